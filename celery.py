@@ -16,6 +16,14 @@ app.conf.beat_schedule = {
         'task': 'machine.tasks.health_check_task',
         'schedule': crontab(minute='*/5'),
     },
+    'compact-health-logs-daily': {
+        'task': 'machine.tasks.compact_health_logs_task',
+        'schedule': crontab(hour=3, minute=30),
+    },
+    'maintain-db-daily': {
+        'task': 'machine.tasks.maintain_db_task',
+        'schedule': crontab(hour=4, minute=0),
+    },
 }
 
 app.conf.timezone = 'UTC'
\ No newline at end of file
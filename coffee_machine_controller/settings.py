@@ -54,14 +54,33 @@ TEMPLATES = [
 WSGI_APPLICATION = 'coffee_machine_controller.wsgi.application'
 ASGI_APPLICATION = 'coffee_machine_controller.asgi.application'
 
+# Serve the machine API with async views (single-process uvicorn mode)
+COFFEE_MACHINE_ASYNC_VIEWS = os.getenv('COFFEE_MACHINE_ASYNC_VIEWS', 'False').lower() == 'true'
+
 # Database
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': '/data/db.sqlite3' if os.path.exists('/data') else BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            'timeout': 20,  # Seconds a writer waits for the lock before "database is locked"
+        },
+        'CONN_MAX_AGE': int(os.getenv('DJANGO_CONN_MAX_AGE', '600')),  # Reuse connections across requests
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Applied to every new SQLite connection (gunicorn workers, Celery and the poller share the file)
+SQLITE_PRAGMAS = {
+    # Takes effect on new databases only (and must come before WAL); maintain_db --convert for older ones
+    'auto_vacuum': 'incremental',
+    'journal_mode': 'wal',      # Readers never block the writer, commits append to the WAL
+    'synchronous': 'normal',    # fsync at checkpoints only; safe against corruption in WAL mode
+    'cache_size': -8000,        # KiB of page cache per connection
+    'mmap_size': 67108864,      # Bytes of the file read through mmap
+    'temp_store': 'memory',
+}
+
 # REST Framework
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
@@ -72,6 +91,8 @@ REST_FRAMEWORK = {
         'rest_framework.parsers.FormParser',
         'rest_framework.parsers.MultiPartParser',
     ],
+    # ?format=raw selects the status payload, not a renderer
+    'DEFAULT_CONTENT_NEGOTIATION_CLASS': 'machine.renderers.PayloadFormatNegotiation',
 }
 
 # CORS settings - Allow Home Assistant and local access
@@ -114,19 +135,107 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 COFFEE_MACHINE_PORT = os.getenv('COFFEE_MACHINE_PORT', '/dev/serial/by-id/usb-FTDI_FT232R_USB_UART_BG01CG7P-if00-port0')  # Your coffee machine port on Raspberry Pi
 COFFEE_MACHINE_BAUDRATE = int(os.getenv('COFFEE_MACHINE_BAUDRATE', '9600'))
 
+MACHINE_INFO_CACHE_TIMEOUT = 300  # Seconds machine info may be cached (also its Cache-Control max-age)
+
+# Status poller and delivery tracking
+# Background threads (write-behind, poller, tracker, telemetry, order dispatch) run in the serving
+# process only: run.sh sets this, manage.py runserver starts them itself, other commands and tests don't
+COFFEE_MACHINE_BACKGROUND = os.getenv('COFFEE_MACHINE_BACKGROUND', 'False').lower() == 'true'
+COFFEE_MACHINE_POLLER_ENABLED = os.getenv('COFFEE_MACHINE_POLLER_ENABLED', 'True').lower() == 'true'
+COFFEE_MACHINE_POLL_INTERVAL = float(os.getenv('COFFEE_MACHINE_POLL_INTERVAL', '1.0'))          # Idle rate with subscribers
+COFFEE_MACHINE_POLL_MIN_INTERVAL = float(os.getenv('COFFEE_MACHINE_POLL_MIN_INTERVAL', '0.2'))  # During deliveries
+COFFEE_MACHINE_POLL_MAX_INTERVAL = float(os.getenv('COFFEE_MACHINE_POLL_MAX_INTERVAL', '5.0'))  # Idle, nobody listening
+COFFEE_MACHINE_POLL_COMMAND_BOOST = 10.0  # Seconds of fast polling after a command is written
+COFFEE_MACHINE_SLOW_POLL_INTERVAL = float(os.getenv('COFFEE_MACHINE_SLOW_POLL_INTERVAL', '30'))  # Faults, countdowns, config
+COFFEE_MACHINE_HEARTBEAT_INTERVAL = float(os.getenv('COFFEE_MACHINE_HEARTBEAT_INTERVAL', '60'))  # Nobody watching
+COFFEE_MACHINE_DEMAND_WINDOW = 30.0  # Seconds an API read keeps the poller out of heartbeat mode
+COFFEE_MACHINE_SNAPSHOT_HISTORY = 256  # Snapshot versions kept for resuming push streams
+
+# Server-Sent Events status stream
+STATUS_STREAM_KEEPALIVE = 15    # Seconds between keepalive comments
+STATUS_STREAM_RETRY_MS = 3000   # Browser reconnect delay
+STATUS_STREAM_MAX_AGE = 300     # Seconds before a stream ends and the browser resumes it
+STATUS_STREAM_MAX_THREADS = 4   # Sync streams per gunicorn worker; more clients reconnect for each update
+DELIVERY_TRACKER_BATCH_SIZE = 20        # Completions buffered before a bulk UPDATE
+DELIVERY_TRACKER_FLUSH_INTERVAL = 2.0   # Seconds before buffered completions are written anyway
+DELIVERY_MAX_DURATION = 180             # Seconds after which an untracked delivery is considered orphaned
+DELIVERY_API_MATCH_WINDOW = 15          # Seconds an API delivery may precede the group going busy
+DELIVERY_STATS_BATCH_SIZE = 500         # Finished deliveries added to the hourly/daily stats per tracker flush
+MACHINE_BATCH_MAX_ACTIONS = 8           # Actions accepted by one /api/batch/ request
+IDEMPOTENCY_KEY_TTL = 600               # Seconds a command result is replayed for a retried Idempotency-Key
+IDEMPOTENCY_WAIT_TIMEOUT = 30           # Seconds a duplicate waits for the original request to finish
+
+# Write-behind buffer: maintenance logs and delivery updates are written off the request path
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'True').lower() == 'true'
+WRITE_BEHIND_FLUSH_INTERVAL = 0.25      # Seconds between flushes
+WRITE_BEHIND_BATCH_SIZE = 50            # Queued writes that trigger an early flush
+WRITE_BEHIND_JOURNAL_DIR = os.getenv('WRITE_BEHIND_JOURNAL_DIR') or None  # Replayed after a crash; off when unset
+WRITE_BEHIND_JOURNAL_FSYNC = False      # Also survive power loss, at one fsync per queued write
+
+# Health checks: a log row per status change, daily counters for the rest
+HEALTH_ROLLUP_INTERVAL = 300            # Seconds between writes of the health check counters
+HEALTH_LOG_RETENTION_DAYS = 30          # Older health check log rows are folded into daily summaries
+
+# Database maintenance (maintain_db command and the nightly Celery task in celery.py)
+DB_BACKUP_DIR = '/data/backups' if os.path.exists('/data') else BASE_DIR / 'backups'
+DB_BACKUP_KEEP = 7                      # Newest backups kept
+DB_BACKUP_STEP_PAGES = 256              # Pages copied per backup step
+DB_MAINTENANCE_BATCH_SIZE = 500         # Rows deleted per transaction
+DB_MAINTENANCE_PAUSE = 0.05             # Seconds between two steps, for writers waiting on the lock
+DB_VACUUM_STEP_PAGES = 200              # Free pages released per incremental VACUUM step
+DB_ANALYSIS_LIMIT = 400                 # Rows sampled per index by ANALYZE
+ORDER_RETENTION_DAYS = 90               # Retention of finished orders (0: forever)
+DELIVERY_RETENTION_DAYS = 365           # Deliveries already counted in the stats
+MAINTENANCE_LOG_RETENTION_DAYS = 180    # Log rows other than health checks
+HOURLY_STATS_RETENTION_DAYS = 90        # Daily stats are kept forever
+
+# Command journal: every register write, replayed after a crash to resume in-flight deliveries
+COMMAND_JOURNAL_ENABLED = os.getenv('COMMAND_JOURNAL_ENABLED', 'True').lower() == 'true'
+COMMAND_JOURNAL_DIR = '/data/journal' if os.path.exists('/data') else BASE_DIR / 'journal'
+COMMAND_JOURNAL_FSYNC = True            # fsync before a command returns (shared by concurrent commands)
+COMMAND_JOURNAL_MAX_BYTES = 1024 * 1024 # Size at which a new journal segment is started
+
+# Telemetry: every change of the state registers, in hourly segment files
+TELEMETRY_ENABLED = os.getenv('TELEMETRY_ENABLED', 'True').lower() == 'true'
+TELEMETRY_DIR = '/data/telemetry' if os.path.exists('/data') else BASE_DIR / 'telemetry'
+TELEMETRY_HEARTBEAT = 60                # Seconds between records while no register changes
+TELEMETRY_MAX_BYTES = 256 * 1024 * 1024 # Oldest segments are deleted beyond this size
+
+# Order queue: drinks without a fixed group, dispatched to the group that can start soonest
+ORDER_QUEUE_MAX_LENGTH = 20
+ORDER_DISPATCH_ATTEMPTS = 3             # Failed starts before an order is marked failed
+DELIVERY_EXPECTED_DURATIONS = {         # Seconds a group stays busy, until enough deliveries were measured
+    'single_short': 20, 'single_medium': 25, 'single_long': 30,
+    'double_short': 25, 'double_medium': 30, 'double_long': 35,
+    'continuous_flow': 60, 'purge': 10,
+}
+DURATION_MODEL_MIN_SAMPLES = 3          # Measured deliveries before a group's own statistics are used
+DURATION_MODEL_WARMUP = 500             # Recent deliveries loaded into the duration model at startup
+
 # Celery Configuration
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 
 # Channels Configuration
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {
-            "hosts": [('127.0.0.1', 6379)],
+# 'memory' keeps a single-node add-on free of Redis; use 'redis' when several
+# processes need to share WebSocket groups.
+CHANNEL_LAYER_BACKEND = os.getenv('CHANNEL_LAYER_BACKEND', 'redis').lower()
+
+if CHANNEL_LAYER_BACKEND == 'memory':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
         },
-    },
-}
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                "hosts": [('127.0.0.1', 6379)],
+            },
+        },
+    }
 
 # Logging
 LOGGING = {
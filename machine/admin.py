@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import CoffeeMachine, CoffeeDelivery, MaintenanceLog
+from .models import (CoffeeMachine, CoffeeDelivery, CoffeeOrder, DailyDeliveryStats, HealthCheckSummary,
+                     HourlyDeliveryStats, MaintenanceLog)
 
 @admin.register(CoffeeMachine)
 class CoffeeMachineAdmin(admin.ModelAdmin):
@@ -9,12 +10,33 @@ class CoffeeMachineAdmin(admin.ModelAdmin):
 
 @admin.register(CoffeeDelivery)
 class CoffeeDeliveryAdmin(admin.ModelAdmin):
-    list_display = ['coffee_type', 'group_number', 'status', 'started_at', 'completed_at']
-    list_filter = ['status', 'coffee_type', 'group_number']
+    list_display = ['coffee_type', 'group_number', 'status', 'source', 'started_at', 'completed_at', 'duration']
+    list_filter = ['status', 'source', 'coffee_type', 'group_number']
     readonly_fields = ['started_at']
 
+@admin.register(CoffeeOrder)
+class CoffeeOrderAdmin(admin.ModelAdmin):
+    list_display = ['id', 'coffee_type', 'status', 'group_number', 'created_at', 'dispatched_at']
+    list_filter = ['status', 'coffee_type', 'group_number']
+    readonly_fields = ['created_at', 'dispatched_at']
+
 @admin.register(MaintenanceLog)
 class MaintenanceLogAdmin(admin.ModelAdmin):
     list_display = ['log_type', 'group_number', 'message', 'timestamp', 'resolved']
     list_filter = ['log_type', 'resolved', 'group_number']
-    readonly_fields = ['timestamp']
\ No newline at end of file
+    readonly_fields = ['timestamp']
+
+@admin.register(HealthCheckSummary)
+class HealthCheckSummaryAdmin(admin.ModelAdmin):
+    list_display = ['date', 'checks', 'healthy', 'unhealthy', 'transitions', 'last_checked_at']
+    readonly_fields = ['last_checked_at']
+
+@admin.register(HourlyDeliveryStats)
+class HourlyDeliveryStatsAdmin(admin.ModelAdmin):
+    list_display = ['hour', 'group_number', 'coffee_type', 'status', 'count', 'timed', 'total_duration']
+    list_filter = ['status', 'coffee_type', 'group_number']
+
+@admin.register(DailyDeliveryStats)
+class DailyDeliveryStatsAdmin(admin.ModelAdmin):
+    list_display = ['date', 'group_number', 'coffee_type', 'status', 'count', 'timed', 'total_duration']
+    list_filter = ['status', 'coffee_type', 'group_number']
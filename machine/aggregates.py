@@ -0,0 +1,142 @@
+"""Hourly and daily delivery counts, kept up to date instead of computed from every row"""
+import logging
+from collections import defaultdict
+from datetime import datetime, time
+from typing import Dict, Iterable, Optional, Tuple
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min
+from .db import lock_for_write
+from .models import CoffeeDelivery, DailyDeliveryStats, HourlyDeliveryStats
+
+logger = logging.getLogger('machine')
+
+# A delivery is counted once it reaches one of these
+FINISHED_STATUSES = ('completed', 'failed', 'stopped')
+
+ROW_FIELDS = ('id', 'started_at', 'group_number', 'coffee_type', 'status', 'duration')
+
+
+def _totals(rows: Iterable[Dict]) -> Tuple[Dict, Dict]:
+    """Count, timed count and summed duration per (hour or date, group, type, status)"""
+    hourly = defaultdict(lambda: [0, 0, 0.0])
+    daily = defaultdict(lambda: [0, 0, 0.0])
+    for row in rows:
+        key = (row['group_number'], row['coffee_type'], row['status'])
+        for totals in (hourly[(row['started_at'].replace(minute=0, second=0, microsecond=0),) + key],
+                       daily[(row['started_at'].date(),) + key]):
+            totals[0] += 1
+            if row['duration'] is not None:
+                totals[1] += 1
+                totals[2] += row['duration']
+    return hourly, daily
+
+
+def _add(model, period: str, totals: Dict):
+    """Add totals to the existing rows of their keys and create the missing ones"""
+    existing = {
+        (getattr(row, period), row.group_number, row.coffee_type, row.status): row
+        for row in model.objects.filter(**{f'{period}__in': {key[0] for key in totals}})
+    }
+    changed, created = [], []
+    for key, (count, timed, duration) in totals.items():
+        row = existing.get(key)
+        if row is None:
+            when, group, coffee_type, status = key
+            created.append(model(**{period: when}, group_number=group, coffee_type=coffee_type, status=status,
+                                 count=count, timed=timed, total_duration=duration))
+        else:
+            row.count += count
+            row.timed += timed
+            row.total_duration += duration
+            changed.append(row)
+    model.objects.bulk_update(changed, ['count', 'timed', 'total_duration'])
+    model.objects.bulk_create(created)
+
+
+def update_delivery_stats(limit: Optional[int] = None) -> int:
+    """Add finished deliveries not counted yet to the stats; returns how many.
+
+    The transaction takes the write lock before it reads anything, so
+    processes updating the stats at the same time queue for it (busy
+    timeout) and each delivery is counted once, however it finished
+    (tracked to completion, stopped, failed to start) and whichever
+    process gets to it first.
+    """
+    limit = limit or getattr(settings, 'DELIVERY_STATS_BATCH_SIZE', 500)
+    with transaction.atomic():
+        lock_for_write(CoffeeDelivery)
+        rows = list(CoffeeDelivery.objects.filter(aggregated=False, status__in=FINISHED_STATUSES)
+                    .order_by('id').values(*ROW_FIELDS)[:limit])
+        if not rows:
+            return 0
+        CoffeeDelivery.objects.filter(id__in=[row['id'] for row in rows]).update(aggregated=True)
+        hourly, daily = _totals(rows)
+        _add(HourlyDeliveryStats, 'hour', hourly)
+        _add(DailyDeliveryStats, 'date', daily)
+    return len(rows)
+
+
+def _day_start(when: datetime) -> datetime:
+    return datetime.combine(when.date(), time.min)
+
+
+def retention_cutoff(cutoff: datetime) -> datetime:
+    """Time before which deliveries can be deleted without losing them from the stats.
+
+    ``cutoff`` is moved back to the start of its day, and to the start of
+    the day of the oldest delivery not counted yet: every delivery before
+    the returned time is counted, and deleting all of them leaves only
+    whole days behind, which ``rebuild_delivery_stats`` recounts.
+    """
+    uncounted = CoffeeDelivery.objects.filter(aggregated=False).aggregate(oldest=Min('started_at'))['oldest']
+    if uncounted is not None:
+        cutoff = min(cutoff, uncounted)
+    return _day_start(cutoff)
+
+
+def rebuild_delivery_stats(chunk_size: int = 2000) -> int:
+    """Recount the stats from the delivery history; returns the deliveries counted.
+
+    Stats from the day of the oldest delivery on are rebuilt; older rows
+    belong to deliveries removed by retention (``retention_cutoff``) and
+    are kept as they are. Runs in one transaction that takes the write lock
+    first, so nothing can finish (or be counted) between the scan and the
+    new totals. The history is streamed with ``iterator()``: memory grows
+    with the number of hours, not of deliveries.
+    """
+    with transaction.atomic():
+        CoffeeDelivery.objects.filter(aggregated=True).exclude(status__in=FINISHED_STATUSES).update(aggregated=False)
+        oldest = CoffeeDelivery.objects.aggregate(oldest=Min('started_at'))['oldest']
+        if oldest is None:
+            logger.info("No deliveries to rebuild the stats from")
+            return 0
+        since = _day_start(oldest)
+        HourlyDeliveryStats.objects.filter(hour__gte=since).delete()
+        DailyDeliveryStats.objects.filter(date__gte=since.date()).delete()
+        finished = CoffeeDelivery.objects.filter(status__in=FINISHED_STATUSES)
+
+        counted = 0
+        def rows():
+            nonlocal counted
+            for row in finished.order_by().values(*ROW_FIELDS).iterator(chunk_size=chunk_size):
+                counted += 1
+                yield row
+        hourly, daily = _totals(rows())
+
+        HourlyDeliveryStats.objects.bulk_create(
+            [HourlyDeliveryStats(hour=when, group_number=group, coffee_type=coffee_type, status=status,
+                                 count=count, timed=timed, total_duration=duration)
+             for (when, group, coffee_type, status), (count, timed, duration) in hourly.items()],
+            batch_size=chunk_size,
+        )
+        DailyDeliveryStats.objects.bulk_create(
+            [DailyDeliveryStats(date=when, group_number=group, coffee_type=coffee_type, status=status,
+                                count=count, timed=timed, total_duration=duration)
+             for (when, group, coffee_type, status), (count, timed, duration) in daily.items()],
+            batch_size=chunk_size,
+        )
+        finished.filter(aggregated=False).update(aggregated=True)
+
+    logger.info(f"Rebuilt delivery stats from {counted} deliveries")
+    return counted
@@ -1,17 +1,81 @@
 from django.apps import AppConfig
+from django.conf import settings
+import os
+import sys
+import atexit
 import logging
 
 logger = logging.getLogger('machine')
 
+def _serving() -> bool:
+    """Whether this process serves the add-on (and so runs its background threads)"""
+    if getattr(settings, 'COFFEE_MACHINE_BACKGROUND', False):
+        return True
+    # manage.py runserver serves from the autoreloader's child process
+    return sys.argv[1:2] == ['runserver'] and (os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv)
+
+
 class MachineConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'machine'
     
     def ready(self):
+        from django.db.backends.signals import connection_created
+        from .db import configure_sqlite
+        connection_created.connect(configure_sqlite, dispatch_uid='machine.configure_sqlite')
+
         # Initialize coffee machine connection on app startup
         try:
             from .coffee_machine import get_coffee_machine
             machine = get_coffee_machine()
             logger.info("Coffee machine controller initialized")
         except Exception as e:
-            logger.error(f"Failed to initialize coffee machine controller: {e}")
\ No newline at end of file
+            logger.error(f"Failed to initialize coffee machine controller: {e}")
+        
+        # Commands sent up to now are on disk; the journal file is closed at shutdown
+        from .journal import get_command_journal
+        atexit.register(get_command_journal().close)
+        
+        # Health checks counted since the last rollup are written at shutdown
+        from .health import get_health_recorder
+        atexit.register(get_health_recorder().flush)
+        
+        # Management commands, Celery workers and tests write through and
+        # leave polling, tracking and dispatching to the server process
+        if not _serving():
+            return
+        
+        # Logs and delivery updates are written in batches off the request path
+        try:
+            from .writebehind import get_write_buffer
+            write_buffer = get_write_buffer()
+            write_buffer.start()
+            atexit.register(write_buffer.stop)
+        except Exception as e:
+            logger.error(f"Failed to start write-behind buffer: {e}")
+        
+        # Start the status poller; it stays idle until the machine is connected
+        if getattr(settings, 'COFFEE_MACHINE_POLLER_ENABLED', True):
+            try:
+                from .poller import get_status_poller
+                from .tracker import get_delivery_tracker
+                from .dispatcher import get_order_dispatcher
+                from .telemetry import get_telemetry_store
+                from .journal import get_command_journal
+                poller = get_status_poller()
+                tracker = get_delivery_tracker()
+                # Replays the journals of dead processes before the tracker sees the first snapshot
+                poller.add_listener(get_command_journal().observe)
+                poller.add_listener(tracker.observe)
+                telemetry = get_telemetry_store()
+                telemetry.start()
+                poller.add_listener(telemetry.observe)
+                dispatcher = get_order_dispatcher()
+                dispatcher.start()
+                poller.start()
+                atexit.register(tracker.flush)
+                atexit.register(poller.stop)
+                atexit.register(telemetry.stop)
+                atexit.register(dispatcher.stop)
+            except Exception as e:
+                logger.error(f"Failed to start status poller: {e}")
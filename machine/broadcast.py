@@ -0,0 +1,82 @@
+"""Single producer that fans machine state out over the channel layer"""
+import asyncio
+import logging
+import threading
+from typing import Optional
+from channels.layers import get_channel_layer
+from .poller import MachineSnapshot, get_status_poller
+
+logger = logging.getLogger('machine')
+
+STATUS_GROUP = 'machine_status'
+
+
+class StatusBroadcaster:
+    """Publishes poller snapshots to every connected WebSocket client.
+
+    Only this object talks to the poller, however many sockets are open:
+    it subscribes while at least one client is attached and sends each
+    snapshot version once (the first in full, then only changed groups).
+    Messages are scheduled on the server's event loop because the poller
+    calls back from its own thread.
+    """
+
+    def __init__(self):
+        self._clients = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._sent: Optional[MachineSnapshot] = None
+        self._lock = threading.Lock()
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        """Register a connected client; the first one starts the subscription"""
+        with self._lock:
+            self._clients += 1
+            self._loop = loop
+            if self._clients == 1:
+                self._sent = None
+                get_status_poller().subscribe(self.publish)
+
+    def detach(self):
+        """Unregister a client; the last one ends the subscription"""
+        with self._lock:
+            self._clients = max(0, self._clients - 1)
+            if self._clients == 0:
+                get_status_poller().unsubscribe(self.publish)
+
+    def publish(self, snapshot: MachineSnapshot):
+        """Poller subscriber: send the snapshot if its version is new"""
+        if self._sent is not None and self._sent.version == snapshot.version:
+            return
+        event = 'snapshot' if self._sent is None else 'groups'
+        data = dict(snapshot.to_status(snapshot.changed_groups(self._sent)), connection_status=True)
+        self._sent = snapshot
+        self.send({'type': 'machine.status', 'payload': {'type': event, 'data': data}})
+
+    def send(self, message: dict):
+        """Send a message to the status group from any thread"""
+        layer = get_channel_layer()
+        if layer is None or self._loop is None or self._loop.is_closed():
+            return
+        future = asyncio.run_coroutine_threadsafe(layer.group_send(STATUS_GROUP, message), self._loop)
+        future.add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Failed to broadcast machine status: {future.exception()}")
+
+
+# Singleton instance for Django integration
+_broadcaster_instance = None
+_broadcaster_lock = threading.Lock()
+
+def get_status_broadcaster() -> StatusBroadcaster:
+    """Get singleton status broadcaster instance"""
+    global _broadcaster_instance
+
+    if _broadcaster_instance is None:
+        with _broadcaster_lock:
+            if _broadcaster_instance is None:
+                _broadcaster_instance = StatusBroadcaster()
+
+    return _broadcaster_instance
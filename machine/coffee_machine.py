@@ -3,11 +3,13 @@ import time
 import logging
 import threading
 from datetime import datetime
-from typing import Dict, Optional, List, Tuple
+from typing import Collection, Dict, Optional, List, Tuple
 from pymodbus.client import ModbusSerialClient
 from pymodbus.exceptions import ModbusException
 from django.conf import settings
 from django.core.cache import cache
+from .journal import RESULT_ERROR, RESULT_FAILED, RESULT_OK, get_command_journal
+from .signals import command_sent
 
 logger = logging.getLogger('machine')
 
@@ -101,6 +103,8 @@ class LaSpazialeCoffeeMachine:
         self.node_address = 0x01  # Official node address from documentation
         self.is_connected = False
         self._connection_lock = threading.Lock()
+        # Serializes bus access between request threads and the status poller
+        self._bus_lock = threading.RLock()
         
         logger.info(f"Coffee machine initialized on port {self.port} at {self.baudrate} bps")
     
@@ -158,11 +162,12 @@ class LaSpazialeCoffeeMachine:
             return None
         
         try:
-            result = self.client.read_holding_registers(
-                address=address, 
-                count=count, 
-                slave=self.node_address
-            )
+            with self._bus_lock:
+                result = self.client.read_holding_registers(
+                    address=address, 
+                    count=count, 
+                    slave=self.node_address
+                )
             if result.isError():
                 logger.error(f"Modbus error reading registers {address}-{address+count-1}: {result}")
                 return None
@@ -182,21 +187,72 @@ class LaSpazialeCoffeeMachine:
             return False
         
         try:
-            result = self.client.write_register(
-                address=address, 
-                value=value, 
-                slave=self.node_address
-            )
+            with self._bus_lock:
+                result = self.client.write_register(
+                    address=address, 
+                    value=value, 
+                    slave=self.node_address
+                )
             success = not result.isError()
+            self._journal(address, [value], RESULT_OK if success else RESULT_FAILED)
             if success:
                 logger.info(f"Successfully wrote value {value} to register {address}")
+                command_sent.send(sender=self.__class__, address=address, value=value)
             else:
                 logger.error(f"Failed to write value {value} to register {address}: {result}")
             return success
         except Exception as e:
             logger.error(f"Error writing register {address}: {e}")
+            self._journal(address, [value], RESULT_ERROR)
+            return False
+    
+    def _write_registers(self, address: int, values: List[int], padding: Collection[int] = ()) -> bool:
+        """Safely write contiguous registers in a single frame (function code 16)
+        
+        ``padding`` are the registers only written to fill a gap between
+        commands: they are neither journaled nor announced as commands.
+        """
+        if not self.is_connected:
+            logger.warning(f"Attempted to write registers while disconnected")
+            return False
+            
+        if not self.ensure_connection():
+            logger.error("Cannot establish connection to coffee machine")
+            return False
+        
+        last = address + len(values) - 1
+        try:
+            with self._bus_lock:
+                result = self.client.write_registers(
+                    address=address,
+                    values=values,
+                    slave=self.node_address
+                )
+            success = not result.isError()
+            self._journal(address, values, RESULT_OK if success else RESULT_FAILED, padding)
+            if success:
+                logger.info(f"Successfully wrote {values} to registers {address}-{last}")
+                for register, value in enumerate(values, start=address):
+                    if register not in padding:
+                        command_sent.send(sender=self.__class__, address=register, value=value)
+            else:
+                logger.error(f"Failed to write {values} to registers {address}-{last}: {result}")
+            return success
+        except Exception as e:
+            logger.error(f"Error writing registers {address}-{last}: {e}")
+            self._journal(address, values, RESULT_ERROR, padding)
             return False
     
+    def _journal(self, address: int, values: List[int], result: int, padding: Collection[int] = ()):
+        """Record a write in the command journal (durably, before the caller acts on the result)"""
+        first_group = self.REGISTERS['COMMAND_GROUP_1']
+        journal = get_command_journal()
+        for register, value in enumerate(values, start=address):
+            if register in padding:
+                continue
+            group = register - first_group + 1 if first_group <= register < first_group + 4 else 0
+            journal.record_write(register, value, result, group)
+    
     # Enhanced identification functions
     def get_machine_info(self) -> Dict:
         """Get comprehensive machine information"""
@@ -213,7 +269,7 @@ class LaSpazialeCoffeeMachine:
         }
         
         # Cache machine info for 5 minutes
-        cache.set('machine_info', info, timeout=300)
+        cache.set('machine_info', info, timeout=getattr(settings, 'MACHINE_INFO_CACHE_TIMEOUT', 300))
         return info
     
     def get_serial_number(self) -> Optional[str]:
@@ -264,7 +320,11 @@ class LaSpazialeCoffeeMachine:
         if registers is None:
             return None
         
-        config_value = registers[0]
+        return self.decode_machine_config(registers[0])
+    
+    @staticmethod
+    def decode_machine_config(config_value: int) -> Dict:
+        """Decode the machine configuration register (268)"""
         doses_config = config_value & 0x03  # bits 0-1
         
         doses_map = {
@@ -280,6 +340,16 @@ class LaSpazialeCoffeeMachine:
         }
     
     # Enhanced status functions
+    def read_register_block(self, first: str, last: str) -> Optional[List[int]]:
+        """Read the contiguous registers ``first``..``last`` (REGISTERS names) in a single frame"""
+        start = self.REGISTERS[first]
+        count = self.REGISTERS[last] - start + 1
+        return self._read_registers(address=start, count=count)
+    
+    def read_state_registers(self) -> Optional[List[int]]:
+        """Read the whole machine state group (registers 256-270) in a single frame"""
+        return self.read_register_block('GROUP_1_SELECTION', 'NUMBER_OF_GROUPS')
+    
     def get_all_groups_status(self) -> Dict:
         """Get status of all groups"""
         num_groups = self.get_number_of_groups() or 3
@@ -322,16 +392,20 @@ class LaSpazialeCoffeeMachine:
         if registers is None:
             return None
         
-        status = registers[0]
+        return self.decode_selection(registers[0])
+    
+    @classmethod
+    def decode_selection(cls, status: int) -> Dict:
+        """Decode a group selection register into its delivery bits"""
         return {
-            'single_short': bool(status & self.STATUS_MASKS['single_short']),
-            'single_long': bool(status & self.STATUS_MASKS['single_long']),
-            'double_short': bool(status & self.STATUS_MASKS['double_short']),
-            'double_long': bool(status & self.STATUS_MASKS['double_long']),
-            'continuous_flow': bool(status & self.STATUS_MASKS['continuous_flow']),
-            'single_medium': bool(status & self.STATUS_MASKS['single_medium']),
-            'double_medium': bool(status & self.STATUS_MASKS['double_medium']),
-            'purge': bool(status & self.STATUS_MASKS['purge']),
+            'single_short': bool(status & cls.STATUS_MASKS['single_short']),
+            'single_long': bool(status & cls.STATUS_MASKS['single_long']),
+            'double_short': bool(status & cls.STATUS_MASKS['double_short']),
+            'double_long': bool(status & cls.STATUS_MASKS['double_long']),
+            'continuous_flow': bool(status & cls.STATUS_MASKS['continuous_flow']),
+            'single_medium': bool(status & cls.STATUS_MASKS['single_medium']),
+            'double_medium': bool(status & cls.STATUS_MASKS['double_medium']),
+            'purge': bool(status & cls.STATUS_MASKS['purge']),
             'raw_status': status
         }
     
@@ -367,6 +441,19 @@ class LaSpazialeCoffeeMachine:
         registers = self._read_registers(register_addr, count=1)
         return registers[0] if registers else None
     
+    def estimate_purge_countdown(self, group_num: int) -> Optional[int]:
+        """Get seconds until automatic purge without touching the bus when possible
+        
+        The countdown ticks down once per second, so it is extrapolated from
+        the status poller's last reading ('purge_countdowns' cache entry).
+        Falls back to reading the register when no reading is cached.
+        """
+        cached = cache.get('purge_countdowns')
+        if cached and group_num in cached['values']:
+            elapsed = int(time.time() - cached['read_at'])
+            return max(0, cached['values'][group_num] - elapsed)
+        return self.get_purge_countdown(group_num)
+    
     def is_group_busy(self, group_num: int) -> Optional[bool]:
         """Check if a group is busy (has an ongoing delivery)"""
         selection = self.get_group_selection(group_num)
@@ -429,7 +516,7 @@ class LaSpazialeCoffeeMachine:
             }
         
         # Check purge countdown - don't deliver if near purge time
-        countdown = self.get_purge_countdown(group_num)
+        countdown = self.estimate_purge_countdown(group_num)
         if countdown is not None and countdown < 10:  # Less than 10 seconds to purge
             return {
                 'success': False,
@@ -493,6 +580,52 @@ class LaSpazialeCoffeeMachine:
             raise ValueError("MAT set number must be 0, 1, or 2")
         return self._write_register(self.REGISTERS['MAT_COMMAND'], set_num)
     
+    def plan_command_frames(self, writes: Dict[int, int], number_of_groups: int) -> List[Tuple[int, List[int]]]:
+        """Group command register writes into as few multi-register frames as possible
+        
+        Gaps between targeted group command registers are padded with
+        NO_ACTION, but only with the registers of the ``number_of_groups``
+        groups the machine has. The water and MAT registers have no such
+        value (0 means stop), so a frame never spans them unless they are
+        targeted.
+        """
+        padding = {self.REGISTERS[f'COMMAND_GROUP_{group}'] for group in range(1, min(number_of_groups, 4) + 1)}
+        frames = []
+        for address in sorted(writes):
+            if frames:
+                start, values = frames[-1]
+                gap = range(start + len(values), address)
+                if all(register in padding for register in gap):
+                    values.extend([self.COMMANDS['NO_ACTION']] * len(gap))
+                    values.append(writes[address])
+                    continue
+            frames.append((address, [writes[address]]))
+        return frames
+    
+    def send_commands(self, writes: Dict[int, int], number_of_groups: Optional[int] = None) -> Dict[int, bool]:
+        """Write several command registers ({address: value}); returns success per address
+        
+        ``number_of_groups`` is read from the machine when not given; if
+        that fails, no gap is padded.
+        """
+        if number_of_groups is None:
+            number_of_groups = self.get_number_of_groups() or 0
+        results = {}
+        for start, values in self.plan_command_frames(writes, number_of_groups):
+            if len(values) == 1:
+                success = self._write_register(start, values[0])
+            else:
+                padding = {address for address in range(start, start + len(values)) if address not in writes}
+                success = self._write_registers(start, values, padding)
+            for address in range(start, start + len(values)):
+                if address in writes:
+                    results[address] = success
+        
+        if any(results.values()):
+            # Clear cached status to force refresh
+            cache.delete('machine_status')
+        return results
+    
     # Health check and diagnostics
     def health_check(self) -> Dict:
         """Perform comprehensive health check"""
@@ -518,7 +651,7 @@ class LaSpazialeCoffeeMachine:
                     group_status = {
                         'busy': self.is_group_busy(group),
                         'sensor_fault': self.get_sensor_fault(group),
-                        'purge_countdown': self.get_purge_countdown(group)
+                        'purge_countdown': self.estimate_purge_countdown(group)
                     }
                     health['groups_status'][f'group_{group}'] = group_status
                     
@@ -0,0 +1,95 @@
+"""WebSocket consumer: live machine state plus deliver/stop/purge commands"""
+import asyncio
+import logging
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from . import services
+from .broadcast import STATUS_GROUP, get_status_broadcaster
+from .idempotency import IdempotencyError
+from .poller import get_status_poller
+
+logger = logging.getLogger('machine')
+
+# action -> (service function, request fields passed to it)
+COMMANDS = {
+    'deliver': (services.deliver_coffee, ('group_number', 'coffee_type', 'client_order_id')),
+    'stop': (services.stop_delivery, ('group_number',)),
+    'purge': (services.start_purge, ('group_number',)),
+}
+
+
+def _current_status():
+    status = get_status_poller().get_status()
+    if status is None:
+        return {'connection_status': False}
+    return dict(status, connection_status=True)
+
+
+class MachineConsumer(AsyncJsonWebsocketConsumer):
+    """Dashboard socket.
+
+    Server -> client: ``snapshot`` / ``groups`` status events,
+    ``command_result`` and ``error`` messages.
+    Client -> server: ``{"action": "deliver" | "stop" | "purge" | "status",
+    "group_number": ..., "coffee_type": ..., "client_order_id": ..., "request_id": ...}``.
+    A deliver with a ``client_order_id`` seen recently is answered with the
+    original result instead of brewing again.
+    """
+
+    async def connect(self):
+        await self.channel_layer.group_add(STATUS_GROUP, self.channel_name)
+        await self.accept()
+        get_status_broadcaster().attach(asyncio.get_running_loop())
+        await self.send_status()
+
+    async def disconnect(self, code):
+        get_status_broadcaster().detach()
+        await self.channel_layer.group_discard(STATUS_GROUP, self.channel_name)
+
+    async def send_status(self):
+        # Bus and database access run in the shared sync thread
+        status = await database_sync_to_async(_current_status)()
+        await self.send_json({'type': 'snapshot', 'data': status})
+
+    async def receive_json(self, content, **kwargs):
+        action = content.get('action') if isinstance(content, dict) else None
+        request_id = content.get('request_id') if isinstance(content, dict) else None
+
+        if action == 'status':
+            await self.send_status()
+            return
+
+        if action not in COMMANDS:
+            await self.send_json({'type': 'error', 'request_id': request_id,
+                                  'message': f'Unknown action: {action}'})
+            return
+
+        handler, fields = COMMANDS[action]
+        try:
+            result = await database_sync_to_async(handler)(*(content.get(field) for field in fields))
+        except (ValueError, IdempotencyError) as e:
+            await self.send_json({'type': 'error', 'request_id': request_id, 'message': str(e)})
+            return
+        except Exception as e:
+            logger.error(f"WebSocket {action} command failed: {e}")
+            await self.send_json({'type': 'error', 'request_id': request_id,
+                                  'message': f'Machine error: {str(e)}'})
+            return
+
+        reply = {'type': 'command_result', 'action': action, 'request_id': request_id, 'result': result}
+        await self.send_json(reply)
+        if result.get('replayed'):
+            return
+        # Let the other dashboards know too
+        await self.channel_layer.group_send(STATUS_GROUP, {
+            'type': 'machine.command_result',
+            'origin': self.channel_name,
+            'payload': reply,
+        })
+
+    async def machine_status(self, event):
+        await self.send_json(event['payload'])
+
+    async def machine_command_result(self, event):
+        if event.get('origin') != self.channel_name:
+            await self.send_json(event['payload'])
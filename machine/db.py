@@ -0,0 +1,61 @@
+"""SQLite tuning for several processes writing the same database file"""
+import logging
+from typing import Dict, Optional
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger('machine')
+
+DEFAULT_SQLITE_PRAGMAS = {
+    'auto_vacuum': 'incremental',
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -8000,
+    'mmap_size': 67108864,
+    'temp_store': 'memory',
+}
+
+
+def sqlite_pragmas() -> Dict:
+    return getattr(settings, 'SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS)
+
+
+def apply_pragmas(cursor, pragmas: Optional[Dict] = None):
+    """Run ``PRAGMA name = value`` for each entry on a DB-API cursor"""
+    for name, value in (sqlite_pragmas() if pragmas is None else pragmas).items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """``connection_created`` receiver applying ``SQLITE_PRAGMAS``.
+
+    WAL lets the web workers, Celery and the poller read while one of them
+    writes, and with ``synchronous=normal`` a commit no longer waits for an
+    fsync of the SD card. The busy timeout comes from the database
+    ``OPTIONS`` (``timeout``), so writers queue for the lock instead of
+    failing with "database is locked".
+    """
+    if connection.vendor != 'sqlite':
+        return
+    try:
+        with connection.cursor() as cursor:
+            apply_pragmas(cursor)
+    except Exception as e:
+        logger.error(f"Failed to apply SQLite pragmas: {e}")
+
+
+def lock_for_write(model):
+    """Take the write lock as the first statement of the current transaction.
+
+    Django opens transactions with a deferred BEGIN. On SQLite in WAL mode,
+    one that reads first and writes later fails with "database is locked",
+    without waiting for the busy timeout, if another connection committed
+    in between. A write as the first statement queues for the lock like
+    any other writer. ``model`` is any table of the database; no row
+    changes.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    table = connection.ops.quote_name(model._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(f'UPDATE {table} SET id = id WHERE 0')
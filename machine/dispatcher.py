@@ -0,0 +1,335 @@
+"""Order queue that assigns drinks to whichever group can start them soonest"""
+import heapq
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+from django.conf import settings
+from django.utils import timezone
+from . import services
+from .coffee_machine import get_coffee_machine
+from .duration_stats import get_duration_model
+from .journal import get_command_journal
+from .models import CoffeeDelivery, CoffeeOrder
+from .poller import MachineSnapshot, get_status_poller
+from .tracker import DeliveryTracker
+
+logger = logging.getLogger('machine')
+
+
+class QueueFull(Exception):
+    """The order queue is at ``ORDER_QUEUE_MAX_LENGTH``"""
+
+
+class OrderDispatcher:
+    """Queues drinks without a fixed group and starts each on the best group.
+
+    On every snapshot the queue head is sent to the groups that are free
+    right now: not busy, no sensor fault, machine not blocked and the
+    automatic purge not about to start. ETAs come from a greedy schedule
+    over the groups: each queued order takes the group that frees up first,
+    where a busy group frees up after the expected duration of what it is
+    brewing (learned per group by the duration model), and a group close
+    to its purge after the purge.
+
+    The queue is the ``queued`` rows of ``CoffeeOrder``, shared by every
+    server process: any of them can cancel or describe an order, and an
+    order is started only by the process that claims it, by moving it to
+    ``dispatching`` while it is still queued.
+
+    The dispatcher is a poller listener for the whole run (to know when each
+    group went busy) and also subscribes while orders are queued, which keeps
+    the poller at its normal rate instead of falling back to heartbeat. The
+    listener only records busy transitions and wakes the dispatch thread,
+    which does the database queries and bus writes, so polls are never
+    delayed by them.
+    """
+
+    OVERRUN_SECONDS = 2.0   # Assumed remaining time once a delivery outlasts its estimate
+    CLAIM_TIMEOUT = 5.0     # Seconds a commanded group counts as busy before the machine shows it
+    DISPATCH_TIMEOUT = 60.0 # Seconds after which an order left in dispatching was lost with its process
+
+    def __init__(self, max_length: Optional[int] = None, max_attempts: Optional[int] = None):
+        self.max_length = max_length or getattr(settings, 'ORDER_QUEUE_MAX_LENGTH', 20)
+        self.max_attempts = max_attempts or getattr(settings, 'ORDER_DISPATCH_ATTEMPTS', 3)
+        self.purge_guard = services.PURGE_GUARD_SECONDS
+
+        self._attempts: Dict[int, int] = {}                    # order id -> failed starts in this process
+        self._busy_since: Dict[int, float] = {}                # group -> monotonic
+        self._claims: Dict[int, Tuple[float, str]] = {}        # group -> (monotonic, coffee type)
+        self._seen: Optional[MachineSnapshot] = None
+        self._last_recovery: Optional[float] = None
+        self._subscribed = False
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def expected_duration(self, kind: str, group: Optional[int] = None) -> float:
+        """Expected busy time of a coffee type (or 'purge') in seconds, learned per group"""
+        return get_duration_model().expected(kind, group)
+
+    def start(self):
+        """Start listening; orders left queued by a previous run are dispatched from the first snapshot"""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='order-dispatcher', daemon=True)
+        self._thread.start()
+        get_status_poller().add_listener(self.observe)
+
+    def stop(self):
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        get_status_poller().remove_listener(self.observe)
+        self._stopped.set()
+        self._wake.set()
+        thread.join(timeout=10)
+
+    def _queued(self) -> List[Tuple[int, str]]:
+        """(order id, coffee type) of every queued order, oldest first"""
+        return list(CoffeeOrder.objects.filter(status='queued').order_by('created_at', 'id')
+                    .values_list('id', 'coffee_type'))
+
+    def _recover(self, now: float):
+        """Fail orders a dead process claimed but never recorded as dispatched (at most once a timeout)"""
+        if self._last_recovery is not None and now - self._last_recovery < self.DISPATCH_TIMEOUT:
+            return
+        self._last_recovery = now
+        lost = CoffeeOrder.objects.filter(
+            status='dispatching', dispatched_at__lt=timezone.now() - timedelta(seconds=self.DISPATCH_TIMEOUT),
+        ).update(status='failed', error_message='Interrupted while dispatching; see the delivery history')
+        if lost:
+            logger.warning(f"Marked {lost} orders interrupted while dispatching as failed")
+
+    def _update_subscription(self, waiting: bool):
+        """Subscribe to the poller exactly while orders are waiting"""
+        poller = get_status_poller()
+        with self._lock:
+            if waiting and not self._subscribed:
+                poller.subscribe(self.observe)
+                self._subscribed = True
+            elif not waiting and self._subscribed:
+                poller.unsubscribe(self.observe)
+                self._subscribed = False
+
+    # Queue operations (request threads)
+
+    def enqueue(self, coffee_type: str, client_order_id: str = '') -> Dict:
+        """Queue a drink; returns the order with its position and ETA"""
+        coffee_type = services.validate_coffee_type(coffee_type)
+        if CoffeeOrder.objects.filter(status='queued').count() >= self.max_length:
+            raise QueueFull(f'Order queue is full ({self.max_length} orders)')
+        order = CoffeeOrder.objects.create(coffee_type=coffee_type, client_order_id=client_order_id or '')
+        self._update_subscription(True)
+        get_status_poller().wake()  # Dispatch on a fresh snapshot right away
+        described = self.describe(order)
+        logger.info(f"Queued order {order.id} ({coffee_type}), position {described.get('position')}")
+        return described
+
+    def cancel(self, order_id: int) -> bool:
+        """Cancel a queued order; False if it is no longer queued (dispatched meanwhile, by any process)"""
+        if not CoffeeOrder.objects.filter(id=order_id, status='queued').update(status='cancelled'):
+            return False
+        self._attempts.pop(order_id, None)
+        logger.info(f"Cancelled order {order_id}")
+        return True
+
+    # Scheduling
+
+    def _group_available_in(self, snapshot: MachineSnapshot, group: int, now: float) -> Optional[float]:
+        """Seconds until a group can start a new order, or None if it cannot take orders"""
+        if snapshot.sensor_fault(group):
+            return None
+
+        wait = 0.0
+        claim = self._claims.get(group)
+        if snapshot.is_group_busy(group):
+            kind = DeliveryTracker.busy_kind(snapshot.selection(group))
+            if kind is None and claim is not None:
+                kind = claim[1]
+            since = self._busy_since.get(group, now)
+            expected = self.expected_duration(kind or 'continuous_flow', group)
+            wait = max(self.OVERRUN_SECONDS, expected - (now - since))
+        elif claim is not None:
+            wait = max(self.OVERRUN_SECONDS, self.expected_duration(claim[1], group) - (now - claim[0]))
+
+        # The countdown only matters once the group is free again
+        countdown = snapshot.purge_countdown(group, now)
+        if countdown - wait < self.purge_guard:
+            wait = max(wait, countdown) + self.expected_duration('purge', group)
+        return wait
+
+    def schedule(self, snapshot: Optional[MachineSnapshot] = None, now: Optional[float] = None) -> List[Dict]:
+        """Planned group and start/ready ETAs of every queued order, in queue order"""
+        snapshot = snapshot or get_status_poller().snapshot
+        now = now if now is not None else time.monotonic()
+        queued = self._queued()
+        with self._lock:
+            groups = []
+            if snapshot is not None and not snapshot.machine_blocked:
+                for group in snapshot.groups():
+                    available_in = self._group_available_in(snapshot, group, now)
+                    if available_in is not None:
+                        groups.append((available_in, group))
+
+        heapq.heapify(groups)
+        plan = []
+        for position, (order_id, coffee_type) in enumerate(queued, start=1):
+            entry = {'order_id': order_id, 'coffee_type': coffee_type, 'position': position,
+                     'estimated_group': None, 'eta_start_seconds': None, 'eta_ready_seconds': None}
+            if groups:
+                available_in, group = heapq.heappop(groups)
+                ready_in = available_in + self.expected_duration(coffee_type, group)
+                entry.update(estimated_group=group, eta_start_seconds=round(available_in, 1),
+                             eta_ready_seconds=round(ready_in, 1))
+                heapq.heappush(groups, (ready_in, group))
+            plan.append(entry)
+        return plan
+
+    def describe(self, order: CoffeeOrder) -> Dict:
+        """Order fields plus its queue position and ETA while it is queued"""
+        data = {
+            'order_id': order.id,
+            'coffee_type': order.coffee_type,
+            'status': order.status,
+            'client_order_id': order.client_order_id,
+            'group_number': order.group_number,
+            'delivery_id': order.delivery_id,
+            'created_at': order.created_at.isoformat(),
+            'dispatched_at': order.dispatched_at.isoformat() if order.dispatched_at else None,
+            'error_message': order.error_message,
+        }
+        data['expected_completion'] = None
+        if order.status == 'queued':
+            planned = next((entry for entry in self.schedule() if entry['order_id'] == order.id), None)
+            if planned is not None:
+                del planned['order_id'], planned['coffee_type']
+                data.update(planned)
+                if planned['eta_ready_seconds'] is not None:
+                    ready_at = timezone.now() + timedelta(seconds=planned['eta_ready_seconds'])
+                    data['expected_completion'] = ready_at.isoformat()
+        elif order.status == 'dispatched' and order.dispatched_at:
+            expected = self.expected_duration(order.coffee_type, order.group_number)
+            data['expected_completion'] = (order.dispatched_at + timedelta(seconds=expected)).isoformat()
+        return data
+
+    # Dispatching
+
+    def observe(self, snapshot: MachineSnapshot):
+        """Poller listener: track busy transitions and wake the dispatch thread"""
+        if snapshot is self._seen:
+            return  # Called as both listener and subscriber
+        self._seen = snapshot
+
+        with self._lock:
+            for group, busy in snapshot.busy_groups().items():
+                if busy and group not in self._busy_since:
+                    claim = self._claims.pop(group, None)
+                    self._busy_since[group] = claim[0] if claim else snapshot.monotonic
+                elif not busy:
+                    self._busy_since.pop(group, None)
+                    claim = self._claims.get(group)
+                    if claim is not None and snapshot.monotonic - claim[0] > self.CLAIM_TIMEOUT:
+                        del self._claims[group]
+        self._wake.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait()
+            self._wake.clear()
+            snapshot = self._seen
+            if self._stopped.is_set() or snapshot is None:
+                continue
+            try:
+                self.dispatch(snapshot)
+            except Exception as e:
+                logger.error(f"Order dispatch failed: {e}")
+
+    def dispatch(self, snapshot: MachineSnapshot):
+        """Start queued orders on the groups that are free in ``snapshot`` (dispatch thread)"""
+        self._recover(snapshot.monotonic)
+        with self._lock:
+            if snapshot.machine_blocked:
+                return
+            free = [group for group in snapshot.groups()
+                    if self._group_available_in(snapshot, group, snapshot.monotonic) == 0]
+        if not free and not self._subscribed:
+            return  # Nothing to start and no subscription to drop: skip the queue query
+
+        queued = self._queued()
+        self._update_subscription(bool(queued))
+        groups = iter(free)
+        group = next(groups, None)
+        while group is not None and queued:
+            order_id, coffee_type = queued.pop(0)
+            started = self._dispatch(order_id, coffee_type, group)
+            if started is None:
+                continue  # Taken by another process or cancelled: the group is still free
+            if not started:
+                break  # Retry on the next snapshot rather than burning attempts
+            group = next(groups, None)
+
+    def _dispatch(self, order_id: int, coffee_type: str, group: int) -> Optional[bool]:
+        """Claim an order and start it on a group; False if it did not start, None if it was not queued anymore"""
+        claimed = CoffeeOrder.objects.filter(id=order_id, status='queued').update(
+            status='dispatching', group_number=group, dispatched_at=timezone.now(),
+        )
+        if not claimed:
+            return None
+
+        # Failed attempts are retried, so only a delivery that started gets a history row
+        try:
+            result = get_coffee_machine().deliver_coffee(group, coffee_type)
+        except Exception as e:
+            logger.error(f"Failed to dispatch order {order_id}: {e}")
+            result = {'success': False, 'message': str(e)}
+
+        if result['success']:
+            with self._lock:
+                self._claims[group] = (time.monotonic(), coffee_type)
+            self._attempts.pop(order_id, None)
+            delivery = CoffeeDelivery.objects.create(coffee_type=coffee_type, group_number=group,
+                                                     status='in_progress')
+            get_command_journal().record_delivery(group, delivery.id, True)
+            CoffeeOrder.objects.filter(id=order_id).update(
+                status='dispatched', delivery_id=delivery.id, dispatched_at=timezone.now(),
+            )
+            logger.info(f"Dispatched order {order_id} ({coffee_type}) to group {group}")
+            return True
+
+        get_command_journal().record_delivery(group, 0, False)
+        attempts = self._attempts.pop(order_id, 0) + 1
+        if attempts >= self.max_attempts:
+            CoffeeOrder.objects.filter(id=order_id).update(
+                status='failed', group_number=None, dispatched_at=None, error_message=result['message'],
+            )
+            logger.error(f"Order {order_id} failed after {self.max_attempts} attempts: {result['message']}")
+        else:
+            self._attempts[order_id] = attempts
+            # Back in the queue at its place (created_at), for any process to start
+            CoffeeOrder.objects.filter(id=order_id).update(status='queued', group_number=None, dispatched_at=None)
+            logger.warning(f"Order {order_id} not started on group {group}: {result['message']}")
+        return False
+
+    def metrics(self) -> Dict:
+        return {'queued': CoffeeOrder.objects.filter(status='queued').count(), 'subscribed': self._subscribed,
+                'max_length': self.max_length}
+
+
+# Singleton instance for Django integration
+_dispatcher_instance = None
+_dispatcher_lock = threading.Lock()
+
+def get_order_dispatcher() -> OrderDispatcher:
+    """Get singleton order dispatcher instance"""
+    global _dispatcher_instance
+
+    if _dispatcher_instance is None:
+        with _dispatcher_lock:
+            if _dispatcher_instance is None:
+                _dispatcher_instance = OrderDispatcher()
+
+    return _dispatcher_instance
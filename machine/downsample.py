@@ -0,0 +1,67 @@
+"""Downsampling of telemetry series for charts (NumPy arrays in, NumPy arrays out)"""
+import numpy as np
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Indices of the points kept by Largest-Triangle-Three-Buckets.
+
+    Keeps the first and last point and, from each of ``threshold - 2``
+    equal-count buckets in between, the point forming the largest triangle
+    with the point kept before it and the average of the next bucket, so
+    peaks and drops survive where plain decimation would skip them. The
+    bucket averages and each bucket's areas are computed as arrays; only
+    the walk from bucket to bucket is a Python loop.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64) - x[0]  # Relative, so epoch seconds keep their precision
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.intp)
+    sizes = np.diff(edges)
+    avg_x = np.add.reduceat(x[:n - 1], edges[:-1]) / sizes
+    avg_y = np.add.reduceat(y[:n - 1], edges[:-1]) / sizes
+    next_x = np.append(avg_x[1:], x[-1])
+    next_y = np.append(avg_y[1:], y[-1])
+
+    kept = np.empty(threshold, dtype=np.intp)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for bucket in range(threshold - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        area = np.abs((x[a] - next_x[bucket]) * (y[lo:hi] - y[a])
+                      - (x[a] - x[lo:hi]) * (next_y[bucket] - y[a]))
+        a = lo + int(np.argmax(area))
+        kept[bucket + 1] = a
+    return kept
+
+
+def runs(t: np.ndarray, until: np.ndarray, on: np.ndarray):
+    """Start and end times of the runs of ``on``.
+
+    Value ``i`` holds from ``t[i]`` to ``until[i]``; where ``until[i]`` is
+    before ``t[i + 1]`` there is no data in between and a run ends there.
+    """
+    if not len(t):
+        return np.empty(0), np.empty(0)
+    contiguous = until[:-1] >= t[1:]
+    begins = on & ~np.r_[False, on[:-1] & contiguous]
+    ends = on & ~np.r_[on[1:] & contiguous, False]
+    return t[begins], until[ends]
+
+
+def duty_cycle(starts: np.ndarray, ends: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """Fraction of each bucket ``edges[i]``-``edges[i + 1]`` covered by the (sorted, disjoint) runs"""
+    lengths = ends - starts
+    before = np.r_[0.0, np.cumsum(lengths)]  # Run time before each run starts
+
+    def covered(x):
+        """Run time before each ``x``"""
+        index = np.searchsorted(starts, x, side='right') - 1
+        inside = np.clip(x - starts[np.maximum(index, 0)], 0, lengths[np.maximum(index, 0)])
+        return np.where(index >= 0, before[np.maximum(index, 0)] + inside, 0.0)
+
+    if not len(starts):
+        return np.zeros(len(edges) - 1)
+    return np.diff(covered(edges)) / np.diff(edges)
@@ -0,0 +1,226 @@
+"""Delivery duration statistics learned incrementally from the machine"""
+import logging
+import math
+import threading
+from bisect import insort
+from typing import Dict, List, Optional, Tuple
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger('machine')
+
+# Expected seconds of a kind missing from DELIVERY_EXPECTED_DURATIONS, whose defaults live in the settings
+FALLBACK_DURATION = 30.0
+
+
+class RunningStats:
+    """Count, mean and variance in O(1) memory (Welford's algorithm)"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def variance(self) -> Optional[float]:
+        """Sample variance, None below two samples"""
+        return self._m2 / (self.count - 1) if self.count > 1 else None
+
+    @property
+    def stddev(self) -> Optional[float]:
+        variance = self.variance
+        return math.sqrt(variance) if variance is not None else None
+
+
+class P2Quantile:
+    """Streaming estimate of one quantile with five markers (the P-square algorithm).
+
+    Keeps no samples: marker heights are nudged towards their desired
+    positions with a piecewise-parabolic fit as observations arrive.
+    """
+
+    def __init__(self, p: float):
+        self.p = p
+        self.heights: List[float] = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, value: float):
+        heights, positions = self.heights, self.positions
+        if len(heights) < 5:
+            insort(heights, value)
+            return
+
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = next(i for i in range(4) if heights[i] <= value < heights[i + 1])
+
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in (1, 2, 3):
+            offset = self.desired[i] - positions[i]
+            if ((offset >= 1 and positions[i + 1] - positions[i] > 1) or
+                    (offset <= -1 and positions[i - 1] - positions[i] < -1)):
+                step = 1 if offset > 0 else -1
+                height = self._parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self._linear(i, step)
+                heights[i] = height
+                positions[i] += step
+
+    def _parabolic(self, i: int, step: int) -> float:
+        q, n = self.heights, self.positions
+        return q[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def _linear(self, i: int, step: int) -> float:
+        q, n = self.heights, self.positions
+        return q[i] + step * (q[i + step] - q[i]) / (n[i + step] - n[i])
+
+    @property
+    def value(self) -> Optional[float]:
+        if not self.heights:
+            return None
+        if len(self.heights) < 5:
+            return self.heights[round(self.p * (len(self.heights) - 1))]
+        return self.heights[2]
+
+
+class DurationStats:
+    """Running moments plus median and p90 of one group/coffee type"""
+
+    QUANTILES = (0.5, 0.9)
+
+    def __init__(self):
+        self.moments = RunningStats()
+        self.quantiles = {p: P2Quantile(p) for p in self.QUANTILES}
+
+    @property
+    def count(self) -> int:
+        return self.moments.count
+
+    def add(self, duration: float):
+        self.moments.add(duration)
+        for quantile in self.quantiles.values():
+            quantile.add(duration)
+
+    def quantile(self, p: float) -> Optional[float]:
+        return self.quantiles[p].value
+
+    def to_dict(self) -> Dict:
+        def rounded(value):
+            return round(value, 2) if value is not None else None
+        return {
+            'count': self.count,
+            'mean': rounded(self.moments.mean),
+            'stddev': rounded(self.moments.stddev),
+            'min': rounded(self.moments.min),
+            'max': rounded(self.moments.max),
+            'p50': rounded(self.quantile(0.5)),
+            'p90': rounded(self.quantile(0.9)),
+        }
+
+
+class DurationModel:
+    """Expected busy time per (group, coffee type), updated as deliveries finish.
+
+    The delivery tracker feeds every measured busy period in; ETAs read the
+    median back in O(1). Per-group statistics are used once they have
+    ``min_samples`` deliveries, then the machine-wide statistics of the
+    coffee type, then ``DELIVERY_EXPECTED_DURATIONS``. On first use the model
+    is warmed up from the most recent ``warmup`` completed deliveries so a
+    restart does not forget everything.
+    """
+
+    def __init__(self, min_samples: Optional[int] = None, warmup: Optional[int] = None):
+        self.min_samples = min_samples or getattr(settings, 'DURATION_MODEL_MIN_SAMPLES', 3)
+        self.warmup = warmup or getattr(settings, 'DURATION_MODEL_WARMUP', 500)
+        self._stats: Dict[Tuple[Optional[int], str], DurationStats] = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._created_at = timezone.now()
+
+    def observe(self, group: int, kind: str, duration: float):
+        """Record one measured busy period of a group"""
+        if not kind or duration is None or duration <= 0:
+            return
+        with self._lock:
+            for key in ((group, kind), (None, kind)):
+                stats = self._stats.get(key)
+                if stats is None:
+                    stats = self._stats[key] = DurationStats()
+                stats.add(duration)
+
+    def _ensure_loaded(self):
+        """Warm up from recent history once (deliveries measured before this process started)"""
+        if self._loaded:
+            return
+        from .models import CoffeeDelivery
+        try:
+            rows = list(
+                CoffeeDelivery.objects.filter(
+                    status='completed', duration__isnull=False, completed_at__lt=self._created_at,
+                ).order_by('-completed_at').values_list('group_number', 'coffee_type', 'duration')[:self.warmup]
+            )
+        except Exception as e:
+            logger.error(f"Failed to warm up delivery duration model: {e}")
+            return
+        self._loaded = True
+        for group, coffee_type, duration in reversed(rows):
+            self.observe(group, coffee_type, duration)
+        if rows:
+            logger.info(f"Warmed up delivery duration model from {len(rows)} deliveries")
+
+    def expected(self, kind: str, group: Optional[int] = None) -> float:
+        """Expected busy time of a coffee type (or 'purge') in seconds"""
+        self._ensure_loaded()
+        with self._lock:
+            for key in ((group, kind), (None, kind)):
+                stats = self._stats.get(key)
+                if stats is not None and stats.count >= self.min_samples:
+                    return stats.quantile(0.5)
+        return float(getattr(settings, 'DELIVERY_EXPECTED_DURATIONS', {}).get(kind, FALLBACK_DURATION))
+
+    def summary(self) -> List[Dict]:
+        """Statistics of every group/type seen so far (group None = all groups)"""
+        self._ensure_loaded()
+        with self._lock:
+            items = sorted(self._stats.items(), key=lambda item: (item[0][0] or 0, item[0][1]))
+            return [dict(stats.to_dict(), group=group, coffee_type=kind) for (group, kind), stats in items]
+
+
+# Singleton instance for Django integration
+_model_instance = None
+_model_lock = threading.Lock()
+
+def get_duration_model() -> DurationModel:
+    """Get singleton delivery duration model instance"""
+    global _model_instance
+
+    if _model_instance is None:
+        with _model_lock:
+            if _model_instance is None:
+                _model_instance = DurationModel()
+
+    return _model_instance
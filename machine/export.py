@@ -0,0 +1,134 @@
+"""Streaming CSV and Parquet exports of the delivery and maintenance history"""
+import io
+import csv
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+from django.utils import timezone
+from .models import CoffeeDelivery, MaintenanceLog
+from .pagination import keyset_chunks
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Optional: only the Parquet format needs it
+    pa = None
+
+# kind -> (model, time field, exported columns)
+EXPORTS = {
+    'deliveries': (CoffeeDelivery, 'started_at', ['id', 'coffee_type', 'group_number', 'status', 'source',
+                                                   'started_at', 'completed_at', 'duration', 'error_message']),
+    'logs': (MaintenanceLog, 'timestamp', ['id', 'log_type', 'group_number', 'message', 'timestamp', 'resolved']),
+}
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'parquet': 'application/vnd.apache.parquet',
+}
+DEFAULT_CHUNK_SIZE = 2000
+
+
+def export_options(params) -> Dict:
+    """``format``, ``start``, ``end`` and ``group`` from query parameters; raises ValueError"""
+    try:
+        start = datetime.fromisoformat(params['start']) if params.get('start') else None
+        end = datetime.fromisoformat(params['end']) if params.get('end') else None
+    except ValueError:
+        raise ValueError('start and end must be ISO dates or datetimes')
+    try:
+        group = int(params['group']) if params.get('group') else None
+    except ValueError:
+        raise ValueError('group must be an integer')
+    return {'fmt': params.get('format', 'csv'), 'start': start, 'end': end, 'group': group}
+
+
+def export_filename(kind: str, fmt: str) -> str:
+    return f'{kind}-{timezone.now():%Y%m%d-%H%M%S}.{fmt}'
+
+
+def export_chunks(kind: str, fmt: str = 'csv', start: Optional[datetime] = None, end: Optional[datetime] = None,
+                  group: Optional[int] = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+    """The encoded export, one piece per ``chunk_size`` rows, oldest row first.
+
+    Rows from ``start`` (inclusive) to ``end`` (exclusive), optionally of
+    one group. Checks its arguments right away (ValueError, or RuntimeError
+    for Parquet without pyarrow); the rows are only read as the returned
+    iterator is consumed.
+    """
+    if kind not in EXPORTS:
+        raise ValueError(f"Unknown export: {kind} (available: {', '.join(EXPORTS)})")
+    if fmt not in CONTENT_TYPES:
+        raise ValueError(f"format must be one of: {', '.join(CONTENT_TYPES)}")
+    if fmt == 'parquet' and pa is None:
+        raise RuntimeError('Parquet exports require pyarrow')
+
+    model, time_field, fields = EXPORTS[kind]
+    rows = model.objects.all()
+    if start is not None:
+        rows = rows.filter(**{f'{time_field}__gte': start})
+    if end is not None:
+        rows = rows.filter(**{f'{time_field}__lt': end})
+    if group is not None:
+        rows = rows.filter(group_number=group)
+
+    chunks = keyset_chunks(rows, time_field, fields, chunk_size)
+    return _csv(fields, chunks) if fmt == 'csv' else _parquet(model, fields, chunks)
+
+
+def _csv(fields: List[str], chunks) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for rows in chunks:
+        writer.writerows(
+            [value.isoformat() if isinstance(value, datetime) else value for value in row] for row in rows
+        )
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()  # Header of an empty export
+
+
+class _Sink(io.RawIOBase):
+    """File the Parquet writer writes to; collects the bytes written since the last ``drain()``"""
+
+    def __init__(self):
+        super().__init__()
+        self._parts: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b''.join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def _parquet(model, fields: List[str], chunks) -> Iterator[bytes]:
+    """One row group per chunk; the footer follows the last one"""
+    types = {
+        'BigAutoField': pa.int64(), 'AutoField': pa.int64(), 'IntegerField': pa.int64(),
+        'CharField': pa.string(), 'TextField': pa.string(), 'FloatField': pa.float64(),
+        'BooleanField': pa.bool_(), 'DateTimeField': pa.timestamp('us'),
+    }
+    schema = pa.schema([(name, types[model._meta.get_field(name).get_internal_type()]) for name in fields])
+    sink = _Sink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for rows in chunks:
+            columns = zip(*rows)
+            writer.write_batch(pa.record_batch(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
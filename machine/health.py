@@ -0,0 +1,154 @@
+"""Health check recording: log status changes, count everything else"""
+import re
+import time
+import logging
+import threading
+from collections import defaultdict
+from datetime import timedelta
+from typing import Dict, List, Optional
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Max, Q
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from .models import HealthCheckSummary, MaintenanceLog
+
+logger = logging.getLogger('machine')
+
+# Countdowns change on every check; they must not make every check a "new" error set
+_COUNTDOWN = re.compile(r' in \d+s$')
+
+
+def health_message(status: str, errors: List[str]) -> str:
+    """Log message identifying a health state: the status plus its (normalized) error set"""
+    errors = sorted({_COUNTDOWN.sub('', error) for error in errors})
+    return f'Health check - Status: {status}' + (f' ({"; ".join(errors)})' if errors else '')
+
+
+class HealthRecorder:
+    """Records health check results without a log row per check.
+
+    A ``health_check`` MaintenanceLog row is written only when the result
+    differs from the last one logged (healthy <-> unhealthy, or a different
+    set of errors). Every check is also counted per day in memory and added
+    to ``HealthCheckSummary`` every ``rollup_interval`` seconds and at
+    shutdown.
+    """
+
+    def __init__(self, rollup_interval: Optional[float] = None):
+        self.rollup_interval = rollup_interval or getattr(settings, 'HEALTH_ROLLUP_INTERVAL', 300)
+        self._counts: Dict = defaultdict(lambda: {'checks': 0, 'healthy': 0, 'unhealthy': 0})
+        self._last_checked_at = None
+        self._last_rollup = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, health: Dict) -> bool:
+        """Count a health check result and log it if the state changed; returns whether it was logged"""
+        now = timezone.now()
+        status = health.get('overall_status', 'unhealthy')
+        errors = list(health.get('errors', []))
+        if not health.get('connection', True) and not errors:
+            errors.append('Machine not connected')
+
+        with self._lock:
+            counts = self._counts[now.date()]
+            counts['checks'] += 1
+            counts[status if status in ('healthy', 'unhealthy') else 'unhealthy'] += 1
+            self._last_checked_at = now
+            due = time.monotonic() - self._last_rollup >= self.rollup_interval
+
+        logged = self._log_transition(status, errors, now)
+        if due:
+            self.flush()
+        return logged
+
+    def _log_transition(self, status: str, errors: List[str], now) -> bool:
+        message = health_message(status, errors)
+        healthy = status == 'healthy'
+        try:
+            last = (MaintenanceLog.objects.filter(log_type='health_check')
+                    .order_by('-timestamp', '-id').values('message', 'resolved').first())
+            if last is not None and last['message'] == message and last['resolved'] == healthy:
+                return False
+            # Written right away (status changes are rare) so the next check compares against it
+            MaintenanceLog.objects.create(log_type='health_check', message=message, resolved=healthy, timestamp=now)
+        except Exception as e:
+            logger.error(f"Failed to log health check: {e}")
+            return False
+        logger.info(f"Health changed: {message}")
+        return True
+
+    def flush(self) -> int:
+        """Add the counted checks to the daily summaries; returns checks written"""
+        with self._lock:
+            counts, self._counts = self._counts, defaultdict(lambda: {'checks': 0, 'healthy': 0, 'unhealthy': 0})
+            last_checked_at = self._last_checked_at
+            self._last_rollup = time.monotonic()
+
+        written = 0
+        try:
+            for date, day in sorted(counts.items()):
+                HealthCheckSummary.objects.get_or_create(date=date)
+                HealthCheckSummary.objects.filter(date=date).update(
+                    checks=F('checks') + day['checks'],
+                    healthy=F('healthy') + day['healthy'],
+                    unhealthy=F('unhealthy') + day['unhealthy'],
+                    last_checked_at=last_checked_at if date == last_checked_at.date() else F('last_checked_at'),
+                )
+                written += day['checks']
+        except Exception as e:
+            logger.error(f"Failed to write health check rollup: {e}")
+            with self._lock:
+                for date, day in counts.items():
+                    for key, value in day.items():
+                        self._counts[date][key] += value
+            return 0
+        return written
+
+
+def compact_health_logs(retention_days: Optional[int] = None) -> int:
+    """Fold ``health_check`` log rows older than the retention into daily summaries.
+
+    Each day's rows are counted as ``transitions``. Days without a summary
+    yet predate the rollup, when every check was logged, so their rows are
+    counted as the checks themselves. Returns the rows deleted.
+    """
+    retention_days = retention_days or getattr(settings, 'HEALTH_LOG_RETENTION_DAYS', 30)
+    cutoff = timezone.now() - timedelta(days=retention_days)
+    old_rows = MaintenanceLog.objects.filter(log_type='health_check', timestamp__lt=cutoff)
+
+    days = (old_rows.annotate(date=TruncDate('timestamp')).values('date')
+            .annotate(rows=Count('id'), healthy=Count('id', filter=Q(resolved=True)), last=Max('timestamp'))
+            .order_by('date'))
+
+    with transaction.atomic():
+        for day in days:
+            summary, created = HealthCheckSummary.objects.get_or_create(date=day['date'])
+            summary.transitions += day['rows']
+            if created:
+                summary.checks = day['rows']
+                summary.healthy = day['healthy']
+                summary.unhealthy = day['rows'] - day['healthy']
+                summary.last_checked_at = day['last']
+            summary.save()
+        deleted, _ = old_rows.delete()
+
+    if deleted:
+        logger.info(f"Compacted {deleted} health check log rows older than {retention_days} days")
+    return deleted
+
+
+# Singleton instance for Django integration
+_recorder_instance = None
+_recorder_lock = threading.Lock()
+
+def get_health_recorder() -> HealthRecorder:
+    """Get singleton health recorder instance"""
+    global _recorder_instance
+
+    if _recorder_instance is None:
+        with _recorder_lock:
+            if _recorder_instance is None:
+                _recorder_instance = HealthRecorder()
+
+    return _recorder_instance
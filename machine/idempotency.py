@@ -0,0 +1,118 @@
+"""Idempotency keys for machine commands, so client retries never brew twice"""
+import time
+import logging
+import threading
+from datetime import timedelta
+from typing import Callable, Dict, Hashable, Optional, Tuple
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from .models import IdempotencyKey
+
+logger = logging.getLogger('machine')
+
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyError(Exception):
+    """A command key could not be honoured"""
+    status_code = 409
+
+
+class IdempotencyKeyReused(IdempotencyError):
+    """The key was already used for a different command"""
+    status_code = 422
+
+
+class IdempotencyStore:
+    """Expiring record of command results by client key, shared by every server process.
+
+    The first request with a key inserts its ``IdempotencyKey`` row (the
+    unique key decides the owner, whichever worker gets the request) and
+    runs the command; any request with the same key within ``ttl`` seconds
+    gets the recorded result back without touching the bus. A duplicate
+    that arrives while the first one is still running waits for its result.
+    Expired keys are deleted as new ones come in.
+    """
+
+    POLL_INTERVAL = 0.05  # Seconds between two looks at a running command's row
+
+    def __init__(self, ttl: Optional[float] = None, wait_timeout: Optional[float] = None):
+        self.ttl = ttl or getattr(settings, 'IDEMPOTENCY_KEY_TTL', 600)
+        self.wait_timeout = wait_timeout or getattr(settings, 'IDEMPOTENCY_WAIT_TIMEOUT', 30)
+
+    def __len__(self):
+        return IdempotencyKey.objects.filter(expires_at__gt=timezone.now()).count()
+
+    def _claim(self, key: str, fingerprint: str) -> Optional[IdempotencyKey]:
+        """Insert the key's row; None if another request owns the key"""
+        now = timezone.now()
+        IdempotencyKey.objects.filter(expires_at__lte=now).delete()
+        try:
+            with transaction.atomic():
+                return IdempotencyKey.objects.create(key=key, fingerprint=fingerprint,
+                                                     expires_at=now + timedelta(seconds=self.ttl))
+        except IntegrityError:
+            return None
+
+    def execute(self, key: str, fingerprint: Hashable, command: Callable[[], Dict]) -> Tuple[Dict, bool]:
+        """Run ``command`` once per key; returns (result, replayed)"""
+        fingerprint = repr(fingerprint)
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            entry = self._claim(key, fingerprint)
+            if entry is not None:
+                break
+            recorded = IdempotencyKey.objects.filter(key=key).values('fingerprint', 'result').first()
+            if recorded is None:
+                continue  # Expired, or the original attempt raised: claim it again
+            if recorded['fingerprint'] != fingerprint:
+                raise IdempotencyKeyReused(f'Idempotency key {key!r} was already used for a different command')
+            if recorded['result'] is not None:
+                logger.info(f"Replaying result for idempotency key {key!r}")
+                return recorded['result'], True
+            if time.monotonic() >= deadline:
+                raise IdempotencyError(f'Command with idempotency key {key!r} is still in progress')
+            time.sleep(self.POLL_INTERVAL)
+
+        try:
+            result = command()
+        except Exception:
+            # Nothing was recorded, so a retry runs the command again
+            IdempotencyKey.objects.filter(id=entry.id).delete()
+            raise
+        # Stored as JSON: a replayed result has dates as ISO strings, like the response it was sent in
+        IdempotencyKey.objects.filter(id=entry.id).update(result=result)
+        return result, False
+
+
+def clean_key(key) -> Optional[str]:
+    """Validate a client-supplied key (header or body field); raises ValueError"""
+    if key is None or key == '':
+        return None
+    key = str(key).strip()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise ValueError(f'Idempotency key must be 1-{MAX_KEY_LENGTH} characters')
+    return key
+
+
+def request_key(request, data) -> Optional[str]:
+    """The ``Idempotency-Key`` header, or else the ``client_order_id`` body field"""
+    body_key = data.get('client_order_id') if isinstance(data, dict) else None
+    return clean_key(request.headers.get('Idempotency-Key') or body_key)
+
+
+# Singleton instance for Django integration
+_store_instance = None
+_store_lock = threading.Lock()
+
+def get_idempotency_store() -> IdempotencyStore:
+    """Get singleton idempotency store instance"""
+    global _store_instance
+
+    if _store_instance is None:
+        with _store_lock:
+            if _store_instance is None:
+                _store_instance = IdempotencyStore()
+
+    return _store_instance
@@ -0,0 +1,305 @@
+"""Append-only journal of the commands written to the machine, for recovery after a crash"""
+import os
+import time
+import uuid
+import fcntl
+import struct
+import zlib
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime
+from typing import Dict, List, Optional
+from django.conf import settings
+from .models import CoffeeDelivery
+
+logger = logging.getLogger('machine')
+
+JOURNAL_PREFIX = 'commands-'
+JOURNAL_SUFFIX = '.journal'
+
+# time (epoch seconds), kind, group (0: not a group register), register, value, result, delivery id
+RECORD = struct.Struct('<dBBHHBq')
+CRC = struct.Struct('<I')
+RECORD_SIZE = RECORD.size + CRC.size
+
+KIND_WRITE = 1     # A register write on the bus
+KIND_DELIVERY = 2  # The CoffeeDelivery row recorded for the last delivery command of a group
+
+RESULT_FAILED = 0  # The machine answered with an error
+RESULT_OK = 1
+RESULT_ERROR = 2   # No answer (timeout, serial error): the machine may or may not have acted on it
+
+JournalRecord = namedtuple('JournalRecord', 'time kind group register value result delivery_id')
+
+
+class CommandJournal:
+    """Records every register write (and the delivery row it became) before the caller goes on.
+
+    Each process appends fixed-size, checksummed records to its own file in
+    ``directory`` and holds a lock on it while it lives. Appends are made
+    durable with group commit: a caller whose record is not on disk yet
+    either writes and fsyncs everything queued so far or waits for the
+    thread already doing so, so concurrent commands share one fsync.
+
+    The journals of processes that died (their lock can be taken) are
+    replayed against the first snapshot of the status poller (``observe``
+    is a poller listener) in the process that tracks deliveries, and then
+    deleted: deliveries that were still
+    running are handed back to the delivery tracker with their real start
+    time, rows of deliveries stopped meanwhile are closed as stopped, and
+    deliveries whose row was never written are recorded.
+    """
+
+    def __init__(self, directory: Optional[str] = None, fsync: Optional[bool] = None,
+                 max_bytes: Optional[int] = None, enabled: Optional[bool] = None):
+        self.directory = str(directory or getattr(settings, 'COMMAND_JOURNAL_DIR', 'journal'))
+        self.fsync = fsync if fsync is not None else getattr(settings, 'COMMAND_JOURNAL_FSYNC', True)
+        self.max_bytes = max_bytes or getattr(settings, 'COMMAND_JOURNAL_MAX_BYTES', 1024 * 1024)
+        self.enabled = enabled if enabled is not None else getattr(settings, 'COMMAND_JOURNAL_ENABLED', True)
+
+        self._cond = threading.Condition()
+        self._pending = bytearray()
+        self._appended = 0    # Records appended (sequence number of the last one)
+        self._durable = 0     # Records written and synced
+        self._committing = False
+        self._fd: Optional[int] = None
+        self._name: Optional[str] = None
+        self._segment = 0
+        self._lock_file = None
+        self._recovered = False
+        self._stats = {'records': 0, 'commits': 0, 'recovered_journals': 0}
+
+    # Recording
+
+    def record_write(self, register: int, value: int, result: int, group: int = 0):
+        """Journal a register write; returns once the record is on disk"""
+        self._append(KIND_WRITE, group, register, value, result, 0)
+
+    def record_delivery(self, group: int, delivery_id: int, success: bool):
+        """Journal the delivery row created for the last delivery command of a group"""
+        self._append(KIND_DELIVERY, group, 0, 0, RESULT_OK if success else RESULT_FAILED, delivery_id)
+
+    def _append(self, kind: int, group: int, register: int, value: int, result: int, delivery_id: int):
+        if not self.enabled:
+            return
+        record = RECORD.pack(time.time(), kind, group, register, value, result, delivery_id)
+        try:
+            with self._cond:
+                if self._fd is None:
+                    self._open()
+                self._pending += record + CRC.pack(zlib.crc32(record))
+                self._appended += 1
+                self._commit(self._appended)
+        except OSError as e:
+            logger.error(f"Failed to journal command: {e}")
+
+    def _commit(self, sequence: int):
+        """Wait until record ``sequence`` is durable, writing it (and all queued after it) if nobody is"""
+        while self._durable < sequence:
+            if self._committing:
+                self._cond.wait()
+                continue
+            self._committing = True
+            batch, self._pending = self._pending, bytearray()
+            upto = self._appended
+            fd = self._fd
+            self._cond.release()
+            try:
+                os.write(fd, batch)
+                if self.fsync:
+                    os.fsync(fd)
+            finally:
+                self._cond.acquire()
+                self._committing = False
+                self._cond.notify_all()
+            self._durable = upto
+            self._stats['records'] += len(batch) // RECORD_SIZE
+            self._stats['commits'] += 1
+            if os.fstat(fd).st_size >= self.max_bytes:
+                self._rotate()
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._name = f'{JOURNAL_PREFIX}{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        # Held for the life of the process: a lock that can be taken means its owner is gone
+        self._lock_file = open(os.path.join(self.directory, f'{self._name}.lock'), 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._fd = os.open(self._segment_path(self._name, 0), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def _segment_path(self, name: str, segment: int) -> str:
+        return os.path.join(self.directory, f'{name}.{segment}{JOURNAL_SUFFIX}')
+
+    def _rotate(self):
+        """Start a new segment and drop the one before the previous (older commands are of no use)"""
+        os.close(self._fd)
+        self._segment += 1
+        self._fd = os.open(self._segment_path(self._name, self._segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        if self._segment >= 2:
+            try:
+                os.remove(self._segment_path(self._name, self._segment - 2))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """Close this process's journal; it is replayed (harmlessly) by the next start"""
+        with self._cond:
+            self._commit(self._appended)
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+
+    # Reading and recovery
+
+    @staticmethod
+    def read(path: str) -> List[JournalRecord]:
+        """Records of a journal segment, up to a torn or corrupt one"""
+        records = []
+        with open(path, 'rb') as journal:
+            data = journal.read()
+        for offset in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+            record = data[offset:offset + RECORD.size]
+            (crc,) = CRC.unpack_from(data, offset + RECORD.size)
+            if zlib.crc32(record) != crc:
+                break
+            records.append(JournalRecord(*RECORD.unpack(record)))
+        return records
+
+    def dead_journals(self) -> Dict[str, List[str]]:
+        """Segment paths (oldest first) of every journal whose process is gone, by lock path"""
+        try:
+            names = sorted(os.listdir(self.directory))
+        except FileNotFoundError:
+            return {}
+        own = f'{self._name}.lock' if self._name else None
+        journals = {}
+        for lock_name in names:
+            if not (lock_name.startswith(JOURNAL_PREFIX) and lock_name.endswith('.lock')) or lock_name == own:
+                continue
+            lock_path = os.path.join(self.directory, lock_name)
+            try:
+                with open(lock_path) as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except FileNotFoundError:
+                continue  # Recovered by another process meanwhile
+            except OSError:
+                continue  # Owner still running
+            name = lock_name[:-len('.lock')]
+            segments = [n for n in names if n.startswith(f'{name}.') and n.endswith(JOURNAL_SUFFIX)]
+            segments.sort(key=lambda n: int(n[len(name) + 1:-len(JOURNAL_SUFFIX)]))
+            journals[lock_path] = [os.path.join(self.directory, n) for n in segments]
+        return journals
+
+    def observe(self, snapshot):
+        """Poller listener: replay dead journals against the first snapshot of the tracking process"""
+        from .tracker import get_delivery_tracker
+
+        # Replayed deliveries are handed to the tracker, so only its process replays
+        if self._recovered or not self.enabled or not get_delivery_tracker().acquire():
+            return
+        self._recovered = True
+        journals = self.dead_journals()
+        if not journals:
+            return
+        try:
+            records = sorted((record for paths in journals.values() for path in paths for record in self.read(path)),
+                             key=lambda record: record.time)
+            self.recover(records, snapshot)
+        except Exception as e:
+            logger.error(f"Failed to recover from the command journal: {e}")
+            return
+        for lock_path, paths in journals.items():
+            for path in paths + [lock_path]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        self._stats['recovered_journals'] += len(journals)
+
+    def recover(self, records: List[JournalRecord], snapshot) -> Dict:
+        """Bring the delivery rows in line with the journaled commands and the live snapshot"""
+        from .coffee_machine import LaSpazialeCoffeeMachine
+        from .tracker import DeliveryTracker, get_delivery_tracker
+
+        commands = LaSpazialeCoffeeMachine.COMMANDS
+        delivery_commands = {value: name.lower() for name, value in commands.items()
+                             if name.startswith(('SINGLE_', 'DOUBLE_'))}
+        unlinked: Dict[int, JournalRecord] = {}  # group -> delivery command without a row yet
+        launched: Dict[int, tuple] = {}          # delivery id -> (group, sent at)
+        latest: Dict[int, int] = {}              # group -> last delivery id
+        stops: Dict[int, List[float]] = {}
+        for record in records:
+            if record.kind == KIND_WRITE and record.group:
+                if record.value in delivery_commands and record.result != RESULT_FAILED:
+                    unlinked[record.group] = record
+                elif record.value == commands['STOP_DELIVERY'] and record.result != RESULT_FAILED:
+                    stops.setdefault(record.group, []).append(record.time)
+            elif record.kind == KIND_DELIVERY:
+                sent = unlinked.pop(record.group, None)
+                if record.result == RESULT_OK:
+                    launched[record.delivery_id] = (record.group, sent.time if sent else record.time)
+                    latest[record.group] = record.delivery_id
+
+        def stopped_after(group, sent_at):
+            return next((at for at in stops.get(group, []) if at >= sent_at), None)
+
+        tracker = get_delivery_tracker()
+        max_age = tracker.max_duration
+        now = snapshot.taken_at.timestamp()
+        result = {'resumed': 0, 'stopped': 0, 'recorded': 0}
+        # Pending: created before the command by the legacy view, whose status update was lost
+        open_statuses = ['pending', 'in_progress']
+        rows = CoffeeDelivery.objects.filter(id__in=list(launched), status__in=open_statuses).in_bulk()
+        for delivery_id, row in rows.items():
+            group, sent_at = launched[delivery_id]
+            stopped_at = stopped_after(group, sent_at)
+            if stopped_at is not None:
+                CoffeeDelivery.objects.filter(id=delivery_id, status__in=open_statuses).update(
+                    status='stopped', completed_at=datetime.fromtimestamp(stopped_at))
+                result['stopped'] += 1
+            elif (latest.get(group) == delivery_id and snapshot.is_group_busy(group)
+                  and now - sent_at < max_age):
+                if row.status == 'pending':
+                    CoffeeDelivery.objects.filter(id=delivery_id).update(status='in_progress')
+                tracker.resume(group, datetime.fromtimestamp(sent_at), row.coffee_type)
+                result['resumed'] += 1
+            # Anything else finished while nobody watched: the tracker's startup pass closes it
+
+        for group, sent in unlinked.items():
+            coffee_type = delivery_commands[sent.value]
+            running = DeliveryTracker.coffee_type_for(snapshot.selection(group)) == coffee_type
+            if stopped_after(group, sent.time) is None and running and now - sent.time < max_age:
+                started_at = datetime.fromtimestamp(sent.time)
+                CoffeeDelivery.objects.create(coffee_type=coffee_type, group_number=group, status='in_progress',
+                                              source='api', started_at=started_at)
+                tracker.resume(group, started_at, coffee_type)
+                result['recorded'] += 1
+            else:
+                logger.warning(f"Delivery command {coffee_type} sent to group {group} at "
+                               f"{datetime.fromtimestamp(sent.time):%H:%M:%S} was never recorded")
+
+        logger.info(f"Recovered from the command journal ({len(records)} records): {result['resumed']} deliveries "
+                    f"resumed, {result['stopped']} closed as stopped, {result['recorded']} recorded")
+        return result
+
+    def metrics(self) -> Dict:
+        return dict(self._stats, enabled=self.enabled, journal=self._name)
+
+
+# Singleton instance for Django integration
+_journal_instance = None
+_journal_lock = threading.Lock()
+
+def get_command_journal() -> CommandJournal:
+    """Get singleton command journal instance"""
+    global _journal_instance
+
+    if _journal_instance is None:
+        with _journal_lock:
+            if _journal_instance is None:
+                _journal_instance = CommandJournal()
+
+    return _journal_instance
@@ -0,0 +1,226 @@
+"""Online backup, retention and compaction of the SQLite database while the add-on runs"""
+import os
+import time
+import sqlite3
+import logging
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Dict, List, Optional
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from .aggregates import retention_cutoff
+from .models import CoffeeDelivery, CoffeeOrder, HourlyDeliveryStats, MaintenanceLog
+
+logger = logging.getLogger('machine')
+
+BACKUP_PREFIX = 'db-'
+BACKUP_SUFFIX = '.sqlite3'
+
+# name -> (model, time field, retention setting, default days, rows that may go)
+RETENTION = {
+    'orders': (CoffeeOrder, 'created_at', 'ORDER_RETENTION_DAYS', 90,
+               Q(status__in=('dispatched', 'failed', 'cancelled'))),
+    # Only whole days of deliveries already counted in the stats (see retention_cutoff)
+    'deliveries': (CoffeeDelivery, 'started_at', 'DELIVERY_RETENTION_DAYS', 365, Q(aggregated=True)),
+    # Health checks are folded into daily summaries by compact_health_logs instead
+    'logs': (MaintenanceLog, 'timestamp', 'MAINTENANCE_LOG_RETENTION_DAYS', 180, ~Q(log_type='health_check')),
+    'hourly_stats': (HourlyDeliveryStats, 'hour', 'HOURLY_STATS_RETENTION_DAYS', 90, Q()),
+}
+
+
+class LockTimer:
+    """Total and longest time spent holding a database lock, over several short holds"""
+
+    def __init__(self):
+        self.total = 0.0
+        self.longest = 0.0
+        self.holds = 0
+
+    @contextmanager
+    def hold(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(time.perf_counter() - started)
+
+    def add(self, seconds: float):
+        self.total += seconds
+        self.longest = max(self.longest, seconds)
+        self.holds += 1
+
+    def report(self) -> Dict:
+        return {'lock_seconds': round(self.total, 4), 'longest_lock_seconds': round(self.longest, 4),
+                'holds': self.holds}
+
+
+def _pause() -> float:
+    """Seconds slept between two steps, so that writers waiting for the lock get it"""
+    return getattr(settings, 'DB_MAINTENANCE_PAUSE', 0.05)
+
+
+def backup_database(directory: Optional[str] = None, step_pages: Optional[int] = None,
+                    keep: Optional[int] = None) -> Dict:
+    """Copy the database to ``directory`` with the online backup API; returns a report.
+
+    The copy is taken inside one read transaction: in WAL mode that is a
+    consistent snapshot that never blocks writers, and the backup does not
+    restart when they commit meanwhile. Pages are copied ``step_pages`` at
+    a time with a pause in between. The file appears under its final name
+    only once complete; the ``keep`` newest backups are kept.
+    """
+    directory = str(directory or getattr(settings, 'DB_BACKUP_DIR', 'backups'))
+    step_pages = step_pages or getattr(settings, 'DB_BACKUP_STEP_PAGES', 256)
+    keep = keep or getattr(settings, 'DB_BACKUP_KEEP', 7)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{BACKUP_PREFIX}{timezone.now():%Y%m%d-%H%M%S}{BACKUP_SUFFIX}')
+    partial = f'{path}.part'
+
+    timer = LockTimer()
+    pause = _pause()
+    started = time.perf_counter()
+    resumed = started
+
+    def progress(status, remaining, total):
+        nonlocal resumed
+        timer.add(time.perf_counter() - resumed)
+        if remaining:
+            time.sleep(pause)
+        resumed = time.perf_counter()
+
+    connection.ensure_connection()
+    target = sqlite3.connect(partial)
+    try:
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT count(*) FROM sqlite_master')  # Starts the read snapshot
+                cursor.fetchone()
+            resumed = time.perf_counter()
+            connection.connection.backup(target, pages=step_pages, progress=progress)
+        pages = target.execute('PRAGMA page_count').fetchone()[0]
+    except Exception:
+        target.close()
+        os.remove(partial)
+        raise
+    target.close()
+    os.replace(partial, path)
+
+    backups = sorted(name for name in os.listdir(directory)
+                     if name.startswith(BACKUP_PREFIX) and name.endswith(BACKUP_SUFFIX))
+    for name in backups[:-keep]:
+        os.remove(os.path.join(directory, name))
+
+    # The backup only reads: writers are never blocked, the step time is what it holds the snapshot for
+    report = dict(timer.report(), path=path, pages=pages, bytes=os.path.getsize(path),
+                  seconds=round(time.perf_counter() - started, 3), deleted_backups=max(len(backups) - keep, 0))
+    logger.info(f"Backed up the database to {path} ({report['bytes']} bytes in {report['holds']} steps)")
+    return report
+
+
+def purge_old_rows(batch_size: Optional[int] = None, names: Optional[List[str]] = None) -> Dict:
+    """Delete rows older than their retention, ``batch_size`` rows per transaction; returns a report.
+
+    A retention of 0 (or None) keeps the rows forever. Each batch is a
+    short write transaction followed by a pause, so requests and the
+    poller get the write lock in between.
+    """
+    batch_size = batch_size or getattr(settings, 'DB_MAINTENANCE_BATCH_SIZE', 500)
+    pause = _pause()
+    report = {}
+    for name in names or RETENTION:
+        model, time_field, setting, default_days, allowed = RETENTION[name]
+        days = getattr(settings, setting, default_days)
+        if not days:
+            continue
+        cutoff = timezone.now() - timedelta(days=days)
+        if model is CoffeeDelivery:
+            cutoff = retention_cutoff(cutoff)
+        old_rows = model.objects.filter(allowed, **{f'{time_field}__lt': cutoff})
+        timer = LockTimer()
+        deleted = 0
+        while True:
+            ids = list(old_rows.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            with timer.hold(), transaction.atomic():
+                model.objects.filter(pk__in=ids).delete()
+            deleted += len(ids)
+            if len(ids) < batch_size:
+                break
+            time.sleep(pause)
+        report[name] = dict(timer.report(), deleted=deleted, retention_days=days)
+        if deleted:
+            logger.info(f"Deleted {deleted} {name} rows older than {days} days")
+    return report
+
+
+def compact_database(vacuum_pages: Optional[int] = None, convert: bool = False,
+                     analysis_limit: Optional[int] = None) -> Dict:
+    """Return free pages to the file system with incremental VACUUM, then ANALYZE; returns a report.
+
+    Incremental VACUUM needs ``auto_vacuum=incremental``, which new databases
+    get from ``SQLITE_PRAGMAS``. An older database is converted only with
+    ``convert``: that takes a full VACUUM, which holds the write lock while
+    it rewrites the whole file. ANALYZE samples at most ``analysis_limit``
+    rows per index.
+    """
+    vacuum_pages = vacuum_pages or getattr(settings, 'DB_VACUUM_STEP_PAGES', 200)
+    analysis_limit = analysis_limit or getattr(settings, 'DB_ANALYSIS_LIMIT', 400)
+    pause = _pause()
+    connection.ensure_connection()
+    raw = connection.connection
+
+    def pragma(name):
+        return raw.execute(f'PRAGMA {name}').fetchone()[0]
+
+    vacuum = LockTimer()
+    mode = pragma('auto_vacuum')
+    if mode != 2 and convert:
+        with vacuum.hold():
+            raw.executescript('PRAGMA auto_vacuum = incremental; VACUUM')
+        logger.info("Converted the database to incremental auto-vacuum")
+        mode = pragma('auto_vacuum')
+
+    freed = 0
+    if mode == 2:
+        while True:
+            free = pragma('freelist_count')
+            if not free:
+                break
+            # executescript steps the pragma to the end; a single step frees one page only
+            with vacuum.hold():
+                raw.executescript(f'PRAGMA incremental_vacuum({vacuum_pages})')
+            released = free - pragma('freelist_count')
+            if released <= 0:
+                break  # Writers are reusing the free pages as fast as they are released
+            freed += released
+            time.sleep(pause)
+    else:
+        logger.warning("Incremental VACUUM skipped: the database has no auto_vacuum=incremental "
+                       "(run maintain_db --convert once to enable it)")
+
+    analyze = LockTimer()
+    with analyze.hold():
+        raw.executescript(f'PRAGMA analysis_limit = {analysis_limit}; ANALYZE')
+
+    return {
+        'vacuum': dict(vacuum.report(), incremental=mode == 2, freed_pages=freed,
+                       free_pages=pragma('freelist_count'), pages=pragma('page_count')),
+        'analyze': analyze.report(),
+    }
+
+
+def maintain_database(backup: bool = True, purge: bool = True, compact: bool = True, **options) -> Dict:
+    """Backup, then retention, then compaction; returns the report of each part that ran"""
+    if connection.vendor != 'sqlite':
+        raise RuntimeError('Database maintenance supports SQLite only')
+    report = {}
+    if backup:
+        report['backup'] = backup_database(options.get('directory'), options.get('step_pages'), options.get('keep'))
+    if purge:
+        report['retention'] = purge_old_rows(options.get('batch_size'))
+    if compact:
+        report.update(compact_database(options.get('vacuum_pages'), options.get('convert', False)))
+    return report
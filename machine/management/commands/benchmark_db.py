@@ -0,0 +1,102 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from machine.db import apply_pragmas, sqlite_pragmas
+from machine.models import CoffeeDelivery
+
+class Command(BaseCommand):
+    help = 'Compare SQLite insert throughput with default and tuned connection settings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=500, help='Deliveries inserted per writer')
+        parser.add_argument('--writers', type=int, default=3,
+                          help='Concurrent writers (each with its own connection, like workers and Celery)')
+        parser.add_argument('--timeout', type=float, default=20, help='Busy timeout in seconds')
+        parser.add_argument('--dir', type=str, default=None,
+                          help='Directory for the scratch databases (use the data volume to measure its disk)')
+
+    def handle(self, *args, **options):
+        # Scratch databases get the real table and indexes, created from the model
+        with connection.schema_editor(collect_sql=True) as editor:
+            editor.create_model(CoffeeDelivery)
+        schema = editor.collected_sql
+
+        self.stdout.write(
+            f"{options['writers']} writers x {options['rows']} single-row transactions "
+            f"(as objects.create() in a request)"
+        )
+        results = {}
+        with tempfile.TemporaryDirectory(dir=options['dir']) as directory:
+            for label, pragmas in (('default', {}), ('tuned', sqlite_pragmas())):
+                path = os.path.join(directory, f'{label}.sqlite3')
+                results[label] = self.run(path, schema, pragmas, options)
+                self.report(label, results[label])
+
+        if results['default']['rate']:
+            speedup = results['tuned']['rate'] / results['default']['rate']
+            self.stdout.write(self.style.SUCCESS(f"Tuned settings: {speedup:.1f}x insert throughput"))
+
+    def run(self, path, schema, pragmas, options):
+        setup = sqlite3.connect(path)
+        for statement in schema:
+            setup.execute(statement)
+        apply_pragmas(setup, pragmas)  # journal_mode is stored in the file; the rest is per connection
+        setup.commit()
+        setup.close()
+
+        latencies, errors = [], []
+        lock = threading.Lock()
+        start = threading.Barrier(options['writers'] + 1)
+
+        def writer(group):
+            db = sqlite3.connect(path, timeout=options['timeout'], isolation_level=None)
+            apply_pragmas(db, pragmas)
+            start.wait()
+            for _ in range(options['rows']):
+                began = time.perf_counter()
+                try:
+                    db.execute(
+                        f'INSERT INTO {CoffeeDelivery._meta.db_table} '
+                        '(coffee_type, group_number, status, source, started_at, error_message, aggregated) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        ('single_short', group, 'in_progress', 'api', timezone.now().isoformat(' '), '', False),
+                    )
+                except sqlite3.OperationalError as e:
+                    with lock:
+                        errors.append(str(e))
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - began)
+            db.close()
+
+        threads = [threading.Thread(target=writer, args=(group,)) for group in range(1, options['writers'] + 1)]
+        for thread in threads:
+            thread.start()
+        start.wait()
+        began = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - began
+
+        latencies.sort()
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else 0
+        return {
+            'rate': len(latencies) / elapsed if elapsed else 0,
+            'p50': percentile(0.5),
+            'p99': percentile(0.99),
+            'errors': len(errors),
+        }
+
+    def report(self, label, result):
+        line = (f"{label:>8}: {result['rate']:8.0f} inserts/s, "
+                f"p50 {result['p50']:.2f} ms, p99 {result['p99']:.2f} ms")
+        if result['errors']:
+            self.stdout.write(self.style.WARNING(f"{line}, {result['errors']} failed (database is locked)"))
+        else:
+            self.stdout.write(line)
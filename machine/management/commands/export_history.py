@@ -0,0 +1,38 @@
+import sys
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from machine.export import CONTENT_TYPES, DEFAULT_CHUNK_SIZE, EXPORTS, export_chunks
+
+class Command(BaseCommand):
+    help = 'Export the delivery or maintenance history as CSV or Parquet, streamed in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=list(EXPORTS), help='History to export')
+        parser.add_argument('--format', choices=list(CONTENT_TYPES), default='csv')
+        parser.add_argument('--output', type=str, default='-', help='File to write (default: standard output)')
+        parser.add_argument('--start', type=datetime.fromisoformat, help='First date/datetime included (ISO)')
+        parser.add_argument('--end', type=datetime.fromisoformat, help='Date/datetime the export stops before (ISO)')
+        parser.add_argument('--group', type=int, help='Only this group')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Rows read per query')
+
+    def handle(self, *args, **options):
+        try:
+            chunks = export_chunks(
+                options['kind'], options['format'], options['start'], options['end'],
+                options['group'], options['chunk_size'],
+            )
+        except (ValueError, RuntimeError) as e:
+            raise CommandError(str(e))
+
+        if options['output'] == '-':
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            return
+
+        written = 0
+        with open(options['output'], 'wb') as output:
+            for chunk in chunks:
+                output.write(chunk)
+                written += len(chunk)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} bytes to {options['output']}"))
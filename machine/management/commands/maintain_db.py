@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+from machine.maintenance import maintain_database
+
+class Command(BaseCommand):
+    help = 'Back up the database online, delete rows past their retention, then VACUUM and ANALYZE'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-backup', action='store_true', help='Skip the backup')
+        parser.add_argument('--no-purge', action='store_true', help='Keep old rows')
+        parser.add_argument('--no-compact', action='store_true', help='Skip VACUUM and ANALYZE')
+        parser.add_argument('--backup-dir', type=str, help='Directory of the backups (default: DB_BACKUP_DIR)')
+        parser.add_argument('--keep', type=int, help='Newest backups kept (default: DB_BACKUP_KEEP)')
+        parser.add_argument('--step-pages', type=int, help='Pages copied per backup step')
+        parser.add_argument('--batch-size', type=int, help='Rows deleted per transaction')
+        parser.add_argument('--vacuum-pages', type=int, help='Free pages released per VACUUM step')
+        parser.add_argument('--convert', action='store_true',
+                          help='Enable incremental auto-vacuum with one full VACUUM (locks the database meanwhile)')
+
+    def handle(self, *args, **options):
+        try:
+            report = maintain_database(
+                backup=not options['no_backup'], purge=not options['no_purge'], compact=not options['no_compact'],
+                directory=options['backup_dir'], keep=options['keep'], step_pages=options['step_pages'],
+                batch_size=options['batch_size'], vacuum_pages=options['vacuum_pages'], convert=options['convert'],
+            )
+        except (RuntimeError, OSError) as e:
+            raise CommandError(str(e))
+
+        if 'backup' in report:
+            backup = report['backup']
+            self.stdout.write(
+                f"Backup: {backup['path']} ({backup['bytes']} bytes) in {backup['seconds']}s, "
+                f"{backup['holds']} steps reading for {backup['lock_seconds']}s "
+                f"(longest {backup['longest_lock_seconds']}s, writers not blocked)"
+            )
+        for name, part in report.get('retention', {}).items():
+            self.stdout.write(
+                f"Retention {name}: {part['deleted']} rows older than {part['retention_days']} days, "
+                f"write lock held {part['lock_seconds']}s (longest {part['longest_lock_seconds']}s)"
+            )
+        if 'vacuum' in report:
+            vacuum, analyze = report['vacuum'], report['analyze']
+            if vacuum['incremental']:
+                self.stdout.write(
+                    f"VACUUM: {vacuum['freed_pages']} pages freed, {vacuum['pages']} left, write lock held "
+                    f"{vacuum['lock_seconds']}s (longest {vacuum['longest_lock_seconds']}s)"
+                )
+            else:
+                self.stdout.write(self.style.WARNING(
+                    'VACUUM: skipped, incremental auto-vacuum is off (run once with --convert)'))
+            self.stdout.write(f"ANALYZE: write lock held {analyze['lock_seconds']}s")
+        self.stdout.write(self.style.SUCCESS('Database maintenance done'))
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-18 21:55
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coffeedelivery',
+            name='duration',
+            field=models.FloatField(blank=True, help_text='Measured group busy time in seconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='coffeedelivery',
+            name='source',
+            field=models.CharField(choices=[('api', 'API'), ('panel', 'Machine Panel')], default='api', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='coffeedelivery',
+            name='coffee_type',
+            field=models.CharField(choices=[('single_short', 'Single Short'), ('single_medium', 'Single Medium'), ('single_long', 'Single Long'), ('double_short', 'Double Short'), ('double_medium', 'Double Medium'), ('double_long', 'Double Long'), ('continuous_flow', 'Continuous Flow')], max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='coffeedelivery',
+            name='started_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.7 on 2026-10-18 22:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0002_delivery_source_duration'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoffeeOrder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('coffee_type', models.CharField(choices=[('single_short', 'Single Short'), ('single_medium', 'Single Medium'), ('single_long', 'Single Long'), ('double_short', 'Double Short'), ('double_medium', 'Double Medium'), ('double_long', 'Double Long'), ('continuous_flow', 'Continuous Flow')], max_length=20)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('dispatched', 'Dispatched'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='queued', max_length=20)),
+                ('group_number', models.IntegerField(blank=True, null=True)),
+                ('client_order_id', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('dispatched_at', models.DateTimeField(blank=True, null=True)),
+                ('error_message', models.TextField(blank=True)),
+                ('delivery', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='orders', to='machine.coffeedelivery')),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+    ]
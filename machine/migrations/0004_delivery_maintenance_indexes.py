@@ -0,0 +1,37 @@
+# Generated by Django 4.2.7 on 2026-10-18 22:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0003_coffeeorder'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='coffeedelivery',
+            index=models.Index(fields=['group_number', 'status', 'started_at'], name='delivery_group_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='coffeedelivery',
+            index=models.Index(fields=['-started_at', '-id'], name='delivery_started_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='coffeedelivery',
+            index=models.Index(fields=['status', 'completed_at'], name='delivery_status_done_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='maintenancelog',
+            index=models.Index(fields=['-timestamp', '-id'], name='maintlog_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='maintenancelog',
+            index=models.Index(fields=['log_type', 'timestamp'], name='maintlog_type_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='maintenancelog',
+            index=models.Index(condition=models.Q(('resolved', False)), fields=['-timestamp'], name='maintlog_unresolved_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.7 on 2026-10-18 22:25
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0004_delivery_maintenance_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='maintenancelog',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-18 22:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0005_maintenancelog_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HealthCheckSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('checks', models.IntegerField(default=0)),
+                ('healthy', models.IntegerField(default=0)),
+                ('unhealthy', models.IntegerField(default=0)),
+                ('transitions', models.IntegerField(default=0, help_text='Status changes logged (and later compacted) that day')),
+                ('last_checked_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'health check summaries',
+                'ordering': ['-date'],
+            },
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 4.2.7 on 2026-10-18 22:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0006_healthchecksummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyDeliveryStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group_number', models.IntegerField()),
+                ('coffee_type', models.CharField(choices=[('single_short', 'Single Short'), ('single_medium', 'Single Medium'), ('single_long', 'Single Long'), ('double_short', 'Double Short'), ('double_medium', 'Double Medium'), ('double_long', 'Double Long'), ('continuous_flow', 'Continuous Flow')], max_length=20)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('in_progress', 'In Progress'), ('completed', 'Completed'), ('failed', 'Failed'), ('stopped', 'Stopped')], max_length=20)),
+                ('count', models.IntegerField(default=0)),
+                ('timed', models.IntegerField(default=0, help_text='Deliveries with a measured duration')),
+                ('total_duration', models.FloatField(default=0, help_text='Sum of the measured durations in seconds')),
+                ('date', models.DateField()),
+            ],
+            options={
+                'verbose_name_plural': 'daily delivery stats',
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='HourlyDeliveryStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group_number', models.IntegerField()),
+                ('coffee_type', models.CharField(choices=[('single_short', 'Single Short'), ('single_medium', 'Single Medium'), ('single_long', 'Single Long'), ('double_short', 'Double Short'), ('double_medium', 'Double Medium'), ('double_long', 'Double Long'), ('continuous_flow', 'Continuous Flow')], max_length=20)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('in_progress', 'In Progress'), ('completed', 'Completed'), ('failed', 'Failed'), ('stopped', 'Stopped')], max_length=20)),
+                ('count', models.IntegerField(default=0)),
+                ('timed', models.IntegerField(default=0, help_text='Deliveries with a measured duration')),
+                ('total_duration', models.FloatField(default=0, help_text='Sum of the measured durations in seconds')),
+                ('hour', models.DateTimeField(help_text='Start of the hour the deliveries started in')),
+            ],
+            options={
+                'verbose_name_plural': 'hourly delivery stats',
+                'ordering': ['-hour'],
+            },
+        ),
+        migrations.AddField(
+            model_name='coffeedelivery',
+            name='aggregated',
+            field=models.BooleanField(default=False, editable=False, help_text='Counted in the hourly and daily delivery stats'),
+        ),
+        migrations.AddIndex(
+            model_name='coffeedelivery',
+            index=models.Index(condition=models.Q(('aggregated', False)), fields=['id'], name='delivery_unaggregated_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='hourlydeliverystats',
+            constraint=models.UniqueConstraint(fields=('hour', 'group_number', 'coffee_type', 'status'), name='hourly_stats_key'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailydeliverystats',
+            constraint=models.UniqueConstraint(fields=('date', 'group_number', 'coffee_type', 'status'), name='daily_stats_key'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.7 on 2026-10-18 22:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0007_delivery_stats'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='coffeeorder',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('dispatching', 'Dispatching'), ('dispatched', 'Dispatched'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='queued', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='coffeeorder',
+            index=models.Index(fields=['status', 'created_at', 'id'], name='order_status_created_idx'),
+        ),
+    ]
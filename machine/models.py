@@ -1,4 +1,5 @@
 from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import timezone
 
 class CoffeeMachine(models.Model):
@@ -25,6 +26,7 @@ class CoffeeDelivery(models.Model):
         ('double_short', 'Double Short'),
         ('double_medium', 'Double Medium'),
         ('double_long', 'Double Long'),
+        ('continuous_flow', 'Continuous Flow'),
     ]
     
     STATUS_CHOICES = [
@@ -35,15 +37,34 @@ class CoffeeDelivery(models.Model):
         ('stopped', 'Stopped'),
     ]
     
+    SOURCE_CHOICES = [
+        ('api', 'API'),
+        ('panel', 'Machine Panel'),
+    ]
+    
     coffee_type = models.CharField(max_length=20, choices=COFFEE_TYPES)
     group_number = models.IntegerField()
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
-    started_at = models.DateTimeField(auto_now_add=True)
+    source = models.CharField(max_length=10, choices=SOURCE_CHOICES, default='api')
+    started_at = models.DateTimeField(default=timezone.now, editable=False)
     completed_at = models.DateTimeField(blank=True, null=True)
+    duration = models.FloatField(blank=True, null=True, help_text='Measured group busy time in seconds')
     error_message = models.TextField(blank=True)
+    aggregated = models.BooleanField(default=False, editable=False,
+                                     help_text='Counted in the hourly and daily delivery stats')
     
     class Meta:
         ordering = ['-started_at']
+        indexes = [
+            # Stop and the tracker: in-progress rows of a group, by start time
+            models.Index(fields=['group_number', 'status', 'started_at'], name='delivery_group_status_idx'),
+            # History, newest first (keyset pagination on started_at, id)
+            models.Index(fields=['-started_at', '-id'], name='delivery_started_idx'),
+            # Duration model warmup: most recently completed deliveries
+            models.Index(fields=['status', 'completed_at'], name='delivery_status_done_idx'),
+            # Finished rows not yet counted in the delivery stats
+            models.Index(fields=['id'], condition=models.Q(aggregated=False), name='delivery_unaggregated_idx'),
+        ]
     
     def __str__(self):
         return f"{self.get_coffee_type_display()} - Group {self.group_number} ({self.status})"
@@ -62,12 +83,124 @@ class MaintenanceLog(models.Model):
     log_type = models.CharField(max_length=20, choices=LOG_TYPES)
     group_number = models.IntegerField(blank=True, null=True)
     message = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     resolved = models.BooleanField(default=False)
     
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['-timestamp', '-id'], name='maintlog_timestamp_idx'),
+            # Log type filter (API and admin), still newest first
+            models.Index(fields=['log_type', 'timestamp'], name='maintlog_type_time_idx'),
+            # Open issues only: Django filters booleans as ``NOT resolved``, which
+            # a (resolved, ...) index cannot serve but this partial index can
+            models.Index(fields=['-timestamp'], condition=models.Q(resolved=False), name='maintlog_unresolved_idx'),
+        ]
     
     def __str__(self):
         group_info = f" - Group {self.group_number}" if self.group_number else ""
-        return f"{self.get_log_type_display()}{group_info} ({self.timestamp.strftime('%Y-%m-%d %H:%M')})"
\ No newline at end of file
+        return f"{self.get_log_type_display()}{group_info} ({self.timestamp.strftime('%Y-%m-%d %H:%M')})"
+
+class CoffeeOrder(models.Model):
+    """Drink ordered without a fixed group; the dispatcher picks the group"""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('dispatching', 'Dispatching'),
+        ('dispatched', 'Dispatched'),
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
+    ]
+    
+    coffee_type = models.CharField(max_length=20, choices=CoffeeDelivery.COFFEE_TYPES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    group_number = models.IntegerField(blank=True, null=True)
+    delivery = models.ForeignKey(CoffeeDelivery, blank=True, null=True, on_delete=models.SET_NULL,
+                                 related_name='orders')
+    client_order_id = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+    dispatched_at = models.DateTimeField(blank=True, null=True)
+    error_message = models.TextField(blank=True)
+    
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            # The queue shared by the server processes: queued orders, oldest first
+            models.Index(fields=['status', 'created_at', 'id'], name='order_status_created_idx'),
+        ]
+    
+    def __str__(self):
+        group_info = f" - Group {self.group_number}" if self.group_number else ""
+        return f"Order {self.id}: {self.get_coffee_type_display()}{group_info} ({self.status})"
+
+class HealthCheckSummary(models.Model):
+    """Health check results of one day, counted instead of logged one row per check"""
+    date = models.DateField(unique=True)
+    checks = models.IntegerField(default=0)
+    healthy = models.IntegerField(default=0)
+    unhealthy = models.IntegerField(default=0)
+    transitions = models.IntegerField(default=0, help_text='Status changes logged (and later compacted) that day')
+    last_checked_at = models.DateTimeField(blank=True, null=True)
+    
+    class Meta:
+        ordering = ['-date']
+        verbose_name_plural = 'health check summaries'
+    
+    def __str__(self):
+        return f"Health {self.date}: {self.healthy}/{self.checks} healthy"
+
+class DeliveryStats(models.Model):
+    """Deliveries of one group, coffee type and final status, counted per period"""
+    group_number = models.IntegerField()
+    coffee_type = models.CharField(max_length=20, choices=CoffeeDelivery.COFFEE_TYPES)
+    status = models.CharField(max_length=20, choices=CoffeeDelivery.STATUS_CHOICES)
+    count = models.IntegerField(default=0)
+    timed = models.IntegerField(default=0, help_text='Deliveries with a measured duration')
+    total_duration = models.FloatField(default=0, help_text='Sum of the measured durations in seconds')
+    
+    class Meta:
+        abstract = True
+    
+    @property
+    def average_duration(self):
+        return self.total_duration / self.timed if self.timed else None
+
+class HourlyDeliveryStats(DeliveryStats):
+    hour = models.DateTimeField(help_text='Start of the hour the deliveries started in')
+    
+    class Meta:
+        ordering = ['-hour']
+        verbose_name_plural = 'hourly delivery stats'
+        constraints = [
+            models.UniqueConstraint(fields=['hour', 'group_number', 'coffee_type', 'status'],
+                                    name='hourly_stats_key'),
+        ]
+    
+    def __str__(self):
+        return f"{self.hour:%Y-%m-%d %H:00} - Group {self.group_number} {self.coffee_type} {self.status}: {self.count}"
+
+class DailyDeliveryStats(DeliveryStats):
+    date = models.DateField()
+    
+    class Meta:
+        ordering = ['-date']
+        verbose_name_plural = 'daily delivery stats'
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'group_number', 'coffee_type', 'status'],
+                                    name='daily_stats_key'),
+        ]
+    
+    def __str__(self):
+        return f"{self.date} - Group {self.group_number} {self.coffee_type} {self.status}: {self.count}"
+
+
+class IdempotencyKey(models.Model):
+    """Result of a command run with a client key, replayed to retries of the same key"""
+    key = models.CharField(max_length=255, unique=True)
+    fingerprint = models.TextField(help_text='The command the key was first used for')
+    result = models.JSONField(blank=True, null=True, encoder=DjangoJSONEncoder,
+                              help_text='Empty while the command is running')
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.key} ({'done' if self.result is not None else 'running'})"
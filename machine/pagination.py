@@ -0,0 +1,84 @@
+"""Keyset (cursor) pagination for the history and log endpoints and exports"""
+import base64
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+from django.db.models import Q
+
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(position: datetime, pk: int) -> str:
+    """Opaque cursor for the row at (position, pk)"""
+    return base64.urlsafe_b64encode(f'{position.isoformat()}|{pk}'.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Inverse of ``encode_cursor``; raises ValueError on a malformed cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        position, pk = raw.split('|')
+        return datetime.fromisoformat(position), int(pk)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f'Invalid cursor: {cursor}') from e
+
+
+def page_params(request, default_limit: int) -> Tuple[int, Optional[str], Optional[int]]:
+    """``limit``, ``cursor`` and ``since_id`` query parameters; raises ValueError"""
+    try:
+        limit = int(request.GET.get('limit', default_limit))
+        since_id = request.GET.get('since_id')
+        since_id = int(since_id) if since_id not in (None, '') else None
+    except ValueError:
+        raise ValueError('limit and since_id must be integers')
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, MAX_PAGE_SIZE), request.GET.get('cursor') or None, since_id
+
+
+def keyset_page(queryset, time_field: str, fields: List[str], limit: int,
+                cursor: Optional[str] = None, since_id: Optional[int] = None) -> Tuple[List[Dict], Optional[str]]:
+    """Newest-first page of ``.values()`` rows ordered by (time_field, id).
+
+    ``cursor`` continues after the last row of the previous page, so deep
+    pages cost the same as the first one (no OFFSET). ``since_id`` keeps
+    only rows inserted after that id. Returns the rows and the cursor of the
+    next page (None on the last page).
+    """
+    queryset = queryset.order_by(f'-{time_field}', '-id')
+    if since_id is not None:
+        queryset = queryset.filter(id__gt=since_id)
+    if cursor:
+        position, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(**{f'{time_field}__lt': position}) |
+                                   Q(**{time_field: position, 'id__lt': pk}))
+
+    rows = list(queryset.values(*fields)[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][time_field], rows[-1]['id'])
+    return rows, next_cursor
+
+
+def keyset_chunks(queryset, time_field: str, fields: List[str], chunk_size: int = 1000) -> Iterator[List[tuple]]:
+    """Every row of ``queryset``, oldest first, as lists of ``values_list`` tuples.
+
+    Each chunk is one query continuing after the last row of the previous
+    chunk on (time_field, id), so memory stays at one chunk however large
+    the table is, and no cursor is held open between chunks. ``fields``
+    must include ``time_field`` and ``id``.
+    """
+    queryset = queryset.order_by(time_field, 'id')
+    time_index, id_index = fields.index(time_field), fields.index('id')
+    after = None
+    while True:
+        page = queryset
+        if after is not None:
+            page = page.filter(Q(**{f'{time_field}__gt': after[0]}) |
+                               Q(**{time_field: after[0], 'id__gt': after[1]}))
+        rows = list(page.values_list(*fields)[:chunk_size])
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        after = (rows[-1][time_index], rows[-1][id_index])
@@ -0,0 +1,473 @@
+"""Background status poller that keeps a live snapshot of the machine state"""
+import time
+import logging
+import threading
+from collections import deque
+from typing import Callable, Dict, List, Optional
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from .coffee_machine import get_coffee_machine, LaSpazialeCoffeeMachine
+from .signals import command_sent
+
+logger = logging.getLogger('machine')
+
+
+class MachineSnapshot:
+    """Image of the machine state registers (256-270)
+
+    Selection words are as fresh as ``taken_at``; the slow-tier words
+    (sensor faults, purge countdowns, config, blocked) were read at
+    ``slow_monotonic`` and purge countdowns are extrapolated from there.
+    """
+
+    BASE_ADDRESS = LaSpazialeCoffeeMachine.REGISTERS['GROUP_1_SELECTION']
+
+    def __init__(self, words: List[int], slow_monotonic: Optional[float] = None):
+        self.words = list(words)
+        self.taken_at = timezone.now()
+        self.monotonic = time.monotonic()
+        self.slow_monotonic = slow_monotonic if slow_monotonic is not None else self.monotonic
+        self.version = 0  # Assigned by the poller; bumped whenever the registers change
+
+    def _word(self, name: str) -> int:
+        return self.words[LaSpazialeCoffeeMachine.REGISTERS[name] - self.BASE_ADDRESS]
+
+    @property
+    def number_of_groups(self) -> int:
+        """Groups reported by the machine, clamped to the 1-4 supported range"""
+        return max(1, min(self._word('NUMBER_OF_GROUPS') or 3, 4))
+
+    def groups(self) -> range:
+        return range(1, self.number_of_groups + 1)
+
+    def selection(self, group_num: int) -> int:
+        return self._word(f'GROUP_{group_num}_SELECTION')
+
+    def is_group_busy(self, group_num: int) -> bool:
+        """A group is busy while any delivery/purge bit (0-7) is set"""
+        return bool(self.selection(group_num) & 0x00FF)
+
+    def busy_groups(self) -> Dict[int, bool]:
+        return {group: self.is_group_busy(group) for group in self.groups()}
+
+    def any_group_busy(self) -> bool:
+        return any(self.is_group_busy(group) for group in self.groups())
+
+    def sensor_fault(self, group_num: int) -> bool:
+        return self._word(f'SENSOR_FAULT_GROUP_{group_num}') == 1
+
+    def purge_countdown(self, group_num: int, now: Optional[float] = None) -> int:
+        """Seconds until automatic purge, extrapolated from the last slow read"""
+        elapsed = int((now if now is not None else time.monotonic()) - self.slow_monotonic)
+        return max(0, self._word(f'PURGE_COUNTDOWN_GROUP_{group_num}') - elapsed)
+
+    def countdown_tick(self, now: Optional[float] = None) -> Optional[int]:
+        """Whole seconds the purge countdowns are extrapolated by at ``now``, None once none is running"""
+        now = now if now is not None else time.monotonic()
+        if not any(self.purge_countdown(group, now) for group in self.groups()):
+            return None
+        return int(now - self.slow_monotonic)
+
+    def purge_due(self, group_num: int) -> bool:
+        """True once a countdown that was running at the last slow read ran out"""
+        return self._word(f'PURGE_COUNTDOWN_GROUP_{group_num}') > 0 and self.purge_countdown(group_num) == 0
+
+    @property
+    def machine_blocked(self) -> bool:
+        return self._word('MACHINE_BLOCKED') == 1
+
+    @property
+    def machine_config(self) -> Dict:
+        return LaSpazialeCoffeeMachine.decode_machine_config(self._word('MACHINE_CONFIG'))
+
+    def group_words(self, group_num: int) -> tuple:
+        """Raw registers describing one group"""
+        return (
+            self.selection(group_num),
+            self._word(f'SENSOR_FAULT_GROUP_{group_num}'),
+            self._word(f'PURGE_COUNTDOWN_GROUP_{group_num}'),
+        )
+
+    def changed_groups(self, previous: Optional['MachineSnapshot']) -> List[int]:
+        """Groups whose registers differ from ``previous`` (all groups if None)"""
+        if previous is None or previous.number_of_groups != self.number_of_groups:
+            return list(self.groups())
+        return [group for group in self.groups() if self.group_words(group) != previous.group_words(group)]
+
+    def group_status(self, group_num: int, now: Optional[float] = None) -> Dict:
+        return {
+            'selection': LaSpazialeCoffeeMachine.decode_selection(self.selection(group_num)),
+            'sensor_fault': self.sensor_fault(group_num),
+            'purge_countdown': self.purge_countdown(group_num, now),
+            'is_busy': self.is_group_busy(group_num),
+        }
+
+    def to_status(self, groups: Optional[List[int]] = None, now: Optional[float] = None) -> Dict:
+        """Status dict in the same shape as get_all_groups_status()
+
+        ``groups`` limits the ``groups`` section to the given group numbers.
+        ``now`` is the monotonic time purge countdowns are extrapolated to.
+        """
+        now = now if now is not None else time.monotonic()
+        groups_status = {
+            f'group_{group}': self.group_status(group, now)
+            for group in (self.groups() if groups is None else groups)
+        }
+
+        return {
+            'version': self.version,
+            'groups': groups_status,
+            'machine_blocked': self.machine_blocked,
+            'machine_config': self.machine_config,
+            'last_updated': self.taken_at.isoformat(),
+        }
+
+    def to_raw(self) -> Dict:
+        """The state registers as read, for clients that decode them themselves
+
+        ``words[i]`` is register ``base + i``. Purge countdowns are as of the
+        last slow read, ``slow_age`` seconds before ``last_updated``.
+        """
+        return {
+            'version': self.version,
+            'base': self.BASE_ADDRESS,
+            'words': list(self.words),
+            'slow_age': round(self.monotonic - self.slow_monotonic, 1),
+            'last_updated': self.taken_at.isoformat(),
+        }
+
+
+class StatusPoller:
+    """Periodically reads the machine state and hands snapshots to listeners.
+
+    The poll interval adapts between ``min_interval`` and ``max_interval``:
+    fast while a group has selection bits set or right after a command was
+    written, the normal ``interval`` while push subscribers are connected,
+    and ``max_interval`` when the machine is idle and only polled over HTTP.
+
+    With no consumers at all (no API read within ``demand_window``, no
+    subscribers, no delivery in flight) it drops to a ``heartbeat_interval``
+    and the first request after that is answered from a one-shot read.
+
+    Registers are read in tiers so that each poll only reads what changes:
+
+    - static: serial number, firmware and number of groups, once per connection
+    - slow: sensor faults, purge countdowns, config and blocked state
+      (260-269), every ``slow_interval`` seconds or after a group changed state
+    - fast: the group selection registers (256-259), every poll
+    """
+
+    def __init__(self, interval: Optional[float] = None, min_interval: Optional[float] = None,
+                 max_interval: Optional[float] = None, command_boost: Optional[float] = None,
+                 slow_interval: Optional[float] = None, heartbeat_interval: Optional[float] = None,
+                 demand_window: Optional[float] = None):
+        self.interval = interval or getattr(settings, 'COFFEE_MACHINE_POLL_INTERVAL', 1.0)
+        self.min_interval = min_interval or getattr(settings, 'COFFEE_MACHINE_POLL_MIN_INTERVAL', 0.2)
+        self.max_interval = max_interval or getattr(settings, 'COFFEE_MACHINE_POLL_MAX_INTERVAL', 5.0)
+        self.command_boost = command_boost or getattr(settings, 'COFFEE_MACHINE_POLL_COMMAND_BOOST', 10.0)
+        self.slow_interval = slow_interval or getattr(settings, 'COFFEE_MACHINE_SLOW_POLL_INTERVAL', 30.0)
+        self.heartbeat_interval = heartbeat_interval or getattr(settings, 'COFFEE_MACHINE_HEARTBEAT_INTERVAL', 60.0)
+        self.demand_window = demand_window or getattr(settings, 'COFFEE_MACHINE_DEMAND_WINDOW', 30.0)
+        self.snapshot: Optional[MachineSnapshot] = None
+        # Versions start from the wall clock so they keep increasing across restarts
+        self.version = int(time.time() * 1000)
+        self.history = deque(maxlen=getattr(settings, 'COFFEE_MACHINE_SNAPSHOT_HISTORY', 256))
+        self.identity: Optional[Dict] = None
+        self._machine = None
+        self._slow_words: Optional[List[int]] = None
+        self._slow_monotonic: Optional[float] = None
+        self._resync = False
+        self.current_interval = self.max_interval
+        self.reason = 'starting'
+        self._listeners: List[Callable[[MachineSnapshot], None]] = []
+        self._subscribers: List[Callable[[MachineSnapshot], None]] = []
+        self._last_command: Optional[float] = None
+        self._last_read: Optional[float] = None
+        self._last_busy: Optional[float] = None
+        self._poll_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {'polls': 0, 'failed_polls': 0, 'slow_polls': 0, 'last_poll_seconds': None}
+
+        command_sent.connect(self._on_command_sent)
+
+    def add_listener(self, listener: Callable[[MachineSnapshot], None]):
+        """Register an internal callable invoked with every new snapshot"""
+        if listener not in self._listeners:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[MachineSnapshot], None]):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def subscribe(self, subscriber: Callable[[MachineSnapshot], None]):
+        """Register a push consumer; subscribers keep the poller at normal rate"""
+        if subscriber not in self._subscribers:
+            self._subscribers.append(subscriber)
+        self.wake()
+
+    def unsubscribe(self, subscriber: Callable[[MachineSnapshot], None]):
+        if subscriber in self._subscribers:
+            self._subscribers.remove(subscriber)
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def wake(self):
+        """Cut the current sleep short and re-evaluate the poll interval"""
+        self._wake_event.set()
+
+    def _on_command_sent(self, sender, **kwargs):
+        self._last_command = time.monotonic()
+        self.wake()
+
+    def touch(self):
+        """Record an API read; wakes the poller if it was down to heartbeat"""
+        self._last_read = time.monotonic()
+        if self.reason == 'heartbeat':
+            self.wake()
+
+    def snapshot_at(self, version: int) -> Optional[MachineSnapshot]:
+        """Look up a recent snapshot by version (for resuming push streams)"""
+        for snapshot in reversed(self.history):
+            if snapshot.version == version:
+                return snapshot
+            if snapshot.version < version:
+                break
+        return None
+
+    def has_recent_reads(self) -> bool:
+        return self._last_read is not None and time.monotonic() - self._last_read < self.demand_window
+
+    def has_recent_activity(self) -> bool:
+        """A delivery finished recently; listeners may still have work to flush"""
+        return self._last_busy is not None and time.monotonic() - self._last_busy < self.demand_window
+
+    def next_interval(self):
+        """Pick the next poll interval and the reason for it"""
+        machine = get_coffee_machine()
+        if not machine.is_connected:
+            return self.max_interval, 'disconnected'
+        if self._last_command is not None and time.monotonic() - self._last_command < self.command_boost:
+            return self.min_interval, 'command'
+        if self.snapshot is not None and self.snapshot.any_group_busy():
+            return self.min_interval, 'delivery'
+        if self._subscribers:
+            return max(self.min_interval, min(self.interval, self.max_interval)), 'subscribers'
+        if self.has_recent_reads() or self.has_recent_activity():
+            return self.max_interval, 'idle'
+        return self.heartbeat_interval, 'heartbeat'
+
+    def metrics(self) -> Dict:
+        """Poller state for the metrics endpoint"""
+        return {
+            'running': self.is_running,
+            'interval': self.current_interval,
+            'reason': self.reason,
+            'min_interval': self.min_interval,
+            'max_interval': self.max_interval,
+            'heartbeat_interval': self.heartbeat_interval,
+            'subscribers': self.subscriber_count,
+            'recent_api_reads': self.has_recent_reads(),
+            'polls': self._stats['polls'],
+            'slow_polls': self._stats['slow_polls'],
+            'failed_polls': self._stats['failed_polls'],
+            'last_poll_seconds': self._stats['last_poll_seconds'],
+            'last_snapshot_at': self.snapshot.taken_at.isoformat() if self.snapshot else None,
+        }
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start the polling thread (no-op if already running)"""
+        if self.is_running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='coffee-status-poller', daemon=True)
+        self._thread.start()
+        logger.info(f"Status poller started ({self.min_interval}s-{self.max_interval}s)")
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the polling thread and wait for it to finish"""
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+            logger.info("Status poller stopped")
+
+    def is_fresh(self, snapshot: Optional[MachineSnapshot]) -> bool:
+        return snapshot is not None and time.monotonic() - snapshot.monotonic <= self.max_interval + 1
+
+    def refresh(self) -> Optional[MachineSnapshot]:
+        """Return a fresh snapshot, doing a one-shot read if the last one is stale"""
+        if self.is_fresh(self.snapshot):
+            return self.snapshot
+        with self._poll_lock:
+            # The poller thread may have read while we waited for the lock
+            if self.is_fresh(self.snapshot):
+                return self.snapshot
+            return self._poll()
+
+    def current(self) -> Optional[MachineSnapshot]:
+        """Fresh snapshot as first seen at its version.
+
+        Its ``to_status()`` body only changes with the version and, while a
+        purge countdown runs down, with ``countdown_tick()``: together they
+        make a strong ETag.
+        """
+        snapshot = self.refresh()
+        if snapshot is None:
+            return None
+        return self.snapshot_at(snapshot.version) or snapshot
+
+    def get_status(self) -> Optional[Dict]:
+        """Status dict for an API read, or None if the machine could not be read"""
+        self.touch()
+        snapshot = self.refresh()
+        return snapshot.to_status() if snapshot is not None else None
+
+    def _reset_tiers(self):
+        """Forget everything read from the previous connection"""
+        self.identity = None
+        self.snapshot = None
+        self._slow_words = None
+        self._slow_monotonic = None
+        cache.delete('purge_countdowns')
+
+    def _read_identity(self, machine) -> Optional[Dict]:
+        """Static tier: registers that never change while connected"""
+        number_of_groups = machine.get_number_of_groups()
+        if number_of_groups is None:
+            return None
+        identity = {
+            'serial_number': machine.get_serial_number(),
+            'firmware_version': machine.get_firmware_version(),
+            'number_of_groups': max(1, min(number_of_groups or 3, 4)),
+            'last_updated': timezone.now().isoformat(),
+        }
+        cache.set('machine_identity', identity, timeout=None)
+        return identity
+
+    def _slow_due(self, now: float) -> bool:
+        if self._slow_words is None or self._resync:
+            return True
+        return now - self._slow_monotonic >= self.slow_interval
+
+    def _read_slow(self, machine, now: float) -> bool:
+        """Slow tier: sensor faults, purge countdowns, config and blocked state"""
+        words = machine.read_register_block('SENSOR_FAULT_GROUP_1', 'MACHINE_BLOCKED')
+        if words is None:
+            return False
+        self._slow_words = words
+        self._slow_monotonic = now
+        self._resync = False
+        self._stats['slow_polls'] += 1
+
+        # Shared with deliver_coffee's near-purge check (estimate_purge_countdown)
+        countdowns = {
+            group: words[LaSpazialeCoffeeMachine.REGISTERS[f'PURGE_COUNTDOWN_GROUP_{group}'] -
+                         LaSpazialeCoffeeMachine.REGISTERS['SENSOR_FAULT_GROUP_1']]
+            for group in range(1, self.identity['number_of_groups'] + 1)
+        }
+        cache.set('purge_countdowns', {'values': countdowns, 'read_at': time.time()},
+                  timeout=int(self.slow_interval * 2))
+        return True
+
+    def poll_once(self) -> Optional[MachineSnapshot]:
+        """Read the due register tiers once and notify listeners"""
+        with self._poll_lock:
+            return self._poll()
+
+    def _poll(self) -> Optional[MachineSnapshot]:
+        # Always resolve the singleton: connect_machine may have replaced it
+        machine = get_coffee_machine()
+        if not machine.is_connected:
+            if self._machine is not None:
+                self._reset_tiers()
+                self._machine = None
+            return None
+        if machine is not self._machine:
+            self._reset_tiers()
+            self._machine = machine
+
+        started = time.monotonic()
+        selections = None
+        if self.identity is None:
+            self.identity = self._read_identity(machine)
+        if self.identity is not None:
+            if self._slow_due(started):
+                self._read_slow(machine, started)
+            if self._slow_words is not None:
+                groups = self.identity['number_of_groups']
+                selections = machine.read_register_block('GROUP_1_SELECTION', f'GROUP_{groups}_SELECTION')
+
+        self._stats['last_poll_seconds'] = round(time.monotonic() - started, 4)
+        if selections is None:
+            self._stats['failed_polls'] += 1
+            return None
+
+        words = selections + [0] * (4 - groups) + self._slow_words + [groups]
+        snapshot = MachineSnapshot(words, slow_monotonic=self._slow_monotonic)
+        previous = self.snapshot
+        if previous is None or previous.words != snapshot.words:
+            self.version += 1
+            snapshot.version = self.version
+            self.history.append(snapshot)
+        else:
+            snapshot.version = previous.version
+        self.snapshot = snapshot
+        self._stats['polls'] += 1
+        if snapshot.any_group_busy():
+            self._last_busy = snapshot.monotonic
+
+        # A delivery or purge starting or ending resets the countdowns, and a
+        # countdown that ran out means an automatic purge just started
+        if previous is not None and previous.busy_groups() != snapshot.busy_groups():
+            self._resync = True
+        elif any(snapshot.purge_due(group) for group in snapshot.groups()):
+            self._resync = True
+
+        for listener in list(self._listeners) + list(self._subscribers):
+            try:
+                listener(snapshot)
+            except Exception as e:
+                logger.error(f"Status listener {listener!r} failed: {e}", exc_info=True)
+
+        return snapshot
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.error(f"Status poller error: {e}", exc_info=True)
+
+            interval, reason = self.next_interval()
+            if reason != self.reason:
+                logger.debug(f"Poll interval {interval}s ({reason})")
+            self.current_interval, self.reason = interval, reason
+
+            self._wake_event.wait(interval)
+            self._wake_event.clear()
+
+
+# Singleton instance for Django integration
+_poller_instance = None
+_poller_lock = threading.Lock()
+
+def get_status_poller() -> StatusPoller:
+    """Get singleton status poller instance"""
+    global _poller_instance
+
+    if _poller_instance is None:
+        with _poller_lock:
+            if _poller_instance is None:
+                _poller_instance = StatusPoller()
+
+    return _poller_instance
@@ -0,0 +1,72 @@
+"""Compact encodings of the machine status for clients that poll it"""
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.renderers import BaseRenderer
+from rest_framework.settings import api_settings
+
+try:
+    import msgpack
+except ImportError:  # Optional: without it the API only speaks JSON
+    msgpack = None
+
+MSGPACK_MEDIA_TYPE = 'application/x-msgpack'
+
+# ``?format=`` values that pick the payload shape rather than the encoding
+PAYLOAD_FORMATS = ('raw',)
+
+
+class MessagePackRenderer(BaseRenderer):
+    """MessagePack encoding, chosen with ``Accept: application/x-msgpack``"""
+    media_type = MSGPACK_MEDIA_TYPE
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, use_bin_type=True)
+
+
+class PayloadFormatNegotiation(DefaultContentNegotiation):
+    """Content negotiation that leaves ``?format=raw`` to the view.
+
+    DRF reads ``?format=`` as a renderer name and answers 404 when none
+    matches. A payload format only changes what the view returns, so the
+    encoding is still negotiated from the Accept header.
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        # DRF breaks ties between equally specific media types by renderer
+        # order; prefer the order the client listed them in
+        listed = [media_range.split(';')[0].strip()
+                  for media_range in request.META.get('HTTP_ACCEPT', '').split(',')]
+        renderers = sorted(renderers, key=lambda renderer: listed.index(renderer.media_type)
+                           if renderer.media_type in listed else len(listed))
+        return super().select_renderer(request, renderers, format_suffix)
+
+    def filter_renderers(self, renderers, format):
+        if format in PAYLOAD_FORMATS:
+            return renderers
+        return super().filter_renderers(renderers, format)
+
+
+def status_renderers() -> list:
+    """Renderers offered by the status endpoint (MessagePack only when installed)"""
+    renderers = list(api_settings.DEFAULT_RENDERER_CLASSES)
+    if msgpack is not None:
+        renderers.append(MessagePackRenderer)
+    return renderers
+
+
+def accepts_msgpack(request) -> bool:
+    """Whether a plain Django request lists MessagePack before JSON in its Accept header"""
+    if msgpack is None:
+        return False
+    accept = request.headers.get('Accept', '')
+    for media_range in accept.split(','):
+        media_type = media_range.split(';')[0].strip()
+        if media_type == MSGPACK_MEDIA_TYPE:
+            return True
+        if media_type in ('application/json', 'application/*', '*/*'):
+            return False
+    return False
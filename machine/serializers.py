@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import CoffeeMachine, CoffeeDelivery, MaintenanceLog
+from .models import CoffeeMachine, CoffeeDelivery, CoffeeOrder, MaintenanceLog
 
 
 class CoffeeMachineSerializer(serializers.ModelSerializer):
@@ -19,8 +19,19 @@ class CoffeeDeliverySerializer(serializers.ModelSerializer):
     class Meta:
         model = CoffeeDelivery
         fields = ['id', 'coffee_type', 'coffee_type_display', 'group_number',
-                  'status', 'status_display', 'started_at', 'completed_at',
-                  'error_message']
+                  'status', 'status_display', 'source', 'started_at',
+                  'completed_at', 'duration', 'error_message']
+
+
+class CoffeeOrderSerializer(serializers.ModelSerializer):
+    coffee_type_display = serializers.CharField(
+        source='get_coffee_type_display', read_only=True)
+
+    class Meta:
+        model = CoffeeOrder
+        fields = ['id', 'coffee_type', 'coffee_type_display', 'status',
+                  'group_number', 'delivery', 'client_order_id', 'created_at',
+                  'dispatched_at', 'error_message']
 
 
 class MaintenanceLogSerializer(serializers.ModelSerializer):
@@ -0,0 +1,286 @@
+"""Machine commands shared by the HTTP views and the WebSocket consumer"""
+import json
+import logging
+from datetime import timedelta
+from typing import Dict, List, Optional
+from django.utils import timezone
+from .models import CoffeeDelivery, MaintenanceLog
+from .coffee_machine import get_coffee_machine, LaSpazialeCoffeeMachine
+from .duration_stats import get_duration_model
+from .idempotency import clean_key, get_idempotency_store
+from .journal import get_command_journal
+from .poller import get_status_poller
+from .writebehind import get_write_buffer
+
+logger = logging.getLogger('machine')
+
+COFFEE_TYPES = ['single_short', 'single_medium', 'single_long',
+                'double_short', 'double_medium', 'double_long']
+MAX_GROUP_NUMBER = 3
+BATCH_ACTIONS = ['deliver', 'stop', 'purge', 'water', 'mat']
+PURGE_GUARD_SECONDS = 10  # Deliveries are refused this close to an automatic purge
+
+
+def parse_group_number(group_number) -> int:
+    """Validate a group number from request data; raises ValueError"""
+    try:
+        group_number = int(group_number)
+    except (ValueError, TypeError):
+        raise ValueError(f'Invalid group_number: {group_number}')
+
+    if not (1 <= group_number <= MAX_GROUP_NUMBER):
+        raise ValueError(f'group_number must be between 1 and {MAX_GROUP_NUMBER}')
+    return group_number
+
+
+def validate_coffee_type(coffee_type) -> str:
+    """Validate a coffee type from request data; raises ValueError"""
+    if coffee_type not in COFFEE_TYPES:
+        raise ValueError(f'Invalid coffee_type: {coffee_type}')
+    return coffee_type
+
+
+def _run_once(idempotency_key, fingerprint, command) -> Dict:
+    """Run a command, or replay its result if the key was seen within the TTL"""
+    idempotency_key = clean_key(idempotency_key)
+    if idempotency_key is None:
+        return command()
+    result, replayed = get_idempotency_store().execute(idempotency_key, fingerprint, command)
+    return dict(result, replayed=True) if replayed else result
+
+
+def deliver_coffee(group_number, coffee_type, idempotency_key: Optional[str] = None) -> Dict:
+    """Start a delivery and record it; raises ValueError on invalid input.
+
+    With an ``idempotency_key`` a retried request gets the first result
+    back (marked ``replayed``) instead of brewing again.
+    """
+    group_number = parse_group_number(group_number)
+    coffee_type = validate_coffee_type(coffee_type)
+    return _run_once(idempotency_key, ('deliver', group_number, coffee_type),
+                     lambda: _deliver(group_number, coffee_type))
+
+
+def expected_completion(group_number: int, coffee_type: str, started_at=None) -> Dict:
+    """Expected duration and completion time of a delivery, from the duration model"""
+    expected = get_duration_model().expected(coffee_type, group_number)
+    started_at = started_at or timezone.now()
+    return {
+        'expected_duration': round(expected, 1),
+        'expected_completion': (started_at + timedelta(seconds=expected)).isoformat(),
+    }
+
+
+def _deliver(group_number: int, coffee_type: str) -> Dict:
+    machine = get_coffee_machine()
+    result = machine.deliver_coffee(group_number, coffee_type)
+
+    delivery = CoffeeDelivery.objects.create(
+        coffee_type=coffee_type,
+        group_number=group_number,
+        status='in_progress' if result['success'] else 'failed',
+        error_message='' if result['success'] else result.get('message', ''),
+    )
+    get_command_journal().record_delivery(group_number, delivery.id, result['success'])
+
+    response = {
+        'success': result['success'],
+        'message': result.get('message', 'Coffee delivered'),
+        'group': group_number,
+        'type': coffee_type,
+        'delivery_id': delivery.id,
+    }
+    if result['success']:
+        response.update(expected_completion(group_number, coffee_type, delivery.started_at))
+    return response
+
+
+def stop_delivery(group_number) -> Dict:
+    """Stop the delivery on a group and close its open rows"""
+    group_number = parse_group_number(group_number)
+
+    machine = get_coffee_machine()
+    success = machine.stop_delivery(group_number)
+
+    if success:
+        # The update is written later: a delivery started after the stop must not match it
+        stopped_at = timezone.now()
+        write_buffer = get_write_buffer()
+        write_buffer.update(
+            CoffeeDelivery,
+            {'group_number': group_number, 'status': 'in_progress', 'started_at__lte': stopped_at},
+            status='stopped',
+            completed_at=stopped_at
+        )
+
+        write_buffer.insert(MaintenanceLog(
+            log_type='manual_stop',
+            group_number=group_number,
+            message=f'Manual stop command sent to group {group_number}'
+        ))
+
+    return {
+        'success': success,
+        'message': f'Stop command {"sent" if success else "failed"} for group {group_number}',
+        'group': group_number,
+    }
+
+
+def start_purge(group_number) -> Dict:
+    """Start a purge cycle on a group and log it"""
+    group_number = parse_group_number(group_number)
+
+    machine = get_coffee_machine()
+    success = machine.start_purge(group_number)
+
+    if success:
+        get_write_buffer().insert(MaintenanceLog(
+            log_type='purge',
+            group_number=group_number,
+            message=f'Purge cycle started for group {group_number}'
+        ))
+
+    return {
+        'success': success,
+        'message': f'Purge cycle {"started" if success else "failed"} for group {group_number}',
+        'group': group_number,
+    }
+
+
+def parse_batch_action(action) -> Dict:
+    """Validate one batch action and resolve the register write it needs; raises ValueError"""
+    if not isinstance(action, dict):
+        raise ValueError('Each action must be an object')
+
+    kind = action.get('action')
+    registers = LaSpazialeCoffeeMachine.REGISTERS
+    commands = LaSpazialeCoffeeMachine.COMMANDS
+
+    if kind in ('deliver', 'stop', 'purge'):
+        group_number = parse_group_number(action.get('group_number'))
+        parsed = {'action': kind, 'group': group_number, 'register': registers[f'COMMAND_GROUP_{group_number}']}
+        if kind == 'deliver':
+            parsed['type'] = validate_coffee_type(action.get('coffee_type'))
+            parsed['value'] = commands[parsed['type'].upper()]
+        else:
+            parsed['value'] = commands['STOP_DELIVERY' if kind == 'stop' else 'START_PURGE']
+        return parsed
+
+    if kind in ('water', 'mat'):
+        try:
+            set_number = int(action.get('set_number'))
+        except (ValueError, TypeError):
+            set_number = None
+        if set_number not in (0, 1, 2):
+            raise ValueError(f'{kind} set_number must be 0, 1 or 2')
+        register = registers['WATER_COMMAND' if kind == 'water' else 'MAT_COMMAND']
+        return {'action': kind, 'set_number': set_number, 'register': register, 'value': set_number}
+
+    raise ValueError(f'Invalid action: {kind} (expected one of {", ".join(BATCH_ACTIONS)})')
+
+
+def execute_batch(actions: List, idempotency_key: Optional[str] = None) -> Dict:
+    """Run several actions against one status snapshot and as few bus frames as possible.
+
+    Every action is validated first, deliveries are checked against a single
+    snapshot (busy group, imminent purge), and the accepted writes go out as
+    multi-register frames. Delivery rows and maintenance logs are then
+    written in bulk. Returns one result per action, in request order.
+    A retried batch with the same ``idempotency_key`` is not executed again.
+    """
+    fingerprint = ('batch', json.dumps(actions, sort_keys=True, default=str))
+    return _run_once(idempotency_key, fingerprint, lambda: _execute_batch(actions))
+
+
+def _execute_batch(actions: List) -> Dict:
+    machine = get_coffee_machine()
+    snapshot = get_status_poller().refresh()
+
+    results = []
+    accepted = {}  # register -> index of the action writing it
+    for index, action in enumerate(actions):
+        try:
+            parsed = parse_batch_action(action)
+        except ValueError as e:
+            results.append({'success': False, 'message': str(e)})
+            continue
+
+        result = dict(parsed, success=False)
+        del result['register'], result['value']
+        results.append(result)
+        group_number = parsed.get('group')
+
+        if snapshot is None:
+            result['message'] = 'Machine not connected'
+        elif parsed['register'] in accepted:
+            result['message'] = f'Conflicts with action {accepted[parsed["register"]]}'
+        elif parsed['action'] == 'deliver' and snapshot.is_group_busy(group_number):
+            result['message'] = f'Group {group_number} is currently busy'
+        elif parsed['action'] == 'deliver' and snapshot.purge_countdown(group_number) < PURGE_GUARD_SECONDS:
+            countdown = snapshot.purge_countdown(group_number)
+            result['message'] = f'Group {group_number} is near automatic purge ({countdown}s). Please wait.'
+        else:
+            accepted[parsed['register']] = index
+            result['_write'] = (parsed['register'], parsed['value'])
+
+    writes = dict(result['_write'] for result in results if '_write' in result)
+    sent = machine.send_commands(writes, snapshot.number_of_groups) if writes else {}
+    sent_at = timezone.now()
+
+    deliveries = []
+    stopped_groups = []
+    maintenance_logs = []
+    for result in results:
+        write = result.pop('_write', None)
+        if write is not None:
+            result['success'] = sent.get(write[0], False)
+            result['message'] = f'Command {"sent" if result["success"] else "failed"}'
+
+        if result.get('action') == 'deliver':
+            deliveries.append((result, CoffeeDelivery(
+                coffee_type=result['type'],
+                group_number=result['group'],
+                status='in_progress' if result['success'] else 'failed',
+                error_message='' if result['success'] else result['message'],
+            )))
+        elif result.get('action') == 'stop' and result['success']:
+            stopped_groups.append(result['group'])
+            maintenance_logs.append(MaintenanceLog(
+                log_type='manual_stop',
+                group_number=result['group'],
+                message=f'Manual stop command sent to group {result["group"]}'
+            ))
+        elif result.get('action') == 'purge' and result['success']:
+            maintenance_logs.append(MaintenanceLog(
+                log_type='purge',
+                group_number=result['group'],
+                message=f'Purge cycle started for group {result["group"]}'
+            ))
+
+    # Delivery ids are part of the response, so only those rows are written now
+    if deliveries:
+        CoffeeDelivery.objects.bulk_create([delivery for _, delivery in deliveries])
+        journal = get_command_journal()
+        for result, delivery in deliveries:
+            result['delivery_id'] = delivery.id
+            journal.record_delivery(delivery.group_number, delivery.id, result['success'])
+            if result['success']:
+                result.update(expected_completion(result['group'], result['type'], delivery.started_at))
+
+    write_buffer = get_write_buffer()
+    if stopped_groups:
+        write_buffer.update(
+            CoffeeDelivery,
+            {'group_number__in': stopped_groups, 'status': 'in_progress', 'started_at__lte': sent_at},
+            status='stopped',
+            completed_at=sent_at
+        )
+    for maintenance_log in maintenance_logs:
+        write_buffer.insert(maintenance_log)
+
+    logger.info(f"Batch of {len(actions)} actions: {len(writes)} writes, "
+                f"{sum(result['success'] for result in results)} succeeded")
+    return {
+        'success': all(result['success'] for result in results),
+        'results': results,
+    }
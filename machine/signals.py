@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent after a register write to the machine succeeded.
+# Arguments: address, value
+command_sent = Signal()
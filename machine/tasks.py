@@ -1,6 +1,8 @@
 from celery import shared_task
 from .coffee_machine import get_coffee_machine
-from .models import CoffeeDelivery, MaintenanceLog
+from .models import CoffeeDelivery
+from .health import compact_health_logs, get_health_recorder
+from .maintenance import maintain_database
 from django.utils import timezone
 import logging
 
@@ -58,20 +60,32 @@ def health_check_task():
     try:
         machine = get_coffee_machine()
         health = machine.health_check()
-        
-        MaintenanceLog.objects.create(
-            log_type='health_check',
-            message=f'Scheduled health check - Status: {health["overall_status"]}',
-            resolved=health['overall_status'] == 'healthy'
-        )
+        get_health_recorder().record(health)
         
         return health['overall_status'] == 'healthy'
         
     except Exception as e:
         logger.error(f"Error in health check task: {e}")
-        MaintenanceLog.objects.create(
-            log_type='health_check',
-            message=f'Health check failed: {str(e)}',
-            resolved=False
-        )
-        return False
\ No newline at end of file
+        get_health_recorder().record({
+            'overall_status': 'unhealthy',
+            'errors': [f'Health check failed: {str(e)}'],
+        })
+        return False
+
+@shared_task
+def compact_health_logs_task():
+    """Fold old health check log rows into daily summaries"""
+    try:
+        return compact_health_logs()
+    except Exception as e:
+        logger.error(f"Error compacting health check logs: {e}")
+        return 0
+
+@shared_task
+def maintain_db_task():
+    """Back up the database, delete rows past their retention, then VACUUM and ANALYZE"""
+    try:
+        return maintain_database()
+    except Exception as e:
+        logger.error(f"Error maintaining the database: {e}")
+        return None
\ No newline at end of file
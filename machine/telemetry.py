@@ -0,0 +1,394 @@
+"""Append-only telemetry store of the machine state registers
+
+Segments are files of fixed-width records, one file per hour in a
+directory per (UTC) day::
+
+    <TELEMETRY_DIR>/20261018/14.tlm
+
+A segment starts with a 16 byte header (magic, record size, start epoch)
+followed by records of ``RECORD_FORMAT``: milliseconds since the segment
+start, flags, the age of the slow-tier words in tenths of a second, and
+the 15 state register words (256-270). The state is run-length encoded in
+time: a record is written only when a word changes, plus a heartbeat
+record every ``heartbeat`` seconds while nothing does, so each record
+holds until the next one. An idle machine costs about 50 KB a day.
+"""
+import os
+import time
+import bisect
+import queue
+import calendar
+import fcntl
+import struct
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+from django.conf import settings
+from .poller import MachineSnapshot
+
+try:
+    import numpy as np
+    from .downsample import duty_cycle, lttb, runs
+except ImportError:  # Optional: recording works without it, reading needs it
+    np = None
+
+logger = logging.getLogger('machine')
+
+MAGIC = b'CMTLM1'
+HEADER_FORMAT = '<6sHq'   # magic, record size, segment start (epoch seconds)
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+WORD_COUNT = 15
+RECORD_FORMAT = f'<IHH{WORD_COUNT}H'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+SEGMENT_SECONDS = 3600
+SEGMENT_SUFFIX = '.tlm'
+
+FLAG_HEARTBEAT = 0x01  # Nothing changed; written to show the state was still being read
+FLAG_RESUMED = 0x02    # First record after the recorder (re)started: there may be a gap before it
+
+# Chartable fields: name -> (kind, word index); busy is any delivery/purge bit of the selection
+FIELDS = {'blocked': ('flag', 13)}
+for _group in range(1, 5):
+    FIELDS[f'busy_{_group}'] = ('flag', _group - 1)
+    FIELDS[f'countdown_{_group}'] = ('line', 7 + _group)
+MAX_POINTS = 5000
+
+if np is not None:
+    RECORD_DTYPE = np.dtype([
+        ('t', '<u4'), ('flags', '<u2'), ('slow_age', '<u2'), ('words', '<u2', (WORD_COUNT,)),
+    ])
+    # Records as returned by ``read()``: absolute epoch seconds instead of the segment offset
+    SERIES_DTYPE = np.dtype([
+        ('t', '<f8'), ('flags', '<u2'), ('slow_age', '<f4'), ('words', '<u2', (WORD_COUNT,)),
+    ])
+
+
+def segment_path(directory: str, epoch: float) -> str:
+    """Path of the segment holding a point in time"""
+    start = time.gmtime(epoch)
+    return os.path.join(directory, time.strftime('%Y%m%d', start), f'{start.tm_hour:02d}{SEGMENT_SUFFIX}')
+
+
+def segment_start(path: str) -> int:
+    """Epoch seconds at which a segment starts, from its path"""
+    day = os.path.basename(os.path.dirname(path))
+    hour = int(os.path.basename(path)[:-len(SEGMENT_SUFFIX)])
+    return calendar.timegm(time.strptime(day, '%Y%m%d')) + hour * 3600
+
+
+class TelemetryStore:
+    """Records every snapshot of the poller into hourly segment files.
+
+    The poller hands snapshots to ``observe``, which only queues them; a
+    writer thread decides what to record and appends it, so a slow SD card
+    never delays a poll. Only one process writes (a lock file in the
+    directory decides which), and the oldest segments are deleted once the
+    store grows beyond ``max_bytes``. ``read`` memory-maps the segments of
+    a time range.
+    """
+
+    def __init__(self, directory: Optional[str] = None, heartbeat: Optional[float] = None,
+                 max_bytes: Optional[int] = None, enabled: Optional[bool] = None):
+        self.directory = str(directory or getattr(settings, 'TELEMETRY_DIR', 'telemetry'))
+        self.heartbeat = heartbeat or getattr(settings, 'TELEMETRY_HEARTBEAT', 60)
+        self.max_bytes = max_bytes or getattr(settings, 'TELEMETRY_MAX_BYTES', 256 * 1024 * 1024)
+        self.enabled = enabled if enabled is not None else getattr(settings, 'TELEMETRY_ENABLED', True)
+
+        self._queue: 'queue.Queue' = queue.Queue(maxsize=1024)
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._lock_file = None
+
+        # Writer thread state
+        self._file = None
+        self._segment_start: Optional[int] = None
+        self._last_words: Optional[Tuple[int, ...]] = None
+        self._last_written = 0.0
+        self._resumed = True
+        self._stats = {'records': 0, 'heartbeats': 0, 'dropped': 0, 'segments_deleted': 0}
+
+    # Recording
+
+    def observe(self, snapshot: MachineSnapshot):
+        """Poller listener: queue a snapshot for the writer thread"""
+        if self._thread is None:
+            return
+        slow_age = snapshot.monotonic - snapshot.slow_monotonic
+        try:
+            self._queue.put_nowait((snapshot.taken_at.timestamp(), tuple(snapshot.words), slow_age))
+        except queue.Full:
+            self._stats['dropped'] += 1
+
+    def start(self):
+        """Start the writer thread, unless another process is already recording"""
+        if not self.enabled or self._thread is not None:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self._lock_file = open(os.path.join(self.directory, 'writer.lock'), 'w')
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+            logger.info(f"Telemetry not recorded by this process: {e}")
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='telemetry-writer', daemon=True)
+        self._thread.start()
+        logger.info(f"Telemetry recorder started ({self.directory})")
+
+    def stop(self):
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._stop_event.set()
+        thread.join(timeout=5)
+        self._close_segment()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _run(self):
+        while not self._stop_event.is_set() or not self._queue.empty():
+            try:
+                epoch, words, slow_age = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self._record(epoch, words, slow_age)
+            except OSError as e:
+                logger.error(f"Failed to record telemetry: {e}")
+                self._close_segment()
+
+    def _record(self, epoch: float, words: Tuple[int, ...], slow_age: float):
+        start = int(epoch // SEGMENT_SECONDS * SEGMENT_SECONDS)
+        new_segment = start != self._segment_start
+        if new_segment:
+            self._open_segment(start, epoch)
+
+        changed = words != self._last_words
+        # Every segment starts with the full state, so it can be read on its own
+        if not (changed or new_segment or epoch - self._last_written >= self.heartbeat):
+            return
+
+        flags = 0 if changed or new_segment else FLAG_HEARTBEAT
+        if self._resumed:
+            flags |= FLAG_RESUMED
+            self._resumed = False
+        offset_ms = max(0, int((epoch - start) * 1000))
+        self._file.write(struct.pack(RECORD_FORMAT, offset_ms, flags, min(int(slow_age * 10), 0xFFFF), *words))
+        self._file.flush()
+
+        self._last_words = words
+        self._last_written = epoch
+        self._stats['records'] += 1
+        if flags & FLAG_HEARTBEAT:
+            self._stats['heartbeats'] += 1
+
+    def _open_segment(self, start: int, epoch: float):
+        self._close_segment()
+        path = segment_path(self.directory, epoch)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(struct.pack(HEADER_FORMAT, MAGIC, RECORD_SIZE, start))
+        elif (self._file.tell() - HEADER_SIZE) % RECORD_SIZE:
+            # A record torn by a crash: pad it out so the records after it stay aligned
+            self._file.write(b'\0' * (RECORD_SIZE - (self._file.tell() - HEADER_SIZE) % RECORD_SIZE))
+        self._segment_start = start
+        self._enforce_retention()
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._segment_start = None
+
+    def _enforce_retention(self):
+        """Delete the oldest segments (never the current one) beyond ``max_bytes``"""
+        segments = self.segments()
+        total = sum(os.path.getsize(path) for path in segments)
+        for path in segments[:-1]:
+            if total <= self.max_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+            self._stats['segments_deleted'] += 1
+            day = os.path.dirname(path)
+            if not os.listdir(day):
+                os.rmdir(day)
+
+    # Reading
+
+    def segments(self) -> List[str]:
+        """All segment paths, oldest first"""
+        paths = []
+        try:
+            days = sorted(name for name in os.listdir(self.directory) if name.isdigit())
+        except FileNotFoundError:
+            return paths
+        for day in days:
+            day_dir = os.path.join(self.directory, day)
+            paths.extend(os.path.join(day_dir, name) for name in sorted(os.listdir(day_dir))
+                         if name.endswith(SEGMENT_SUFFIX))
+        return paths
+
+    def load_segment(self, path: str):
+        """Memory-mapped records of one segment (offsets still relative to its start)"""
+        if np is None:
+            raise RuntimeError('Reading telemetry requires numpy')
+        count = (os.path.getsize(path) - HEADER_SIZE) // RECORD_SIZE
+        if count <= 0:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+    def read(self, start: float, end: float):
+        """Records between two epoch times, led by the one in effect at ``start``.
+
+        Returns a ``SERIES_DTYPE`` array sorted by time (epoch seconds); only
+        the segments of the range (and the one before it) are mapped and
+        only the records in range are copied out of them.
+        """
+        if np is None:
+            raise RuntimeError('Reading telemetry requires numpy')
+        # Paths sort in time order: the segment holding ``start`` and the one
+        # before it (for the record in effect at ``start``) are the first read
+        paths = self.segments()
+        first_segment = max(bisect.bisect_left(paths, segment_path(self.directory, start)) - 1, 0)
+        parts = []
+        carried = None
+        for path in paths[first_segment:]:
+            seg_start = segment_start(path)
+            if seg_start >= end:
+                break
+            records = self.load_segment(path)
+            if not len(records):
+                continue
+            offsets = records['t']
+            first = int(np.searchsorted(offsets, (start - seg_start) * 1000, side='left'))
+            last = int(np.searchsorted(offsets, (end - seg_start) * 1000, side='right'))
+            if first > 0:
+                carried = (seg_start, records[first - 1:first])
+            if last > first:
+                if carried is not None and not parts:
+                    parts.append(self._to_series(*carried))
+                parts.append(self._to_series(seg_start, records[first:last]))
+
+        if not parts and carried is not None:
+            parts.append(self._to_series(*carried))
+        if not parts:
+            return np.empty(0, dtype=SERIES_DTYPE)
+        return np.concatenate(parts)
+
+    def series(self, start: float, end: float, fields: Optional[List[str]] = None, points: int = 500) -> Dict:
+        """Chart data for ``fields`` between two epoch times, about ``points`` per series.
+
+        Countdowns become ``[t, value]`` points picked by LTTB; busy and
+        blocked become the ``[from, to]`` intervals they were set, or, where
+        there are more intervals than ``points``, ``[t, percent]`` points of
+        the time set in each of ``points`` equal buckets (``duty``). A record
+        holds until the next one, or for two heartbeats at most: longer
+        silences (the machine disconnected, the server down) are listed as
+        ``gaps``. Times are epoch milliseconds. Raises ValueError for a
+        range starting in the future.
+        """
+        if np is None:
+            raise RuntimeError('Reading telemetry requires numpy')
+        unknown = [field for field in fields or [] if field not in FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)} (available: {', '.join(FIELDS)})")
+        points = max(3, min(points, MAX_POINTS))
+        if start > time.time():
+            raise ValueError('start is in the future')
+
+        records = self.read(start, end)
+        if fields is None:
+            groups = int(records['words'][-1, 14]) if len(records) else 0
+            groups = max(1, min(groups or 3, 4))
+            fields = [f'{kind}_{group}' for kind in ('busy', 'countdown') for group in range(1, groups + 1)]
+            fields.append('blocked')
+
+        t = records['t']
+        end = max(start, min(end, time.time()))
+        until = np.minimum(np.append(t[1:], end), t + 2 * self.heartbeat)
+        shown_from, shown_to = np.maximum(t, start), np.minimum(until, end)
+        resolution = (end - start) / points
+
+        result = {}
+        for field in fields:
+            kind, index = FIELDS[field]
+            words = records['words'][:, index]
+            if kind == 'flag':
+                on = words & 0x00FF != 0 if field.startswith('busy') else words == 1
+                begins, ends = runs(shown_from, shown_to, on)
+                keep = ends > begins
+                begins, ends = begins[keep], ends[keep]
+                if len(begins) <= points:
+                    result[field] = {'type': 'intervals',
+                                     'intervals': _ms(np.column_stack((begins, ends))).tolist()}
+                else:
+                    edges = np.linspace(start, end, points + 1)
+                    percent = np.round(100 * duty_cycle(begins, ends, edges), 1)
+                    result[field] = {'type': 'duty',
+                                     'points': [list(point) for point in zip(_ms(edges[:-1]).tolist(),
+                                                                             percent.tolist())]}
+            else:
+                # Countdowns were read with the slow tier and keep running down until the next read
+                at = np.append(shown_from, shown_to[-1:])
+                read_at = np.append(t, t[-1:]) - np.append(records['slow_age'], records['slow_age'][-1:])
+                value = np.maximum(0, np.append(words, words[-1:]) - (at - read_at))
+                kept = lttb(at, value, points)
+                result[field] = {'type': 'line',
+                                 'points': np.column_stack((_ms(at[kept]), np.round(value[kept]))).astype(np.int64).tolist()}
+
+        gap_from, gap_to = np.append(start, shown_to), np.append(shown_from, end)
+        gaps = gap_to - gap_from > resolution
+        return {
+            'start': int(_ms(start)),
+            'end': int(_ms(end)),
+            'records': len(records),
+            'series': result,
+            'gaps': _ms(np.column_stack((gap_from[gaps], gap_to[gaps]))).tolist(),
+        }
+
+    @staticmethod
+    def _to_series(seg_start: int, records):
+        series = np.empty(len(records), dtype=SERIES_DTYPE)
+        series['t'] = seg_start + records['t'] / 1000.0
+        series['flags'] = records['flags']
+        series['slow_age'] = records['slow_age'] / 10.0
+        series['words'] = records['words']
+        return series
+
+    def metrics(self) -> Dict:
+        segments = self.segments()
+        return dict(
+            self._stats,
+            recording=self._thread is not None,
+            queued=self._queue.qsize(),
+            segments=len(segments),
+            bytes=sum(os.path.getsize(path) for path in segments),
+        )
+
+
+def _ms(seconds):
+    """Epoch seconds (scalar or array) as whole epoch milliseconds"""
+    return np.round(np.asarray(seconds, dtype=np.float64) * 1000).astype(np.int64)
+
+
+# Singleton instance for Django integration
+_store_instance = None
+_store_lock = threading.Lock()
+
+def get_telemetry_store() -> TelemetryStore:
+    """Get singleton telemetry store instance"""
+    global _store_instance
+
+    if _store_instance is None:
+        with _store_lock:
+            if _store_instance is None:
+                _store_instance = TelemetryStore()
+
+    return _store_instance
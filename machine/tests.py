@@ -1,3 +1,1192 @@
-from django.test import TestCase
+import io
+import os
+import csv
+import json
+import random
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from unittest import skipUnless, mock
+from channels.testing import WebsocketCommunicator
+from django.db import connection
+from django.db.models import Q
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from . import services, views_async
+from .aggregates import rebuild_delivery_stats, update_delivery_stats
+from .coffee_machine import LaSpazialeCoffeeMachine
+from .db import apply_pragmas, configure_sqlite
+from .consumers import MachineConsumer
+from .dispatcher import OrderDispatcher
+from .duration_stats import DurationModel, P2Quantile, RunningStats
+from .export import EXPORTS, export_chunks, pa
+from .health import HealthRecorder, compact_health_logs, health_message
+from .idempotency import IdempotencyKeyReused, IdempotencyStore
+from .journal import (KIND_DELIVERY, KIND_WRITE, RECORD_SIZE, RESULT_ERROR, RESULT_FAILED, RESULT_OK,
+                      CommandJournal, JournalRecord)
+from .maintenance import purge_old_rows
+from .pagination import decode_cursor, encode_cursor, keyset_chunks
+from .models import CoffeeDelivery, CoffeeOrder, DailyDeliveryStats, HealthCheckSummary, MaintenanceLog
+from .poller import MachineSnapshot, StatusPoller
+from .renderers import accepts_msgpack, msgpack
+from .telemetry import FLAG_HEARTBEAT, FLAG_RESUMED, TelemetryStore, np
+from .tracker import DeliveryTracker
+from .views_stream import _StreamState
+from .writebehind import WriteBehindBuffer
 
-# Create your tests here.
+if np is not None:
+    from .downsample import duty_cycle, lttb, runs
+
+
+def snapshot(groups=2, selections=(), countdown=3600, **kwargs):
+    """A snapshot of a machine with ``groups`` groups, purges far away and the given selection words"""
+    words = [0] * 15
+    words[:len(selections)] = selections
+    words[8:12] = [countdown] * 4
+    words[14] = groups
+    return MachineSnapshot(words, **kwargs)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN output is SQLite specific')
+class QueryPlanTests(TestCase):
+    """The hot queries are answered from an index, without a table scan or sort"""
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(f'USING INDEX {index_name}', plan)
+        self.assertNotIn('USE TEMP B-TREE', plan)
+        for table in (CoffeeDelivery._meta.db_table, MaintenanceLog._meta.db_table):
+            self.assertNotIn(f'SCAN {table}\n', plan + '\n')
+
+    def test_stop_delivery_lookup(self):
+        queryset = CoffeeDelivery.objects.filter(group_number=1, status='in_progress')
+        self.assertUsesIndex(queryset, 'delivery_group_status_idx')
+
+    def test_tracker_completion_lookup(self):
+        queryset = CoffeeDelivery.objects.filter(
+            group_number=2, status='in_progress', started_at__lte=datetime(2026, 1, 1),
+        )
+        self.assertUsesIndex(queryset, 'delivery_group_status_idx')
+
+    def test_delivery_history_page(self):
+        queryset = CoffeeDelivery.objects.order_by('-started_at', '-id')
+        self.assertUsesIndex(queryset[:51], 'delivery_started_idx')
+        # Next page after a cursor, as built by pagination.keyset_page()
+        position = datetime(2026, 1, 1)
+        after_cursor = queryset.filter(Q(started_at__lt=position) | Q(started_at=position, id__lt=1000))
+        self.assertUsesIndex(after_cursor[:51], 'delivery_started_idx')
+
+    def test_duration_warmup(self):
+        queryset = CoffeeDelivery.objects.filter(
+            status='completed', duration__isnull=False, completed_at__lt=datetime(2026, 1, 1),
+        ).order_by('-completed_at')[:500]
+        self.assertUsesIndex(queryset, 'delivery_status_done_idx')
+
+    def test_maintenance_logs(self):
+        queryset = MaintenanceLog.objects.order_by('-timestamp', '-id')
+        self.assertUsesIndex(queryset[:50], 'maintlog_timestamp_idx')
+        self.assertUsesIndex(queryset.filter(log_type='purge')[:50], 'maintlog_type_time_idx')
+        self.assertUsesIndex(MaintenanceLog.objects.filter(resolved=False), 'maintlog_unresolved_idx')
+
+
+@override_settings(DELIVERY_RETENTION_DAYS=365)
+class DeliveryRetentionTests(TestCase):
+    """Deliveries removed by retention stay in the daily stats, also after a rebuild"""
+
+    def deliver(self, days_ago, status='completed'):
+        return CoffeeDelivery.objects.create(coffee_type='single_short', group_number=1, status=status,
+                                             started_at=timezone.now() - timedelta(days=days_ago), duration=20.0)
+
+    def daily_counts(self):
+        return {row.date: row.count for row in DailyDeliveryStats.objects.filter(status='completed')}
+
+    def test_rebuild_after_retention(self):
+        old = [self.deliver(400), self.deliver(400), self.deliver(390)]
+        self.deliver(10)
+        update_delivery_stats()
+        counts = self.daily_counts()
+
+        purge_old_rows(names=['deliveries'])
+        self.assertEqual(CoffeeDelivery.objects.filter(id__in=[d.id for d in old]).count(), 0)
+        rebuild_delivery_stats()
+        self.assertEqual(self.daily_counts(), counts)
+
+    def test_uncounted_delivery_holds_retention_back(self):
+        oldest = self.deliver(400)
+        self.deliver(395, status='in_progress')
+        kept = self.deliver(390)
+        update_delivery_stats()
+        counts = self.daily_counts()
+
+        purge_old_rows(names=['deliveries'])
+        self.assertFalse(CoffeeDelivery.objects.filter(id=oldest.id).exists())
+        self.assertTrue(CoffeeDelivery.objects.filter(id=kept.id).exists())
+        rebuild_delivery_stats()
+        self.assertEqual(self.daily_counts(), counts)
+
+
+class OrderQueueTests(TestCase):
+    """Server processes share the order queue through the database (one dispatcher per process)"""
+
+    def setUp(self):
+        self.first, self.second = OrderDispatcher(), OrderDispatcher()
+        self.order = CoffeeOrder.objects.create(coffee_type='single_short')
+        journal = mock.patch('machine.dispatcher.get_command_journal')
+        journal.start()
+        self.addCleanup(journal.stop)
+
+    @mock.patch('machine.dispatcher.get_coffee_machine')
+    def test_order_is_started_once(self, get_machine):
+        deliver = get_machine.return_value.deliver_coffee
+        deliver.return_value = {'success': True, 'message': ''}
+        self.assertTrue(self.first._dispatch(self.order.id, 'single_short', 1))
+        self.assertIsNone(self.second._dispatch(self.order.id, 'single_short', 2))
+        deliver.assert_called_once_with(1, 'single_short')
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.status, self.order.group_number), ('dispatched', 1))
+        self.assertEqual(CoffeeDelivery.objects.get(id=self.order.delivery_id).status, 'in_progress')
+
+    @mock.patch('machine.dispatcher.get_coffee_machine')
+    def test_failed_start_returns_to_the_queue(self, get_machine):
+        get_machine.return_value.deliver_coffee.return_value = {'success': False, 'message': 'Group busy'}
+        self.assertFalse(self.first._dispatch(self.order.id, 'single_short', 1))
+        self.assertEqual(self.second._queued(), [(self.order.id, 'single_short')])
+        self.assertFalse(CoffeeDelivery.objects.exists())  # Only deliveries that started are history
+
+    @mock.patch('machine.dispatcher.get_coffee_machine')
+    def test_snapshot_is_dispatched_off_the_poller_thread(self, get_machine):
+        get_machine.return_value.deliver_coffee.return_value = {'success': True, 'message': ''}
+        idle = snapshot()
+        with self.assertNumQueries(0):
+            self.first.observe(idle)
+        self.first.dispatch(idle)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'dispatched')
+
+    def test_cancel_from_another_process(self):
+        self.assertEqual(self.first._queued(), [(self.order.id, 'single_short')])
+        self.assertTrue(self.second.cancel(self.order.id))
+        self.assertFalse(self.first.cancel(self.order.id))
+        self.assertEqual(self.first._queued(), [])
+
+    def test_orders_claimed_by_a_dead_process_fail(self):
+        CoffeeOrder.objects.filter(id=self.order.id).update(
+            status='dispatching', dispatched_at=timezone.now() - timedelta(minutes=5))
+        self.first._recover(0.0)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'failed')
+
+
+class IdempotencyStoreTests(TestCase):
+    """A retried command key is honoured by every server process (one store per process)"""
+
+    def setUp(self):
+        self.first, self.second = IdempotencyStore(), IdempotencyStore()
+        self.runs = 0
+
+    def command(self):
+        self.runs += 1
+        return {'success': True, 'delivery_id': 7, 'started_at': datetime(2026, 1, 1)}
+
+    def test_retry_on_another_process_is_replayed(self):
+        result, replayed = self.first.execute('order-1', ('deliver', 1, 'single_short'), self.command)
+        self.assertFalse(replayed)
+        result, replayed = self.second.execute('order-1', ('deliver', 1, 'single_short'), self.command)
+        self.assertTrue(replayed)
+        self.assertEqual(self.runs, 1)
+        self.assertEqual(result['delivery_id'], 7)
+
+    def test_key_reused_for_another_command(self):
+        self.first.execute('order-1', ('deliver', 1, 'single_short'), self.command)
+        with self.assertRaises(IdempotencyKeyReused):
+            self.second.execute('order-1', ('deliver', 2, 'single_short'), self.command)
+
+    def test_failed_command_can_be_retried(self):
+        def fail():
+            raise RuntimeError('bus error')
+        with self.assertRaises(RuntimeError):
+            self.first.execute('order-1', ('deliver', 1, 'single_short'), fail)
+        self.assertFalse(self.second.execute('order-1', ('deliver', 1, 'single_short'), self.command)[1])
+        self.assertEqual(self.runs, 1)
+
+
+@skipUnless(np is not None, 'Reading telemetry requires numpy')
+class TelemetryStoreTests(TestCase):
+    """Snapshots written to hourly segments read back by time range"""
+
+    HOUR = 1767225600  # 2026-01-01 00:00 UTC
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.store = TelemetryStore(directory=directory, heartbeat=60, enabled=True)
+        self.addCleanup(self.store._close_segment)
+
+    def record(self, epoch, selection=0, countdown=0, slow_age=0.0):
+        words = [0] * 15
+        words[0], words[8], words[14] = selection, countdown, 1
+        self.store._record(epoch, tuple(words), slow_age)
+
+    def test_changes_and_heartbeats_are_recorded(self):
+        self.record(self.HOUR, countdown=5, slow_age=1.5)
+        self.record(self.HOUR + 10, countdown=5)   # Unchanged within the heartbeat: skipped
+        self.record(self.HOUR + 30, countdown=4)
+        self.record(self.HOUR + 100, countdown=4)  # Unchanged for a heartbeat
+        records = self.store.read(self.HOUR, self.HOUR + 3600)
+        self.assertEqual(records['t'].tolist(), [self.HOUR, self.HOUR + 30, self.HOUR + 100])
+        self.assertEqual(records['flags'].tolist(), [FLAG_RESUMED, 0, FLAG_HEARTBEAT])
+        self.assertEqual(records['words'][:, 8].tolist(), [5, 4, 4])
+        self.assertEqual(records['slow_age'].tolist(), [1.5, 0.0, 0.0])
+        self.assertEqual(self.store.metrics()['records'], 3)
+
+    def test_every_segment_starts_with_the_full_state(self):
+        self.record(self.HOUR + 3590, countdown=1)
+        self.record(self.HOUR + 3605, countdown=1)
+        self.assertEqual(len(self.store.segments()), 2)
+        # Written although unchanged: the second segment reads on its own
+        self.assertEqual([len(self.store.load_segment(path)) for path in self.store.segments()], [1, 1])
+        records = self.store.read(self.HOUR + 3600, self.HOUR + 7200)
+        self.assertEqual(records['t'].tolist(), [self.HOUR + 3590, self.HOUR + 3605])
+        self.assertEqual(records['flags'].tolist(), [FLAG_RESUMED, 0])
+
+    def test_read_before_any_record_is_empty(self):
+        self.assertEqual(len(self.store.read(self.HOUR, self.HOUR + 60)), 0)
+        self.record(self.HOUR + 120, countdown=1)
+        self.assertEqual(len(self.store.read(self.HOUR, self.HOUR + 60)), 0)
+        # A range after the last record is led by it
+        self.assertEqual(self.store.read(self.HOUR + 200, self.HOUR + 300)['t'].tolist(), [self.HOUR + 120])
+
+    def test_read_maps_only_the_segments_of_the_range(self):
+        for hour in range(4):
+            self.record(self.HOUR + hour * 3600 + 10, countdown=hour + 1)
+        loaded = []
+        load_segment = self.store.load_segment
+        with mock.patch.object(self.store, 'load_segment', side_effect=lambda path: loaded.append(path) or
+                               load_segment(path)):
+            records = self.store.read(self.HOUR + 2 * 3600 + 30, self.HOUR + 3 * 3600 + 20)
+        self.assertEqual([os.path.basename(path) for path in loaded], ['01.tlm', '02.tlm', '03.tlm'])
+        # Led by the record in effect at start (from the segment before), then the one in range
+        self.assertEqual(records['words'][:, 8].tolist(), [3, 4])
+        self.assertEqual(records['t'].tolist(), [self.HOUR + 2 * 3600 + 10, self.HOUR + 3 * 3600 + 10])
+
+    def test_silences_are_gaps(self):
+        self.record(self.HOUR, selection=1)
+        self.record(self.HOUR + 600)  # Nothing recorded for longer than two heartbeats
+        series = self.store.series(self.HOUR, self.HOUR + 700, fields=['busy_1'], points=100)
+        ms = 1000 * self.HOUR
+        self.assertEqual(series['series']['busy_1'], {'type': 'intervals', 'intervals': [[ms, ms + 120000]]})
+        self.assertEqual(series['gaps'], [[ms + 120000, ms + 600000]])
+
+    def test_many_runs_become_a_duty_cycle(self):
+        for step in range(20):
+            self.record(self.HOUR + 10 * step, selection=step % 2 == 0)
+        busy = self.store.series(self.HOUR, self.HOUR + 200, fields=['busy_1'], points=3)['series']['busy_1']
+        self.assertEqual(busy['type'], 'duty')
+        self.assertEqual(len(busy['points']), 3)
+        self.assertTrue(all(40 <= percent <= 60 for _, percent in busy['points']))
+
+    def test_countdowns_run_down_between_reads(self):
+        self.record(self.HOUR, countdown=100)
+        line = self.store.series(self.HOUR, self.HOUR + 30, fields=['countdown_1'])['series']['countdown_1']
+        self.assertEqual(line['points'], [[1000 * self.HOUR, 100], [1000 * (self.HOUR + 30), 70]])
+
+    def test_bad_requests_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.store.series(self.HOUR, self.HOUR + 60, fields=['pressure'])
+        with self.assertRaises(ValueError):
+            self.store.series(time.time() + 3600, time.time() + 7200)
+
+
+@skipUnless(np is not None, 'Downsampling requires numpy')
+class DownsampleTests(SimpleTestCase):
+    """Series are thinned for charts without losing peaks, runs or gaps"""
+
+    def test_lttb_keeps_the_ends_and_peaks(self):
+        y = np.zeros(100)
+        y[37] = 50
+        kept = lttb(np.arange(100.0), y, 10)
+        self.assertEqual(len(kept), 10)
+        self.assertEqual((kept[0], kept[-1]), (0, 99))
+        self.assertIn(37, kept)
+        self.assertTrue((np.diff(kept) > 0).all())
+        self.assertEqual(lttb(np.arange(5.0), np.zeros(5), 10).tolist(), [0, 1, 2, 3, 4])
+
+    def test_runs_end_at_gaps(self):
+        begins, ends = runs(np.array([0.0, 10, 20, 30, 40]), np.array([10.0, 20, 25, 40, 50]),
+                            np.array([True, True, True, True, False]))
+        self.assertEqual((begins.tolist(), ends.tolist()), ([0, 30], [25, 40]))
+
+    def test_duty_cycle_splits_runs_across_buckets(self):
+        edges = np.array([0.0, 10, 20])
+        self.assertEqual(duty_cycle(np.array([0.0, 15]), np.array([5.0, 20]), edges).tolist(), [0.5, 0.5])
+        self.assertEqual(duty_cycle(np.array([5.0]), np.array([15.0]), edges).tolist(), [0.5, 0.5])
+        self.assertEqual(duty_cycle(np.empty(0), np.empty(0), edges).tolist(), [0, 0])
+
+
+class SnapshotCountdownTests(TestCase):
+    """Purge countdowns run down between slow reads of the machine"""
+
+    def test_countdown_is_extrapolated_from_the_slow_read(self):
+        taken = snapshot(countdown=100)
+        taken.slow_monotonic = taken.monotonic - 30
+        self.assertEqual(taken.purge_countdown(1, taken.monotonic), 70)
+        self.assertEqual(taken.to_status(now=taken.monotonic + 5)['groups']['group_2']['purge_countdown'], 65)
+        self.assertEqual(taken.purge_countdown(1, taken.monotonic + 500), 0)
+
+    def test_countdown_tick_changes_with_the_body(self):
+        taken = snapshot(countdown=100)
+        self.assertEqual(taken.countdown_tick(taken.monotonic + 1.5), 1)
+        self.assertNotEqual(taken.countdown_tick(taken.monotonic + 2.5), taken.countdown_tick(taken.monotonic + 1.5))
+        self.assertIsNone(taken.countdown_tick(taken.monotonic + 100))  # Ran out: the body stops changing
+        self.assertIsNone(snapshot(countdown=0).countdown_tick())
+
+
+class DeferredStopTests(TestCase):
+    """The stop UPDATE is written behind, after deliveries may have started again"""
+
+    @mock.patch('machine.services.get_write_buffer')
+    @mock.patch('machine.services.get_coffee_machine')
+    def test_deferred_stop_leaves_newer_deliveries_open(self, get_machine, get_buffer):
+        get_machine.return_value.stop_delivery.return_value = True
+        stopped = CoffeeDelivery.objects.create(coffee_type='single_short', group_number=1, status='in_progress')
+        services.stop_delivery(1)
+        started_after = CoffeeDelivery.objects.create(coffee_type='single_long', group_number=1, status='in_progress')
+
+        model, filters = get_buffer.return_value.update.call_args.args
+        model.objects.filter(**filters).update(**get_buffer.return_value.update.call_args.kwargs)
+        self.assertEqual(CoffeeDelivery.objects.get(id=stopped.id).status, 'stopped')
+        self.assertEqual(CoffeeDelivery.objects.get(id=started_after.id).status, 'in_progress')
+
+
+class CommandFrameTests(TestCase):
+    """Batched command writes share Modbus frames, padded only with registers the machine has"""
+
+    NO_ACTION = LaSpazialeCoffeeMachine.COMMANDS['NO_ACTION']
+
+    def setUp(self):
+        self.machine = LaSpazialeCoffeeMachine(port='/dev/null')
+        self.machine.client = mock.Mock()
+        self.machine.client.write_registers.return_value.isError.return_value = False
+        self.machine.is_connected = True
+
+    def test_gaps_are_padded_with_existing_groups_only(self):
+        writes = {512: 128, 514: 2, 516: 1}
+        self.assertEqual(self.machine.plan_command_frames(writes, 3), [(512, [128, self.NO_ACTION, 2]), (516, [1])])
+        self.assertEqual(self.machine.plan_command_frames(writes, 4),
+                         [(512, [128, self.NO_ACTION, 2, self.NO_ACTION, 1])])
+
+    def test_water_and_mat_are_never_padded(self):
+        self.assertEqual(self.machine.plan_command_frames({512: 128, 517: 1}, 4), [(512, [128]), (517, [1])])
+
+    @mock.patch('machine.coffee_machine.get_command_journal')
+    def test_padding_is_not_journaled(self, get_journal):
+        results = self.machine.send_commands({512: 128, 514: 2}, number_of_groups=2)
+        self.assertEqual(results, {512: True, 514: True})
+        self.machine.client.write_registers.assert_called_once_with(
+            address=512, values=[128, self.NO_ACTION, 2], slave=self.machine.node_address)
+        journaled = [call.args[:2] for call in get_journal.return_value.record_write.call_args_list]
+        self.assertEqual(journaled, [(512, 128), (514, 2)])
+
+
+class DeliveryTrackerTests(TestCase):
+    """Group state transitions open and close delivery rows"""
+
+    def setUp(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+        self.tracker = DeliveryTracker(batch_size=100, flush_interval=3600, lock_dir=lock_dir)
+        self.started = timezone.now()
+        self.observe(0)  # Every group idle
+
+    def observe(self, seconds, selections=()):
+        taken = snapshot(selections=selections)
+        taken.taken_at = self.started + timedelta(seconds=seconds)
+        self.tracker.observe(taken)
+
+    def test_api_delivery_is_closed_when_its_group_goes_idle(self):
+        delivery = CoffeeDelivery.objects.create(coffee_type='single_short', group_number=1, status='in_progress')
+        self.observe(1, [0x0001])
+        self.observe(26)
+        self.tracker.flush()
+        delivery.refresh_from_db()
+        self.assertEqual((delivery.status, delivery.duration), ('completed', 25.0))
+        self.assertEqual(CoffeeDelivery.objects.count(), 1)  # The start was the API delivery's
+
+    def test_open_rows_left_by_a_restart_are_closed(self):
+        left = CoffeeDelivery.objects.create(coffee_type='single_short', group_number=2, status='in_progress',
+                                             started_at=self.started - timedelta(minutes=10))
+        self.tracker._last_reconcile = None  # As on the first snapshot
+        self.observe(1)
+        left.refresh_from_db()
+        self.assertEqual(left.status, 'failed')
+
+    def test_panel_delivery_is_recorded(self):
+        self.observe(1, [0, 0x0020])
+        self.tracker.flush()
+        delivery = CoffeeDelivery.objects.get()
+        self.assertEqual((delivery.source, delivery.group_number, delivery.coffee_type, delivery.status),
+                         ('panel', 2, 'single_medium', 'in_progress'))
+        self.observe(31)
+        self.tracker.flush()
+        delivery.refresh_from_db()
+        self.assertEqual((delivery.status, delivery.duration), ('completed', 30.0))
+
+    def test_purge_is_not_a_delivery(self):
+        self.observe(1, [0x0080])
+        self.tracker.flush()
+        self.assertFalse(CoffeeDelivery.objects.exists())
+
+    def test_panel_start_is_recorded_once(self):
+        self.observe(1, [0x0001])
+        self.tracker.flush()
+        # A retried flush, or a previous owner of the lock that saw the start one poll later
+        seen_again = self.started + timedelta(seconds=2)
+        self.assertEqual(self.tracker._record_started([(1, seen_again, 0x0001)]), 0)
+        self.assertEqual(CoffeeDelivery.objects.filter(source='panel').count(), 1)
+
+    def test_one_process_records_deliveries(self):
+        other = DeliveryTracker(lock_dir=self.tracker.lock_dir)
+        self.assertTrue(self.tracker.acquire())
+        self.assertFalse(other.acquire())
+
+
+class PollIntervalTests(TestCase):
+    """The poll rate follows what the machine is doing and who is watching"""
+
+    def setUp(self):
+        machine = mock.patch('machine.poller.get_coffee_machine')
+        machine.start().return_value.is_connected = True
+        self.addCleanup(machine.stop)
+        self.poller = StatusPoller(interval=1.0, min_interval=0.2, max_interval=5.0, command_boost=10.0,
+                                   heartbeat_interval=60.0, demand_window=30.0)
+        self.poller.snapshot = snapshot()
+        self.poller.touch()  # An API read: idle rate, not heartbeat
+
+    def test_idle(self):
+        self.assertEqual(self.poller.next_interval(), (5.0, 'idle'))
+
+    def test_fast_during_a_delivery(self):
+        self.poller.snapshot = snapshot(selections=[0, 0x0004])
+        self.assertEqual(self.poller.next_interval(), (0.2, 'delivery'))
+
+    def test_fast_after_a_command(self):
+        self.poller._on_command_sent(sender=None)
+        self.assertEqual(self.poller.next_interval(), (0.2, 'command'))
+        self.poller._last_command -= 11
+        self.assertEqual(self.poller.next_interval(), (5.0, 'idle'))
+
+    def test_slow_while_disconnected(self):
+        with mock.patch('machine.poller.get_coffee_machine') as machine:
+            machine.return_value.is_connected = False
+            self.assertEqual(self.poller.next_interval(), (5.0, 'disconnected'))
+
+    def test_heartbeat_when_nobody_is_watching(self):
+        self.poller._last_read -= 31
+        self.assertEqual(self.poller.next_interval(), (60.0, 'heartbeat'))
+
+    def test_subscribers_keep_the_normal_rate(self):
+        self.poller._last_read -= 31
+        subscriber = mock.Mock()
+        self.poller.subscribe(subscriber)
+        self.assertEqual(self.poller.next_interval(), (1.0, 'subscribers'))
+        self.poller.unsubscribe(subscriber)
+        self.assertEqual(self.poller.next_interval(), (60.0, 'heartbeat'))
+
+    def test_api_read_wakes_a_heartbeat_poller(self):
+        self.poller.reason = 'heartbeat'
+        self.poller._wake_event.clear()
+        self.poller.touch()
+        self.assertTrue(self.poller._wake_event.is_set())
+
+
+class TieredPollTests(TestCase):
+    """Selections are read on every poll, the slow registers only when due"""
+
+    def setUp(self):
+        self.machine = mock.Mock(is_connected=True)
+        self.machine.get_number_of_groups.return_value = 2
+        self.machine.get_serial_number.return_value = 'S50'
+        self.machine.get_firmware_version.return_value = '1.0'
+        self.selections = [0, 0]
+        self.machine.read_register_block.side_effect = self.read_block
+        patcher = mock.patch('machine.poller.get_coffee_machine', return_value=self.machine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.poller = StatusPoller(slow_interval=30.0)
+
+    def read_block(self, first, last):
+        if first == 'SENSOR_FAULT_GROUP_1':
+            return [0, 0, 0, 0, 120, 90, 0, 0, 0, 0]
+        return list(self.selections)
+
+    def slow_reads(self):
+        return [call for call in self.machine.read_register_block.call_args_list if call.args[0] == 'SENSOR_FAULT_GROUP_1']
+
+    def test_slow_registers_are_read_when_due(self):
+        first = self.poller.poll_once()
+        second = self.poller.poll_once()
+        self.assertEqual(len(self.slow_reads()), 1)
+        self.assertEqual(second.slow_monotonic, first.slow_monotonic)
+        # The countdown keeps running down from the slow read
+        self.assertEqual(second.purge_countdown(1, first.slow_monotonic + 20), 100)
+
+    def test_group_state_change_rereads_the_countdowns(self):
+        self.poller.poll_once()
+        self.selections = [0x0001, 0]
+        self.poller.poll_once()
+        self.poller.poll_once()
+        self.assertEqual(len(self.slow_reads()), 2)
+
+
+class StatusStreamTests(TestCase):
+    """A resumed stream sends the groups that changed since the client's last event"""
+
+    def setUp(self):
+        self.old = snapshot(selections=[0, 0])
+        self.old.version = 1
+        self.new = snapshot(selections=[0, 0x0001])
+        self.new.version = 2
+        self.poller = mock.Mock()
+        self.poller.snapshot_at.side_effect = lambda version: self.old if version == 1 else None
+
+    def parse(self, event):
+        lines = dict(line.split(': ', 1) for line in event.strip().split('\n'))
+        return lines['event'], int(lines['id']), json.loads(lines['data'])
+
+    def test_new_stream_opens_with_every_group(self):
+        name, version, data = self.parse(_StreamState(self.poller, None).opening(self.new))
+        self.assertEqual((name, version), ('snapshot', 2))
+        self.assertEqual(sorted(data['groups']), ['group_1', 'group_2'])
+
+    def test_resumed_stream_sends_the_changed_groups(self):
+        name, version, data = self.parse(_StreamState(self.poller, '1').opening(self.new))
+        self.assertEqual((name, version), ('groups', 2))
+        self.assertEqual(list(data['groups']), ['group_2'])
+        self.assertTrue(data['groups']['group_2']['is_busy'])
+
+    def test_resume_at_the_current_version_sends_nothing(self):
+        self.poller.snapshot_at.side_effect = lambda version: self.new
+        self.assertIsNone(_StreamState(self.poller, '2').opening(self.new))
+
+    def test_resume_from_a_forgotten_version_starts_over(self):
+        name, _, _ = self.parse(_StreamState(self.poller, '0').opening(self.new))
+        self.assertEqual(name, 'snapshot')
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class MachineConsumerTests(SimpleTestCase):
+    """Dashboard sockets get the status and command results, and send commands"""
+
+    def setUp(self):
+        for target in ('machine.consumers.get_status_broadcaster', 'machine.consumers.get_status_poller'):
+            patcher = mock.patch(target)
+            patcher.start().return_value.get_status.return_value = {'groups': {}}
+            self.addCleanup(patcher.stop)
+        self.deliver = mock.Mock(return_value={'success': True, 'delivery_id': 3})
+        patcher = mock.patch.dict('machine.consumers.COMMANDS', {
+            'deliver': (self.deliver, ('group_number', 'coffee_type', 'client_order_id'))})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(MachineConsumer.as_asgi(), '/ws/machine/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(await communicator.receive_json_from(), {
+            'type': 'snapshot', 'data': {'groups': {}, 'connection_status': True}})
+        return communicator
+
+    async def test_command_result_goes_to_every_dashboard(self):
+        sender, other = await self.connect(), await self.connect()
+        await sender.send_json_to({'action': 'deliver', 'group_number': 1, 'coffee_type': 'single_short',
+                                   'request_id': 'r1'})
+        reply = await sender.receive_json_from()
+        self.assertEqual((reply['type'], reply['request_id'], reply['result']['delivery_id']),
+                         ('command_result', 'r1', 3))
+        self.deliver.assert_called_once_with(1, 'single_short', None)
+        self.assertEqual(await other.receive_json_from(), reply)
+        self.assertTrue(await sender.receive_nothing())
+        await sender.disconnect()
+        await other.disconnect()
+
+    async def test_replayed_command_is_not_broadcast(self):
+        self.deliver.return_value = {'success': True, 'delivery_id': 3, 'replayed': True}
+        sender, other = await self.connect(), await self.connect()
+        await sender.send_json_to({'action': 'deliver', 'group_number': 1, 'coffee_type': 'single_short',
+                                   'client_order_id': 'order-1'})
+        self.assertTrue((await sender.receive_json_from())['result']['replayed'])
+        self.assertTrue(await other.receive_nothing())
+        await sender.disconnect()
+        await other.disconnect()
+
+    async def test_invalid_commands_get_an_error(self):
+        communicator = await self.connect()
+        await communicator.send_json_to({'action': 'brew', 'request_id': 'r2'})
+        self.assertEqual(await communicator.receive_json_from(),
+                         {'type': 'error', 'request_id': 'r2', 'message': 'Unknown action: brew'})
+        self.deliver.side_effect = ValueError('Invalid group number')
+        await communicator.send_json_to({'action': 'deliver', 'group_number': 9})
+        self.assertEqual((await communicator.receive_json_from())['message'], 'Invalid group number')
+        await communicator.disconnect()
+
+    async def test_status_action_sends_a_snapshot(self):
+        communicator = await self.connect()
+        await communicator.send_json_to({'action': 'status'})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'snapshot')
+        await communicator.disconnect()
+
+
+class StatusETagTests(TestCase):
+    """Status reads are revalidated against the snapshot version"""
+
+    def setUp(self):
+        self.snapshot = snapshot(countdown=0)
+        self.snapshot.version = 7
+        machine = mock.patch('machine.views.get_coffee_machine')
+        machine.start().return_value.is_connected = True
+        self.addCleanup(machine.stop)
+        poller = mock.patch('machine.views.get_status_poller')
+        poller.start().return_value.current.side_effect = lambda: self.snapshot
+        self.addCleanup(poller.stop)
+
+    def test_unchanged_status_is_not_sent_again(self):
+        response = self.client.get('/api/status/')
+        self.assertEqual((response.status_code, response['ETag']), (200, '"7"'))
+        self.assertEqual(response.json()['version'], 7)
+        response = self.client.get('/api/status/', HTTP_IF_NONE_MATCH='"7"')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_new_version_is_sent(self):
+        self.snapshot.version = 8
+        response = self.client.get('/api/status/', HTTP_IF_NONE_MATCH='"7"')
+        self.assertEqual((response.status_code, response['ETag']), (200, '"8"'))
+
+    def test_raw_format_has_its_own_etag(self):
+        response = self.client.get('/api/status/?format=raw')
+        self.assertEqual(response['ETag'], '"7-raw"')
+        self.assertEqual(response.json()['words'], self.snapshot.words)
+
+    def test_running_countdown_is_part_of_the_etag(self):
+        self.snapshot = snapshot(countdown=100)
+        self.snapshot.version = 7
+        self.assertRegex(self.client.get('/api/status/')['ETag'], r'^"7-t\d+"$')
+
+
+class AsyncViewTests(TestCase):
+    """The ASGI views answer from a fresh snapshot on the event loop and run commands in the bus thread"""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.snapshot = snapshot(countdown=0)
+        self.snapshot.version = 7
+        machine = mock.patch('machine.views_async.get_coffee_machine')
+        machine.start().return_value.is_connected = True
+        self.addCleanup(machine.stop)
+        poller = mock.patch('machine.views_async.get_status_poller')
+        self.poller = poller.start().return_value
+        self.addCleanup(poller.stop)
+        self.poller.snapshot = self.snapshot
+        self.poller.is_fresh.return_value = True
+        self.poller.snapshot_at.return_value = self.snapshot
+
+    async def test_fresh_status_is_served_without_a_bus_read(self):
+        response = await views_async.machine_status(self.factory.get('/api/status/'))
+        self.assertEqual((response.status_code, response['ETag']), (200, '"7"'))
+        self.assertEqual(json.loads(response.content)['version'], 7)
+        self.poller.current.assert_not_called()
+        response = await views_async.machine_status(self.factory.get('/api/status/', HTTP_IF_NONE_MATCH='"7"'))
+        self.assertEqual(response.status_code, 304)
+
+    async def test_stale_status_is_read_in_the_bus_thread(self):
+        self.poller.is_fresh.return_value = False
+        self.poller.current.return_value = self.snapshot
+        response = await views_async.machine_status(self.factory.get('/api/status/'))
+        self.assertEqual(response.status_code, 200)
+        self.poller.current.assert_called_once_with()
+
+    async def test_status_only_answers_get(self):
+        response = await views_async.machine_status(self.factory.post('/api/status/'))
+        self.assertEqual(response.status_code, 405)
+
+    @mock.patch('machine.views_raw.services.stop_delivery', return_value={'success': True, 'message': 'Stop command sent', 'group': 2})
+    async def test_commands_run_the_sync_view(self, stop_delivery):
+        self.assertTrue(views_async.stop_delivery.csrf_exempt)
+        request = self.factory.post('/api/stop/', data='{"group_number": 2}', content_type='application/json')
+        response = await views_async.stop_delivery(request)
+        self.assertEqual(response.status_code, 200)
+        stop_delivery.assert_called_once_with(2)
+
+
+class DurationModelTests(TestCase):
+    """Delivery durations are summarized in O(1) memory and fall back when samples are few"""
+
+    def test_p2_quantiles_track_the_sorted_data(self):
+        rng = random.Random(38)
+        values = [rng.gauss(25, 4) for _ in range(5000)]
+        ordered = sorted(values)
+        for p in (0.5, 0.9):
+            quantile = P2Quantile(p)
+            for value in values:
+                quantile.add(value)
+            self.assertAlmostEqual(quantile.value, ordered[int(p * (len(ordered) - 1))], delta=0.3)
+
+    def test_quantile_of_a_few_samples_is_exact(self):
+        quantile = P2Quantile(0.5)
+        for value in (30, 10, 20):
+            quantile.add(value)
+        self.assertEqual(quantile.value, 20)
+
+    def test_running_moments(self):
+        values = [20.5, 22.0, 31.0, 24.5, 26.0]
+        moments = RunningStats()
+        for value in values:
+            moments.add(value)
+        self.assertAlmostEqual(moments.mean, statistics.mean(values))
+        self.assertAlmostEqual(moments.stddev, statistics.stdev(values))
+        self.assertEqual((moments.min, moments.max), (20.5, 31.0))
+
+    @override_settings(DELIVERY_EXPECTED_DURATIONS={'single_short': 20})
+    def test_expected_duration_falls_back_from_group_to_machine_to_settings(self):
+        model = DurationModel(min_samples=3)
+        self.assertEqual(model.expected('single_short', 1), 20.0)
+        for duration in (30, 32, 34):
+            model.observe(2, 'single_short', duration)
+        self.assertEqual(model.expected('single_short', 1), 32.0)  # Machine-wide median
+        for duration in (40, 41):
+            model.observe(1, 'single_short', duration)
+        self.assertEqual(model.expected('single_short', 1), 34.0)  # Still machine-wide: 2 samples on group 1
+        model.observe(1, 'single_short', 42)
+        self.assertEqual(model.expected('single_short', 1), 41.0)
+
+    def test_model_is_warmed_up_from_history(self):
+        for duration in (21, 23, 25):
+            CoffeeDelivery.objects.create(coffee_type='double_long', group_number=1, status='completed',
+                                          completed_at=timezone.now() - timedelta(minutes=1), duration=duration)
+        self.assertEqual(DurationModel(min_samples=3).expected('double_long', 1), 23.0)
+
+
+class KeysetPaginationTests(TestCase):
+    """History pages continue after the last row seen, however deep, and ties on time are kept apart"""
+
+    def setUp(self):
+        moment = timezone.now().replace(microsecond=0)
+        # Pairs of deliveries started in the same second
+        self.ids = [CoffeeDelivery.objects.create(coffee_type='single_short', group_number=1 + i % 2,
+                                                  status='completed',
+                                                  started_at=moment - timedelta(seconds=i // 2)).id
+                    for i in range(7)]
+
+    def pages(self, url):
+        ids, cursor = [], None
+        while True:
+            data = self.client.get(url + (f'&cursor={cursor}' if cursor else '')).json()
+            ids.extend(row['id'] for row in data['deliveries'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                return ids
+
+    def newest_first(self, **filters):
+        return list(CoffeeDelivery.objects.filter(**filters).order_by('-started_at', '-id')
+                    .values_list('id', flat=True))
+
+    def test_pages_cover_every_row_once_newest_first(self):
+        self.assertEqual(self.pages('/api/history/?limit=3'), self.newest_first())
+
+    def test_filters_apply_to_every_page(self):
+        self.assertEqual(self.pages('/api/history/?limit=2&group=1'), self.newest_first(group_number=1))
+
+    def test_since_id_returns_only_newer_rows(self):
+        latest = self.client.get('/api/history/?limit=50').json()['latest_id']
+        self.assertEqual(latest, max(self.ids))
+        added = CoffeeDelivery.objects.create(coffee_type='single_long', group_number=1, status='in_progress')
+        data = self.client.get(f'/api/history/?since_id={latest}').json()
+        self.assertEqual([row['id'] for row in data['deliveries']], [added.id])
+        self.assertEqual(data['latest_id'], added.id)
+        self.assertEqual(self.client.get(f'/api/history/?since_id={added.id}').json()['latest_id'], added.id)
+
+    def test_bad_cursor_is_rejected(self):
+        self.assertEqual(self.client.get('/api/history/?cursor=nonsense').status_code, 400)
+        self.assertEqual(self.client.get('/api/logs/?limit=0').status_code, 400)
+
+    def test_cursor_round_trip(self):
+        moment = datetime(2026, 1, 2, 3, 4, 5, 678000)
+        self.assertEqual(decode_cursor(encode_cursor(moment, 42)), (moment, 42))
+
+    def test_chunks_cover_every_row_oldest_first(self):
+        chunks = list(keyset_chunks(CoffeeDelivery.objects.all(), 'started_at', ['id', 'started_at'], chunk_size=3))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1])
+        self.assertEqual(sorted(row[0] for chunk in chunks for row in chunk), sorted(self.ids))
+
+
+@skipUnless(msgpack, 'needs msgpack')
+class MessagePackStatusTests(TestCase):
+    """The status is encoded as MessagePack for clients that list it first"""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.snapshot = snapshot(countdown=0)
+        self.snapshot.version = 7
+        machine = mock.patch('machine.views.get_coffee_machine')
+        machine.start().return_value.is_connected = True
+        self.addCleanup(machine.stop)
+        poller = mock.patch('machine.views.get_status_poller')
+        poller.start().return_value.current.side_effect = lambda: self.snapshot
+        self.addCleanup(poller.stop)
+
+    def get(self, path='/api/status/', accept='application/x-msgpack', **headers):
+        return self.client.get(path, HTTP_ACCEPT=accept, **headers)
+
+    def test_status_is_encoded_as_msgpack(self):
+        response = self.get()
+        self.assertEqual((response['Content-Type'], response['ETag']), ('application/x-msgpack', '"7-msgpack"'))
+        self.assertEqual(msgpack.unpackb(response.content), self.client.get('/api/status/').json())
+        self.assertIn('Accept', response['Vary'])
+
+    def test_encodings_do_not_share_etags(self):
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"7-msgpack"').status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"7"').status_code, 200)
+
+    def test_raw_format_is_encoded_too(self):
+        response = self.get('/api/status/?format=raw')
+        self.assertEqual(response['ETag'], '"7-raw-msgpack"')
+        self.assertEqual(msgpack.unpackb(response.content)['words'], self.snapshot.words)
+
+    def test_client_order_picks_the_encoding(self):
+        response = self.get(accept='application/json, application/x-msgpack')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        response = self.get(accept='application/x-msgpack, application/json')
+        self.assertEqual(response['Content-Type'], 'application/x-msgpack')
+
+    def test_accepts_msgpack_reads_the_first_match(self):
+        for accept, expected in [('application/x-msgpack', True), ('application/x-msgpack;q=0.9, */*', True),
+                                 ('*/*, application/x-msgpack', False), ('text/html', False), ('', False)]:
+            with self.subTest(accept=accept):
+                self.assertEqual(accepts_msgpack(self.factory.get('/', HTTP_ACCEPT=accept)), expected)
+
+
+class SQLitePragmaTests(SimpleTestCase):
+    """Every new connection gets the SQLITE_PRAGMAS"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.raw = sqlite3.connect(os.path.join(self.directory, 'db.sqlite3'))
+        self.addCleanup(self.raw.close)
+
+    def pragma(self, name):
+        return self.raw.execute(f'PRAGMA {name}').fetchone()[0]
+
+    def test_pragmas_are_applied_to_a_new_database(self):
+        apply_pragmas(self.raw.cursor())
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual((self.pragma('auto_vacuum'), self.pragma('synchronous'), self.pragma('temp_store')),
+                         (2, 1, 2))
+        self.assertEqual(self.pragma('cache_size'), -8000)
+
+    @override_settings(SQLITE_PRAGMAS={'synchronous': 'full'})
+    def test_pragmas_come_from_the_settings(self):
+        apply_pragmas(self.raw.cursor())
+        self.assertEqual((self.pragma('journal_mode'), self.pragma('synchronous')), ('delete', 2))
+
+    def test_receiver_runs_on_sqlite_connections_only(self):
+        other = mock.Mock(vendor='postgresql')
+        configure_sqlite(None, other)
+        other.cursor.assert_not_called()
+        sqlite = mock.MagicMock(vendor='sqlite')
+        configure_sqlite(None, sqlite)
+        executed = [call.args[0] for call in sqlite.cursor.return_value.__enter__.return_value.execute.call_args_list]
+        self.assertIn('PRAGMA journal_mode = wal', executed)
+
+    def test_failing_pragma_does_not_break_the_connection(self):
+        sqlite = mock.MagicMock(vendor='sqlite')
+        sqlite.cursor.return_value.__enter__.return_value.execute.side_effect = sqlite3.OperationalError('locked')
+        with self.assertLogs('machine', 'ERROR'):
+            configure_sqlite(None, sqlite)
+
+
+@mock.patch('machine.writebehind.threading.Thread')
+class WriteBehindTests(TestCase):
+    """Writes are queued and journaled, flushed in order and replayed after a crash"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def buffer(self, **kwargs):
+        buffer = WriteBehindBuffer(flush_interval=60, batch_size=100, journal_dir=self.directory, enabled=True, **kwargs)
+        buffer.start()
+        self.addCleanup(buffer.stop)
+        return buffer
+
+    def queue_delivery(self, buffer):
+        buffer.insert(CoffeeDelivery(coffee_type='single_short', group_number=2, status='in_progress'))
+        buffer.update(CoffeeDelivery, {'group_number': 2, 'started_at__lte': timezone.now()}, status='stopped')
+
+    def test_writes_wait_for_the_flush(self, thread):
+        buffer = self.buffer()
+        self.queue_delivery(buffer)
+        self.assertFalse(CoffeeDelivery.objects.exists())
+        self.assertEqual(buffer.metrics()['queued'], 2)
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(list(CoffeeDelivery.objects.values_list('status', flat=True)), ['stopped'])
+        buffer.stop()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_stopped_buffer_writes_directly(self, thread):
+        buffer = WriteBehindBuffer(journal_dir=self.directory)
+        self.queue_delivery(buffer)
+        self.assertEqual(list(CoffeeDelivery.objects.values_list('status', flat=True)), ['stopped'])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_journal_of_a_dead_process_is_replayed(self, thread):
+        crashed = self.buffer()
+        self.queue_delivery(crashed)
+        crashed._journal.write('{"op": "ins')  # Torn by the crash
+        crashed._journal.close()
+        crashed._lock_file.close()
+        crashed._thread = None
+
+        self.buffer()._recover()
+        delivery = CoffeeDelivery.objects.get()
+        self.assertEqual((delivery.group_number, delivery.status), (2, 'stopped'))
+        self.assertEqual(len(os.listdir(self.directory)), 2)  # The journal and lock of the new buffer only
+
+    def test_journal_of_a_running_process_is_left_alone(self, thread):
+        running = self.buffer()
+        self.queue_delivery(running)
+        self.buffer()._recover()
+        self.assertFalse(CoffeeDelivery.objects.exists())
+        self.assertEqual(running.flush(), 2)
+
+    def test_failed_flush_keeps_the_writes(self, thread):
+        buffer = self.buffer()
+        self.queue_delivery(buffer)
+        with mock.patch.object(buffer, '_apply', side_effect=RuntimeError('database is locked')), \
+                self.assertLogs('machine', 'ERROR'):
+            self.assertIsNone(buffer.flush())
+        self.assertEqual(buffer.metrics()['queued'], 2)
+        self.assertEqual(buffer.flush(), 2)
+        self.assertTrue(CoffeeDelivery.objects.exists())
+
+
+class HealthRecorderTests(TestCase):
+    """Health checks log status changes only and are counted per day"""
+
+    healthy = {'overall_status': 'healthy', 'connection': True, 'errors': []}
+    faulty = {'overall_status': 'unhealthy', 'connection': True, 'errors': ['Group 1 purge due in 40s']}
+
+    def setUp(self):
+        self.recorder = HealthRecorder(rollup_interval=3600)
+
+    def logged(self):
+        return list(MaintenanceLog.objects.filter(log_type='health_check').order_by('id')
+                    .values_list('message', 'resolved'))
+
+    def test_only_transitions_are_logged(self):
+        results = [self.recorder.record(health) for health in
+                   (self.healthy, self.healthy, self.faulty, dict(self.faulty, errors=['Group 1 purge due in 39s']),
+                    self.healthy)]
+        self.assertEqual(results, [True, False, True, False, True])
+        self.assertEqual(self.logged(), [('Health check - Status: healthy', True),
+                                         ('Health check - Status: unhealthy (Group 1 purge due)', False),
+                                         ('Health check - Status: healthy', True)])
+
+    def test_disconnected_machine_is_an_error(self):
+        self.recorder.record({'overall_status': 'unhealthy', 'connection': False})
+        self.assertEqual(self.logged(), [('Health check - Status: unhealthy (Machine not connected)', False)])
+
+    def test_error_order_does_not_matter(self):
+        self.assertEqual(health_message('unhealthy', ['b', 'a']), health_message('unhealthy', ['a', 'b', 'a']))
+
+    def test_checks_are_rolled_up_per_day(self):
+        for health in (self.healthy, self.faulty, self.faulty):
+            self.recorder.record(health)
+        self.assertEqual(self.recorder.flush(), 3)
+        self.recorder.record(self.healthy)
+        self.assertEqual(self.recorder.flush(), 1)
+        summary = HealthCheckSummary.objects.get()
+        self.assertEqual((summary.date, summary.checks, summary.healthy, summary.unhealthy),
+                         (timezone.now().date(), 4, 2, 2))
+        self.assertIsNotNone(summary.last_checked_at)
+        self.assertEqual(self.recorder.flush(), 0)
+
+    def test_failed_rollup_is_retried(self):
+        self.recorder.record(self.healthy)
+        with mock.patch.object(HealthCheckSummary.objects, 'get_or_create', side_effect=RuntimeError('locked')), \
+                self.assertLogs('machine', 'ERROR'):
+            self.assertEqual(self.recorder.flush(), 0)
+        self.assertEqual(self.recorder.flush(), 1)
+
+    def test_old_logs_are_compacted_into_summaries(self):
+        old = timezone.now() - timedelta(days=40)
+        for resolved in (True, False, True):
+            MaintenanceLog.objects.create(log_type='health_check', message='x', resolved=resolved, timestamp=old)
+        MaintenanceLog.objects.create(log_type='health_check', message='recent', resolved=True)
+        self.assertEqual(compact_health_logs(retention_days=30), 3)
+        summary = HealthCheckSummary.objects.get(date=old.date())
+        self.assertEqual((summary.checks, summary.healthy, summary.unhealthy, summary.transitions), (3, 2, 1, 3))
+        self.assertEqual(self.logged(), [('recent', True)])
+
+
+class ExportTests(TestCase):
+    """History exports stream every row once, oldest first, in CSV or Parquet"""
+
+    def setUp(self):
+        self.moment = timezone.now().replace(microsecond=0)
+        for i in range(5):
+            CoffeeDelivery.objects.create(coffee_type='single_short', group_number=i % 2 + 1, status='completed',
+                                          started_at=self.moment + timedelta(seconds=i // 2), duration=20.5)
+        self.ids = list(CoffeeDelivery.objects.order_by('started_at', 'id').values_list('id', flat=True))
+
+    def csv_rows(self, content):
+        return list(csv.reader(io.StringIO(content.decode())))
+
+    def test_csv_streams_every_row_oldest_first(self):
+        response = self.client.get('/api/export/deliveries/?format=csv')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertRegex(response['Content-Disposition'], r'^attachment; filename="deliveries-\d{8}-\d{6}\.csv"$')
+        rows = self.csv_rows(b''.join(response.streaming_content))
+        self.assertEqual(rows[0], EXPORTS['deliveries'][2])
+        self.assertEqual([int(row[0]) for row in rows[1:]], self.ids)
+        self.assertEqual(rows[1][5], self.moment.isoformat())
+
+    def test_chunks_add_up_to_the_whole_export(self):
+        chunks = list(export_chunks('deliveries', chunk_size=2))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(b''.join(chunks), b''.join(export_chunks('deliveries')))
+
+    def test_filters(self):
+        start = (self.moment + timedelta(seconds=1)).isoformat()
+        response = self.client.get(f'/api/export/deliveries/?start={start}&group=1')
+        rows = self.csv_rows(b''.join(response.streaming_content))[1:]
+        expected = CoffeeDelivery.objects.filter(started_at__gte=start, group_number=1).order_by('started_at', 'id')
+        self.assertEqual([int(row[0]) for row in rows], list(expected.values_list('id', flat=True)))
+        # The end is exclusive: nothing started before the first row
+        self.assertEqual(len(self.csv_rows(b''.join(export_chunks('deliveries', end=self.moment)))), 1)
+
+    @skipUnless(pa is not None, 'Parquet exports require pyarrow')
+    def test_parquet_round_trip(self):
+        import pyarrow.parquet as pq
+        response = self.client.get('/api/export/deliveries/?format=parquet')
+        self.assertEqual(response['Content-Type'], 'application/vnd.apache.parquet')
+        data = b''.join(response.streaming_content)
+        self.assertEqual(pq.ParquetFile(io.BytesIO(data)).metadata.num_row_groups, 1)
+        table = pq.read_table(io.BytesIO(data))
+        self.assertEqual(table.column_names, EXPORTS['deliveries'][2])
+        self.assertEqual(table.column('id').to_pylist(), self.ids)
+        self.assertEqual(table.column('started_at').to_pylist()[0], self.moment)
+        self.assertEqual(table.column('duration').to_pylist(), [20.5] * 5)
+
+    @skipUnless(pa is not None, 'Parquet exports require pyarrow')
+    def test_parquet_has_a_row_group_per_chunk(self):
+        import pyarrow.parquet as pq
+        data = b''.join(export_chunks('deliveries', 'parquet', chunk_size=2))
+        self.assertEqual(pq.ParquetFile(io.BytesIO(data)).metadata.num_row_groups, 3)
+        self.assertEqual(pq.read_table(io.BytesIO(data)).num_rows, 5)
+
+    def test_bad_requests_are_rejected(self):
+        for path in ('/api/export/orders/', '/api/export/deliveries/?format=xlsx',
+                     '/api/export/deliveries/?start=yesterday', '/api/export/deliveries/?group=one'):
+            with self.subTest(path=path):
+                self.assertEqual(self.client.get(path).status_code, 400)
+
+    def test_empty_export_has_a_header(self):
+        rows = self.csv_rows(b''.join(export_chunks('logs')))
+        self.assertEqual(rows, [EXPORTS['logs'][2]])
+
+
+class CommandJournalTests(TestCase):
+    """Commands are journaled with checksums and replayed against the machine after a crash"""
+
+    COMMANDS = LaSpazialeCoffeeMachine.COMMANDS
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.journal = CommandJournal(directory=self.directory, fsync=False, enabled=True)
+        self.addCleanup(self.journal.close)
+        tracker = mock.patch('machine.tracker.get_delivery_tracker')
+        self.tracker = tracker.start().return_value
+        self.addCleanup(tracker.stop)
+        self.tracker.max_duration = 180
+        self.sent_at = time.time() - 20
+
+    def segment(self):
+        (path,) = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                   if name.endswith('.journal')]
+        return path
+
+    def write(self, group, command, at=0, result=RESULT_OK):
+        return JournalRecord(self.sent_at + at, KIND_WRITE, group, 511 + group, self.COMMANDS[command], result, 0)
+
+    def delivery(self, group, delivery_id, at=0.1):
+        return JournalRecord(self.sent_at + at, KIND_DELIVERY, group, 0, 0, RESULT_OK, delivery_id)
+
+    def recover(self, records, selections=()):
+        return self.journal.recover(records, snapshot(selections=selections))
+
+    def test_records_read_back(self):
+        self.journal.record_write(512, 1, RESULT_OK, group=1)
+        self.journal.record_delivery(1, 42, True)
+        records = CommandJournal.read(self.segment())
+        self.assertEqual([(r.kind, r.group, r.register, r.value, r.result, r.delivery_id) for r in records],
+                         [(KIND_WRITE, 1, 512, 1, RESULT_OK, 0), (KIND_DELIVERY, 1, 0, 0, RESULT_OK, 42)])
+        self.assertEqual(self.journal.metrics()['records'], 2)
+
+    def test_reading_stops_at_a_corrupt_or_torn_record(self):
+        for value in (1, 2, 4):
+            self.journal.record_write(512, value, RESULT_OK, group=1)
+        with open(self.segment(), 'r+b') as segment:
+            segment.seek(RECORD_SIZE + 10)
+            segment.write(b'\xff')
+        self.assertEqual([record.value for record in CommandJournal.read(self.segment())], [1])
+        with open(self.segment(), 'r+b') as segment:
+            segment.truncate(RECORD_SIZE + 5)
+        self.assertEqual(len(CommandJournal.read(self.segment())), 1)
+
+    def test_running_delivery_is_resumed(self):
+        row = CoffeeDelivery.objects.create(coffee_type='single_short', group_number=1, status='pending')
+        result = self.recover([self.write(1, 'SINGLE_SHORT'), self.delivery(1, row.id)], [0x0001])
+        self.assertEqual(result, {'resumed': 1, 'stopped': 0, 'recorded': 0})
+        row.refresh_from_db()
+        self.assertEqual(row.status, 'in_progress')
+        self.tracker.resume.assert_called_once_with(1, datetime.fromtimestamp(self.sent_at), 'single_short')
+
+    def test_delivery_stopped_meanwhile_is_closed(self):
+        row = CoffeeDelivery.objects.create(coffee_type='single_long', group_number=2, status='in_progress')
+        records = [self.write(2, 'SINGLE_LONG'), self.delivery(2, row.id), self.write(2, 'STOP_DELIVERY', at=5)]
+        self.assertEqual(self.recover(records, [0, 0x0002])['stopped'], 1)
+        row.refresh_from_db()
+        self.assertEqual((row.status, row.completed_at), ('stopped', datetime.fromtimestamp(self.sent_at + 5)))
+        self.tracker.resume.assert_not_called()
+
+    def test_unrecorded_delivery_is_recorded_if_still_running(self):
+        # No answer: the machine may have acted on it. A refused command was not
+        records = [self.write(2, 'DOUBLE_SHORT', result=RESULT_ERROR),
+                   self.write(1, 'SINGLE_SHORT', result=RESULT_FAILED)]
+        self.assertEqual(self.recover(records, [0x0001, 0x0004])['recorded'], 1)
+        row = CoffeeDelivery.objects.get()
+        self.assertEqual((row.group_number, row.coffee_type, row.status), (2, 'double_short', 'in_progress'))
+        self.assertEqual(row.started_at, datetime.fromtimestamp(self.sent_at))
+
+    def test_unrecorded_delivery_that_finished_is_only_logged(self):
+        with self.assertLogs('machine', 'WARNING'):
+            self.assertEqual(self.recover([self.write(1, 'SINGLE_SHORT')])['recorded'], 0)
+        self.assertFalse(CoffeeDelivery.objects.exists())
+
+    def test_dead_journals_are_replayed_once_and_deleted(self):
+        dead = CommandJournal(directory=self.directory, fsync=False, enabled=True)
+        dead.record_write(512, 1, RESULT_OK, group=1)
+        dead.close()
+        self.journal.record_write(513, 2, RESULT_OK, group=2)  # Its own journal is never replayed
+        with mock.patch.object(self.journal, 'recover') as recover:
+            self.journal.observe(snapshot())
+            self.journal.observe(snapshot())
+        (records, _), _ = recover.call_args
+        self.assertEqual([(record.group, record.value) for record in records], [(1, 1)])
+        recover.assert_called_once()
+        self.assertEqual(len(os.listdir(self.directory)), 2)  # The live journal and its lock
@@ -0,0 +1,299 @@
+"""Delivery tracker that closes CoffeeDelivery rows from the live machine state"""
+import os
+import time
+import fcntl
+import logging
+import threading
+from collections import Counter, defaultdict
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+from django.conf import settings
+from django.db.models import Case, FloatField, Q, Value, When
+from .aggregates import update_delivery_stats
+from .coffee_machine import LaSpazialeCoffeeMachine
+from .duration_stats import get_duration_model
+from .models import CoffeeDelivery
+from .poller import MachineSnapshot
+
+logger = logging.getLogger('machine')
+
+
+class DeliveryTracker:
+    """Records every delivery the machine performs from group state transitions.
+
+    An idle->busy transition opens an episode: if no API delivery is waiting
+    on that group the delivery was started from the machine's own keypad
+    and a ``panel`` row is recorded. A busy->idle transition closes the
+    episode's row with its measured duration and feeds that duration to the
+    duration model behind the ETAs. Transitions are buffered and
+    written back as one bulk INSERT plus one bulk UPDATE every
+    ``batch_size`` transitions or ``flush_interval`` seconds; each write
+    back (and each reconcile) then adds the deliveries that finished since
+    to the hourly and daily delivery stats.
+
+    Every server process polls the machine, but only one records
+    deliveries: the process holding ``tracker.lock`` in ``lock_dir``. The
+    others keep trying to take it, so a recycled worker hands over to the
+    next one.
+    """
+
+    # Seconds between two attempts of a process without the lock to take it
+    LOCK_RETRY = 5.0
+    # Seconds between two sightings of one start (deliveries last longer)
+    PANEL_MATCH_TOLERANCE = 5.0
+
+    # Selection bits that identify a coffee delivery; purge (bit 7) is not one
+    SELECTION_TYPES = [
+        (mask, coffee_type)
+        for coffee_type, mask in LaSpazialeCoffeeMachine.STATUS_MASKS.items()
+        if coffee_type != 'purge'
+    ]
+
+    def __init__(self, batch_size: Optional[int] = None, flush_interval: Optional[float] = None,
+                 max_duration: Optional[float] = None, api_match_window: Optional[float] = None,
+                 lock_dir: Optional[str] = None):
+        self.batch_size = batch_size or getattr(settings, 'DELIVERY_TRACKER_BATCH_SIZE', 20)
+        self.flush_interval = flush_interval or getattr(settings, 'DELIVERY_TRACKER_FLUSH_INTERVAL', 2.0)
+        self.max_duration = max_duration or getattr(settings, 'DELIVERY_MAX_DURATION', 180)
+        self.api_match_window = api_match_window or getattr(settings, 'DELIVERY_API_MATCH_WINDOW', 15)
+        self.lock_dir = str(lock_dir or getattr(settings, 'COMMAND_JOURNAL_DIR', 'journal'))
+
+        self._busy: Dict[int, bool] = {}
+        self._busy_since: Dict[int, object] = {}
+        self._busy_kind: Dict[int, Optional[str]] = {}
+        self._started: List[Tuple[int, object, int]] = []      # (group, busy since, selection)
+        self._finished: List[Tuple[int, object, object]] = []  # (group, busy since, idle at)
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._last_reconcile: Optional[float] = None
+        self._lock_file = None
+        self._lock_attempt: Optional[float] = None
+
+    @classmethod
+    def coffee_type_for(cls, selection: int) -> Optional[str]:
+        """Map a group selection word to a CoffeeDelivery coffee_type"""
+        for mask, coffee_type in cls.SELECTION_TYPES:
+            if selection & mask:
+                return coffee_type
+        return None
+
+    @classmethod
+    def busy_kind(cls, selection: int) -> Optional[str]:
+        """What a busy group is doing: a coffee type or 'purge'"""
+        if selection & LaSpazialeCoffeeMachine.STATUS_MASKS['purge']:
+            return 'purge'
+        return cls.coffee_type_for(selection)
+
+    def acquire(self) -> bool:
+        """Whether this process records deliveries, taking the tracker lock if it is free"""
+        if self._lock_file is not None:
+            return True
+        now = time.monotonic()
+        if self._lock_attempt is not None and now - self._lock_attempt < self.LOCK_RETRY:
+            return False
+        self._lock_attempt = now
+        lock_file = None
+        try:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            lock_file = open(os.path.join(self.lock_dir, 'tracker.lock'), 'w')
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            if lock_file is not None:
+                lock_file.close()
+            return False
+        self._lock_file = lock_file
+        logger.info("Delivery tracker started in this process")
+        return True
+
+    def observe(self, snapshot: MachineSnapshot):
+        """Feed a new machine snapshot (registered as a poller listener)"""
+        if not self.acquire():
+            return
+        if self._last_reconcile is None or snapshot.monotonic - self._last_reconcile >= self.max_duration:
+            self.reconcile(snapshot)
+
+        with self._lock:
+            for group, busy in snapshot.busy_groups().items():
+                was_busy = self._busy.get(group)
+                if was_busy is False and busy:
+                    self._busy_since[group] = snapshot.taken_at
+                    self._busy_kind[group] = self.busy_kind(snapshot.selection(group))
+                    self._started.append((group, snapshot.taken_at, snapshot.selection(group)))
+                elif was_busy and not busy:
+                    # busy_since is unknown when the tracker started mid-delivery
+                    since = self._busy_since.pop(group, None)
+                    kind = self._busy_kind.pop(group, None)
+                    self._finished.append((group, since, snapshot.taken_at))
+                    if since is not None:
+                        get_duration_model().observe(group, kind, (snapshot.taken_at - since).total_seconds())
+                self._busy[group] = busy
+
+            pending = len(self._started) + len(self._finished)
+            due = (pending >= self.batch_size or
+                   (pending and time.monotonic() - self._last_flush >= self.flush_interval))
+
+        if due:
+            self.flush()
+
+    def resume(self, group: int, since, kind: Optional[str]):
+        """Continue tracking a delivery that was running before a restart (from the command journal)"""
+        with self._lock:
+            self._busy[group] = True
+            self._busy_since[group] = since
+            self._busy_kind[group] = kind
+
+    def flush(self) -> int:
+        """Write buffered transitions to the database; returns rows touched"""
+        with self._lock:
+            started, self._started = self._started, []
+            finished, self._finished = self._finished, []
+            self._last_flush = time.monotonic()
+
+        touched = 0
+        try:
+            # Starts go first so that a panel delivery which both started and
+            # finished within this batch already has a row to close.
+            if started:
+                touched += self._record_started(started)
+            if finished:
+                touched += self._record_finished(finished)
+        except Exception as e:
+            logger.error(f"Failed to record delivery transitions: {e}")
+            with self._lock:
+                self._started = started + self._started
+                self._finished = finished + self._finished
+            return 0
+
+        if started or finished:
+            self._update_stats()
+        return touched
+
+    def _update_stats(self):
+        """Count deliveries that finished since the last call (however they finished)"""
+        try:
+            update_delivery_stats()
+        except Exception as e:
+            logger.error(f"Failed to update delivery stats: {e}")
+
+    def _record_started(self, started) -> int:
+        """Insert panel rows for starts that no open delivery row accounts for"""
+        groups = {group for group, _, _ in started}
+        window_start = min(since for _, since, _ in started) - timedelta(seconds=self.api_match_window)
+        open_rows = list(CoffeeDelivery.objects.filter(
+            status='in_progress', source__in=('api', 'panel'),
+            group_number__in=groups, started_at__gte=window_start,
+        ).values_list('group_number', 'source', 'started_at'))
+        api_rows = Counter(group for group, source, _ in open_rows if source == 'api')
+        # Panel rows of the same start: a flush retried after an error, or a
+        # previous owner of the lock that saw the start one poll earlier or later
+        panel_starts = defaultdict(list)
+        for group, source, started_at in open_rows:
+            if source == 'panel':
+                panel_starts[group].append(started_at)
+
+        panel_rows = []
+        for group, since, selection in started:
+            if api_rows[group]:
+                # One API row accounts for one start only
+                api_rows[group] -= 1
+                continue
+            recorded = next((at for at in panel_starts[group]
+                             if abs((at - since).total_seconds()) <= self.PANEL_MATCH_TOLERANCE), None)
+            if recorded is not None:
+                panel_starts[group].remove(recorded)
+                continue
+            coffee_type = self.coffee_type_for(selection)
+            if coffee_type is None:
+                continue  # purge cycle, not a delivery
+            panel_rows.append(CoffeeDelivery(
+                coffee_type=coffee_type,
+                group_number=group,
+                status='in_progress',
+                source='panel',
+                started_at=since,
+            ))
+
+        if panel_rows:
+            CoffeeDelivery.objects.bulk_create(panel_rows)
+            logger.info(f"Recorded {len(panel_rows)} deliveries started from the machine panel")
+        return len(panel_rows)
+
+    def _record_finished(self, finished) -> int:
+        """Close open rows of every finished episode with one UPDATE"""
+        # A row belongs to the first idle transition of its group after it
+        # started, so the When() clauses are ordered by transition time.
+        by_group = defaultdict(list)
+        for group, since, idle_at in finished:
+            by_group[group].append((idle_at, since))
+
+        match = Q()
+        completed_whens = []
+        duration_whens = []
+        for group, episodes in by_group.items():
+            episodes.sort(key=lambda episode: episode[0])
+            match |= Q(group_number=group, started_at__lte=episodes[-1][0])
+            for idle_at, since in episodes:
+                condition = Q(group_number=group, started_at__lte=idle_at)
+                duration = (idle_at - since).total_seconds() if since is not None else None
+                completed_whens.append(When(condition, then=Value(idle_at)))
+                duration_whens.append(When(condition, then=Value(duration, output_field=FloatField())))
+
+        updated = CoffeeDelivery.objects.filter(match, status='in_progress').update(
+            status='completed',
+            completed_at=Case(*completed_whens),
+            duration=Case(*duration_whens, output_field=FloatField()),
+        )
+        if updated:
+            logger.info(f"Marked {updated} deliveries as completed")
+        return updated
+
+    def reconcile(self, snapshot: MachineSnapshot) -> int:
+        """Close in-progress rows that can no longer be matched to a transition.
+
+        Runs on the first snapshot after startup (rows left behind by a
+        restart) and then every ``max_duration`` seconds. Rows on groups that
+        are busy right now are left alone: their idle transition closes them.
+        """
+        startup = self._last_reconcile is None
+        self._last_reconcile = snapshot.monotonic
+        idle_groups = [group for group, busy in snapshot.busy_groups().items() if not busy]
+        if not idle_groups:
+            return 0
+
+        stale_before = snapshot.taken_at - timedelta(seconds=self.max_duration)
+        open_rows = CoffeeDelivery.objects.filter(status='in_progress', group_number__in=idle_groups)
+
+        try:
+            failed = open_rows.filter(started_at__lt=stale_before).update(
+                status='failed',
+                completed_at=snapshot.taken_at,
+                error_message='Delivery was not tracked to completion',
+            )
+            # Only the startup pass can find rows that finished while we were not watching
+            completed = 0
+            if startup:
+                completed = open_rows.update(status='completed', completed_at=snapshot.taken_at)
+        except Exception as e:
+            logger.error(f"Failed to reconcile open deliveries: {e}")
+            return 0
+
+        if failed or completed:
+            logger.info(f"Reconciled orphaned deliveries: {completed} completed, {failed} failed")
+        self._update_stats()
+        return failed + completed
+
+
+# Singleton instance for Django integration
+_tracker_instance = None
+_tracker_lock = threading.Lock()
+
+def get_delivery_tracker() -> DeliveryTracker:
+    """Get singleton delivery tracker instance"""
+    global _tracker_instance
+
+    if _tracker_instance is None:
+        with _tracker_lock:
+            if _tracker_instance is None:
+                _tracker_instance = DeliveryTracker()
+
+    return _tracker_instance
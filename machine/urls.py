@@ -1,5 +1,6 @@
+from django.conf import settings
 from django.urls import path
-from . import views, views_raw
+from . import views, views_raw, views_stream
 
 app_name = 'machine'
 
@@ -7,16 +8,48 @@ urlpatterns = [
     path('', views.dashboard, name='dashboard'),
     path('api/info/', views.machine_info, name='machine_info'),
     path('api/status/', views.machine_status, name='machine_status'),
+    path('api/status/stream', views_stream.status_stream, name='status_stream'),
     path('api/connect/', views.connect_machine, name='connect_machine'),
     path('api/disconnect/', views.disconnect_machine, name='disconnect_machine'),
     path('api/deliver/', views_raw.deliver_coffee_raw, name='deliver_coffee'),
     path('api/deliver_old/', views.deliver_coffee, name='deliver_coffee_old'),
     path('api/stop/', views_raw.stop_delivery_raw, name='stop_delivery'),
     path('api/purge/', views_raw.start_purge_raw, name='start_purge'),
+    path('api/batch/', views_raw.batch_raw, name='batch'),
+    path('api/orders/', views_raw.orders_raw, name='orders'),
+    path('api/orders/<int:order_id>/', views_raw.order_detail_raw, name='order_detail'),
     path('api/stop_old/', views.stop_delivery, name='stop_delivery_old'),
     path('api/purge_old/', views.start_purge, name='start_purge_old'),
     path('api/health/', views.health_check, name='health_check'),
+    path('api/metrics/', views.machine_metrics, name='machine_metrics'),
+    path('api/durations/', views.duration_stats, name='duration_stats'),
+    path('api/stats/', views.delivery_stats, name='delivery_stats'),
     path('api/history/', views.delivery_history, name='delivery_history'),
     path('api/logs/', views.maintenance_logs, name='maintenance_logs'),
+    path('api/telemetry/', views.telemetry, name='telemetry'),
+    path('api/export/<str:kind>/', views.export_history, name='export_history'),
     path('api/test/', views.test_post, name='test_post'),
-]
\ No newline at end of file
+]
+
+if getattr(settings, 'COFFEE_MACHINE_ASYNC_VIEWS', False):
+    from . import views_async
+
+    # Same URLs, served by async views under the ASGI server
+    async_views = {
+        'machine_info': views_async.machine_info,
+        'machine_status': views_async.machine_status,
+        'status_stream': views_async.status_stream,
+        'deliver_coffee': views_async.deliver_coffee,
+        'stop_delivery': views_async.stop_delivery,
+        'start_purge': views_async.start_purge,
+        'batch': views_async.batch,
+        'orders': views_async.orders,
+        'order_detail': views_async.order_detail,
+        'machine_metrics': views_async.machine_metrics,
+        'export_history': views_async.export_history,
+    }
+    urlpatterns = [
+        path(str(pattern.pattern), async_views[pattern.name], name=pattern.name)
+        if pattern.name in async_views else pattern
+        for pattern in urlpatterns
+    ]
@@ -2,22 +2,109 @@ from django.shortcuts import render
 
 # Create your views here.
 import json
+import time
+import hashlib
+from datetime import datetime, timedelta
 from django.shortcuts import render
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.core.cache import cache
 from django.utils import timezone
 from django.conf import settings
-from rest_framework.decorators import api_view
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import quote_etag
+from rest_framework.decorators import api_view, renderer_classes
 from rest_framework.response import Response
 from rest_framework import status
-from .models import CoffeeMachine, CoffeeDelivery, MaintenanceLog
+from .models import CoffeeMachine, CoffeeDelivery, DailyDeliveryStats, HourlyDeliveryStats, MaintenanceLog
 from .coffee_machine import get_coffee_machine, CoffeeMachineException
+from .poller import get_status_poller
+from .dispatcher import get_order_dispatcher
+from .duration_stats import get_duration_model
+from .export import CONTENT_TYPES, export_chunks, export_filename, export_options
+from .health import get_health_recorder
+from .journal import get_command_journal
+from .pagination import keyset_page, page_params
+from .renderers import status_renderers
+from .writebehind import get_write_buffer
+from .telemetry import get_telemetry_store
 import logging
 
 logger = logging.getLogger('machine')
 
+def _conditional_response(request, data, etag, cache_control='no-cache'):
+    """Response carrying a strong ETag, or an empty 304 if the client already has it"""
+    etag = quote_etag(str(etag))
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = Response(data)
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    return response
+
+def _content_etag(data):
+    """ETag derived from the JSON content itself"""
+    return hashlib.md5(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+def _status_etag(version, raw=False, encoding='json', tick=None):
+    """Snapshot version plus the representation, so caches never mix them up.
+
+    ``tick`` is the countdown second of a decoded status while a purge
+    countdown runs down (the body changes with it).
+    """
+    parts = [str(version)]
+    if raw:
+        parts.append('raw')
+    elif tick is not None:
+        parts.append(f't{tick}')
+    if encoding != 'json':
+        parts.append(encoding)
+    return '-'.join(parts)
+
+def _offline_info(machine) -> dict:
+    """Machine info returned while the machine is not connected"""
+    return {
+        'serial_number': 'Not Connected',
+        'firmware_version': 'Not Connected',
+        'number_of_groups': 'Not Connected',
+        'is_blocked': 'Unknown',
+        'machine_config': None,
+        'connection_status': False,
+        'port': machine.port,
+        'baudrate': machine.baudrate,
+        'last_updated': None
+    }
+
+def _offline_status() -> dict:
+    """Machine status returned while the machine is not connected"""
+    return {
+        'groups': {
+            'group_1': {'is_busy': False, 'sensor_fault': False, 'purge_countdown': 0, 'current_action': 'Not Connected'},
+            'group_2': {'is_busy': False, 'sensor_fault': False, 'purge_countdown': 0, 'current_action': 'Not Connected'},
+            'group_3': {'is_busy': False, 'sensor_fault': False, 'purge_countdown': 0, 'current_action': 'Not Connected'}
+        },
+        'machine_blocked': False,
+        'connection_status': False
+    }
+
+def _snapshot_info(machine, poller, snapshot):
+    """Machine info from the poller's cached identity registers, or None if not read yet"""
+    identity = poller.identity
+    if not identity or snapshot is None:
+        return None
+    return {
+        'serial_number': identity['serial_number'],
+        'firmware_version': identity['firmware_version'],
+        'number_of_groups': identity['number_of_groups'],
+        'is_blocked': snapshot.machine_blocked,
+        'machine_config': snapshot.machine_config,
+        'connection_status': True,
+        'port': machine.port,
+        'baudrate': machine.baudrate,
+        'last_updated': identity['last_updated'],
+    }
+
 def dashboard(request):
     """Main dashboard view"""
     context = {
@@ -35,17 +122,16 @@ def machine_info(request):
         
         # Return basic info if not connected
         if not machine.is_connected:
-            return Response({
-                'serial_number': 'Not Connected',
-                'firmware_version': 'Not Connected',
-                'number_of_groups': 'Not Connected',
-                'is_blocked': 'Unknown',
-                'machine_config': None,
-                'connection_status': False,
-                'port': machine.port,
-                'baudrate': machine.baudrate,
-                'last_updated': None
-            })
+            return Response(_offline_info(machine))
+        
+        # Identity registers are cached by the poller for the whole connection,
+        # so the info can be served (and revalidated) without bus traffic
+        poller = get_status_poller()
+        poller.touch()
+        info = _snapshot_info(machine, poller, poller.current())
+        if info is not None:
+            max_age = getattr(settings, 'MACHINE_INFO_CACHE_TIMEOUT', 300)
+            return _conditional_response(request, info, _content_etag(info), f'private, max-age={max_age}')
         
         info = machine.get_machine_info()
         return Response(info)
@@ -65,22 +151,36 @@ def machine_info(request):
         })
 
 @api_view(['GET'])
+@renderer_classes(status_renderers())
 def machine_status(request):
-    """Get current machine status"""
+    """Get current machine status
+
+    ``?format=raw`` returns the state register words and snapshot version
+    instead of the decoded groups; ``Accept: application/x-msgpack`` encodes
+    either one as MessagePack.
+    """
     try:
         machine = get_coffee_machine()
         
         # Return empty status if not connected
         if not machine.is_connected:
-            return Response({
-                'groups': {
-                    'group_1': {'is_busy': False, 'sensor_fault': False, 'purge_countdown': 0, 'current_action': 'Not Connected'},
-                    'group_2': {'is_busy': False, 'sensor_fault': False, 'purge_countdown': 0, 'current_action': 'Not Connected'},
-                    'group_3': {'is_busy': False, 'sensor_fault': False, 'purge_countdown': 0, 'current_action': 'Not Connected'}
-                },
-                'machine_blocked': False,
-                'connection_status': False
-            })
+            return Response(_offline_status())
+        
+        # Served from the poller's snapshot when fresh: no bus traffic. The body
+        # only changes with the snapshot version and the running countdowns,
+        # which make up the ETag.
+        poller = get_status_poller()
+        poller.touch()
+        snapshot = poller.current()
+        if snapshot is not None:
+            raw = request.query_params.get('format') == 'raw'
+            now = time.monotonic()
+            data = snapshot.to_raw() if raw else snapshot.to_status(now=now)
+            etag = _status_etag(snapshot.version, raw, request.accepted_renderer.format,
+                                snapshot.countdown_tick(now))
+            response = _conditional_response(request, data, etag)
+            patch_vary_headers(response, ['Accept'])
+            return response
         
         machine_status = machine.get_all_groups_status()
         return Response(machine_status)
@@ -113,6 +213,9 @@ def connect_machine(request):
         connected = machine.connect()
         
         if connected:
+            # Start polling the new connection right away
+            get_status_poller().wake()
+            
             # Update database record
             try:
                 machine_obj, created = CoffeeMachine.objects.get_or_create(
@@ -314,10 +417,10 @@ def deliver_coffee(request):
         try:
             machine = get_coffee_machine()
             result = machine.deliver_coffee(int(group_number), coffee_type)
+            get_command_journal().record_delivery(int(group_number), delivery.id, result['success'])
             
             if result['success']:
-                delivery.status = 'in_progress'
-                delivery.save()
+                get_write_buffer().update(CoffeeDelivery, {'id': delivery.id}, status='in_progress')
                 
                 return JsonResponse({
                     'success': True,
@@ -326,9 +429,8 @@ def deliver_coffee(request):
                     'result': result
                 })
             else:
-                delivery.status = 'failed'
-                delivery.error_message = result['message']
-                delivery.save()
+                get_write_buffer().update(CoffeeDelivery, {'id': delivery.id},
+                                          status='failed', error_message=result['message'])
                 
                 return JsonResponse(
                     {'success': False, 'message': result['message']}, 
@@ -336,9 +438,7 @@ def deliver_coffee(request):
                 )
                 
         except Exception as e:
-            delivery.status = 'failed'
-            delivery.error_message = str(e)
-            delivery.save()
+            get_write_buffer().update(CoffeeDelivery, {'id': delivery.id}, status='failed', error_message=str(e))
             raise
             
     except Exception as e:
@@ -366,20 +466,20 @@ def stop_delivery(request):
         
         if success:
             # Update any in-progress deliveries
-            CoffeeDelivery.objects.filter(
-                group_number=group_number,
-                status='in_progress'
-            ).update(
+            write_buffer = get_write_buffer()
+            write_buffer.update(
+                CoffeeDelivery,
+                {'group_number': int(group_number), 'status': 'in_progress'},
                 status='stopped',
                 completed_at=timezone.now()
             )
             
             # Log maintenance action
-            MaintenanceLog.objects.create(
+            write_buffer.insert(MaintenanceLog(
                 log_type='manual_stop',
                 group_number=group_number,
                 message=f'Manual stop command sent to group {group_number}'
-            )
+            ))
             
             return Response({
                 'success': True,
@@ -416,11 +516,11 @@ def start_purge(request):
         
         if success:
             # Log maintenance action
-            MaintenanceLog.objects.create(
+            get_write_buffer().insert(MaintenanceLog(
                 log_type='purge',
                 group_number=group_number,
                 message=f'Purge cycle started for group {group_number}'
-            )
+            ))
             
             return Response({
                 'success': True,
@@ -446,12 +546,8 @@ def health_check(request):
         machine = get_coffee_machine()
         health = machine.health_check()
         
-        # Log health check
-        MaintenanceLog.objects.create(
-            log_type='health_check',
-            message=f'Health check performed - Status: {health["overall_status"]}',
-            resolved=health['overall_status'] == 'healthy'
-        )
+        # Logged only when the result changed; otherwise just counted
+        get_health_recorder().record(health)
         
         return Response(health)
         
@@ -462,33 +558,81 @@ def health_check(request):
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
+@api_view(['GET'])
+def machine_metrics(request):
+    """Get status poller metrics (current poll rate and the reason for it)"""
+    try:
+        return Response({
+            'poller': get_status_poller().metrics(),
+            'orders': get_order_dispatcher().metrics(),
+            'writes': get_write_buffer().metrics(),
+            'telemetry': get_telemetry_store().metrics(),
+            'journal': get_command_journal().metrics(),
+        })
+    except Exception as e:
+        logger.error(f"Error getting metrics: {e}")
+        return Response(
+            {'error': str(e)}, 
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+@api_view(['GET'])
+def duration_stats(request):
+    """Get learned delivery durations per group and coffee type (group null = all groups)"""
+    try:
+        return Response({'durations': get_duration_model().summary()})
+    except Exception as e:
+        logger.error(f"Error getting duration stats: {e}")
+        return Response(
+            {'error': str(e)}, 
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
 @api_view(['GET'])
 def delivery_history(request):
-    """Get delivery history"""
+    """Get delivery history, newest first.
+
+    Query parameters: ``limit``, ``cursor`` (``next_cursor`` of the previous
+    page), ``since_id`` (only rows added after that id) and the filters
+    ``group``, ``type``, ``status`` and ``source``.
+    """
     try:
-        limit = request.GET.get('limit', 50)
-        deliveries = CoffeeDelivery.objects.all()[:int(limit)]
-        
-        data = []
-        for delivery in deliveries:
-            data.append({
-                'id': delivery.id,
-                'coffee_type': delivery.get_coffee_type_display(),
-                'group_number': delivery.group_number,
-                'status': delivery.get_status_display(),
-                'started_at': delivery.started_at.isoformat(),
-                'completed_at': delivery.completed_at.isoformat() if delivery.completed_at else None,
-                'error_message': delivery.error_message
-            })
-        
-        return Response({'deliveries': data})
-        
+        limit, cursor, since_id = page_params(request, 50)
+        deliveries = CoffeeDelivery.objects.all()
+        if request.GET.get('group'):
+            deliveries = deliveries.filter(group_number=int(request.GET['group']))
+        for param, field in (('type', 'coffee_type'), ('status', 'status'), ('source', 'source')):
+            if request.GET.get(param):
+                deliveries = deliveries.filter(**{field: request.GET[param]})
+        
+        rows, next_cursor = keyset_page(
+            deliveries, 'started_at',
+            ['id', 'coffee_type', 'group_number', 'status', 'source',
+             'started_at', 'completed_at', 'duration', 'error_message'],
+            limit, cursor, since_id,
+        )
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         logger.error(f"Error getting delivery history: {e}")
         return Response(
             {'error': str(e)}, 
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
+    
+    coffee_types = dict(CoffeeDelivery.COFFEE_TYPES)
+    statuses = dict(CoffeeDelivery.STATUS_CHOICES)
+    for row in rows:
+        row['coffee_type'] = coffee_types.get(row['coffee_type'], row['coffee_type'])
+        row['status'] = statuses.get(row['status'], row['status'])
+        row['started_at'] = row['started_at'].isoformat()
+        row['completed_at'] = row['completed_at'].isoformat() if row['completed_at'] else None
+    
+    return Response({
+        'deliveries': rows,
+        'next_cursor': next_cursor,
+        'latest_id': max((row['id'] for row in rows), default=since_id) if not cursor else since_id,
+    })
 
 @csrf_exempt
 @require_http_methods(['POST'])
@@ -520,27 +664,163 @@ def test_post(request):
 
 @api_view(['GET'])
 def maintenance_logs(request):
-    """Get maintenance logs"""
+    """Get maintenance logs, newest first.
+
+    Query parameters: ``limit``, ``cursor``, ``since_id`` and the filters
+    ``log_type`` and ``group``.
+    """
     try:
-        limit = request.GET.get('limit', 100)
-        logs = MaintenanceLog.objects.all()[:int(limit)]
-        
-        data = []
-        for log in logs:
-            data.append({
-                'id': log.id,
-                'log_type': log.get_log_type_display(),
-                'group_number': log.group_number,
-                'message': log.message,
-                'timestamp': log.timestamp.isoformat(),
-                'resolved': log.resolved
-            })
-        
-        return Response({'logs': data})
-        
+        limit, cursor, since_id = page_params(request, 100)
+        logs = MaintenanceLog.objects.all()
+        if request.GET.get('group'):
+            logs = logs.filter(group_number=int(request.GET['group']))
+        if request.GET.get('log_type'):
+            logs = logs.filter(log_type=request.GET['log_type'])
+        
+        rows, next_cursor = keyset_page(
+            logs, 'timestamp',
+            ['id', 'log_type', 'group_number', 'message', 'timestamp', 'resolved'],
+            limit, cursor, since_id,
+        )
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         logger.error(f"Error getting maintenance logs: {e}")
         return Response(
             {'error': str(e)}, 
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
\ No newline at end of file
+        )
+    
+    log_types = dict(MaintenanceLog.LOG_TYPES)
+    for row in rows:
+        row['log_type'] = log_types.get(row['log_type'], row['log_type'])
+        row['timestamp'] = row['timestamp'].isoformat()
+    
+    return Response({
+        'logs': rows,
+        'next_cursor': next_cursor,
+        'latest_id': max((row['id'] for row in rows), default=since_id) if not cursor else since_id,
+    })
+
+def _time_param(request, name, default: float) -> float:
+    """Epoch seconds from an ISO datetime or epoch milliseconds query parameter; raises ValueError"""
+    value = request.GET.get(name)
+    if not value:
+        return default
+    if value.isdigit():
+        return int(value) / 1000
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ValueError(f'{name} must be an ISO datetime or epoch milliseconds')
+
+@api_view(['GET'])
+def telemetry(request):
+    """Get recorded register history, downsampled for charts.
+
+    Query parameters: ``start`` and ``end`` (ISO datetimes or epoch
+    milliseconds, the last 24 hours by default), ``fields`` (comma separated
+    ``busy_<group>``, ``countdown_<group>`` and ``blocked``; all of them by
+    default) and ``points`` (per series, default 500).
+    """
+    try:
+        end = _time_param(request, 'end', time.time())
+        start = _time_param(request, 'start', end - 24 * 3600)
+        if start >= end:
+            raise ValueError('start must be before end')
+        fields = [field for field in request.GET.get('fields', '').split(',') if field] or None
+        try:
+            points = int(request.GET.get('points', 500))
+        except ValueError:
+            raise ValueError('points must be an integer')
+        return Response(get_telemetry_store().series(start, end, fields, points))
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except RuntimeError as e:
+        return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    except Exception as e:
+        logger.error(f"Error getting telemetry: {e}")
+        return Response(
+            {'error': str(e)}, 
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+@api_view(['GET'])
+def delivery_stats(request):
+    """Get delivery counts per hour or day, group, coffee type and final status.
+
+    Query parameters: ``period`` (``day`` or ``hour``), ``start`` and ``end``
+    (ISO dates or datetimes; the last 30 days or 48 hours by default) and the
+    filters ``group``, ``type`` and ``status``. Reads only the stats tables.
+    """
+    try:
+        period = request.GET.get('period', 'day')
+        if period not in ('day', 'hour'):
+            raise ValueError('period must be day or hour')
+        model, field = (DailyDeliveryStats, 'date') if period == 'day' else (HourlyDeliveryStats, 'hour')
+        try:
+            end = datetime.fromisoformat(request.GET['end']) if request.GET.get('end') else timezone.now()
+            start = (datetime.fromisoformat(request.GET['start']) if request.GET.get('start') else
+                     end - (timedelta(days=30) if period == 'day' else timedelta(hours=48)))
+        except ValueError:
+            raise ValueError('start and end must be ISO dates or datetimes')
+        
+        stats = model.objects.filter(**{f'{field}__gte': start if period == 'hour' else start.date(),
+                                        f'{field}__lte': end if period == 'hour' else end.date()})
+        if request.GET.get('group'):
+            stats = stats.filter(group_number=int(request.GET['group']))
+        for param, column in (('type', 'coffee_type'), ('status', 'status')):
+            if request.GET.get(param):
+                stats = stats.filter(**{column: request.GET[param]})
+        
+        rows = list(stats.order_by(field, 'group_number', 'coffee_type', 'status').values(
+            field, 'group_number', 'coffee_type', 'status', 'count', 'timed', 'total_duration'))
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        logger.error(f"Error getting delivery stats: {e}")
+        return Response(
+            {'error': str(e)}, 
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+    
+    totals = {'deliveries': 0, 'completed': 0, 'failed': 0, 'stopped': 0}
+    timed, total_duration = 0, 0.0
+    for row in rows:
+        row['period'] = row.pop(field).isoformat()
+        totals['deliveries'] += row['count']
+        totals[row['status']] = totals.get(row['status'], 0) + row['count']
+        timed += row['timed']
+        total_duration += row['total_duration']
+        row['average_duration'] = round(row.pop('total_duration') / row['timed'], 1) if row['timed'] else None
+        del row['timed']
+    totals['failure_rate'] = round(totals['failed'] / totals['deliveries'], 3) if totals['deliveries'] else None
+    totals['average_duration'] = round(total_duration / timed, 1) if timed else None
+    
+    return Response({
+        'period': period,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'stats': rows,
+        'totals': totals,
+    })
+
+@require_http_methods(["GET"])
+def export_history(request, kind):
+    """Stream the delivery (``deliveries``) or maintenance (``logs``) history.
+
+    Query parameters: ``format`` (``csv`` or ``parquet``), ``start`` and
+    ``end`` (ISO dates or datetimes, end exclusive) and ``group``. Rows are
+    read and encoded one chunk at a time while the response is sent.
+    """
+    try:
+        options = export_options(request.GET)
+        chunks = export_chunks(kind, **options)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except RuntimeError as e:
+        return JsonResponse({'error': str(e)}, status=501)
+    
+    response = StreamingHttpResponse(chunks, content_type=CONTENT_TYPES[options['fmt']])
+    response['Content-Disposition'] = f'attachment; filename="{export_filename(kind, options["fmt"])}"'
+    return response
@@ -0,0 +1,221 @@
+"""Async views served when the app runs under an ASGI server (uvicorn mode)
+
+Reads answered from the poller's snapshot never leave the event loop.
+Anything that touches the serial bus or the database goes through
+``sync_to_async``, whose default thread-sensitive mode funnels it into one
+shared thread: bus frames stay serialized, and a slow frame only delays
+other bus work instead of every client.
+"""
+import time
+import asyncio
+import logging
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import quote_etag
+from . import views_raw
+from .coffee_machine import get_coffee_machine
+from .dispatcher import get_order_dispatcher
+from .export import CONTENT_TYPES, export_chunks, export_filename, export_options
+from .journal import get_command_journal
+from .poller import get_status_poller
+from .renderers import MSGPACK_MEDIA_TYPE, MessagePackRenderer, accepts_msgpack
+from .telemetry import get_telemetry_store
+from .views import _content_etag, _offline_info, _offline_status, _snapshot_info, _status_etag
+from .views_stream import _StreamState
+from .writebehind import get_write_buffer
+
+logger = logging.getLogger('machine')
+
+
+def _conditional_json(request, data, etag, cache_control='no-cache', msgpack=False):
+    """JSON (or MessagePack) response carrying a strong ETag, or an empty 304 if the client already has it"""
+    etag = quote_etag(str(etag))
+    response = get_conditional_response(request, etag=etag)
+    if response is None and msgpack:
+        response = HttpResponse(MessagePackRenderer().render(data), content_type=MSGPACK_MEDIA_TYPE)
+    elif response is None:
+        response = JsonResponse(data)
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    return response
+
+
+async def _current_snapshot(poller):
+    """``poller.current()`` without leaving the event loop while the snapshot is fresh"""
+    snapshot = poller.snapshot
+    if poller.is_fresh(snapshot):
+        return poller.snapshot_at(snapshot.version) or snapshot
+    return await sync_to_async(poller.current)()
+
+
+def _in_bus_thread(view):
+    """Async wrapper running a sync command view in the shared bus/database thread"""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        return await sync_to_async(view)(request, *args, **kwargs)
+    # csrf_exempt() would hide the coroutine from Django 4.2, so set its flag directly
+    wrapper.csrf_exempt = True
+    return wrapper
+
+
+async def machine_info(request):
+    """Get machine information"""
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    machine = get_coffee_machine()
+    if not machine.is_connected:
+        return JsonResponse(_offline_info(machine))
+
+    try:
+        poller = get_status_poller()
+        poller.touch()
+        info = _snapshot_info(machine, poller, await _current_snapshot(poller))
+        if info is not None:
+            max_age = getattr(settings, 'MACHINE_INFO_CACHE_TIMEOUT', 300)
+            return _conditional_json(request, info, _content_etag(info), f'private, max-age={max_age}')
+        return JsonResponse(await sync_to_async(machine.get_machine_info)())
+    except Exception as e:
+        logger.error(f"Error getting machine info: {e}")
+        return JsonResponse(dict(_offline_info(machine), error=str(e)))
+
+
+async def machine_status(request):
+    """Get current machine status (``?format=raw`` and MessagePack as in the sync view)"""
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    machine = get_coffee_machine()
+    if not machine.is_connected:
+        return JsonResponse(_offline_status())
+
+    try:
+        poller = get_status_poller()
+        poller.touch()
+        snapshot = await _current_snapshot(poller)
+        if snapshot is not None:
+            raw = request.GET.get('format') == 'raw'
+            msgpack = accepts_msgpack(request)
+            now = time.monotonic()
+            data = snapshot.to_raw() if raw else snapshot.to_status(now=now)
+            etag = _status_etag(snapshot.version, raw, 'msgpack' if msgpack else 'json', snapshot.countdown_tick(now))
+            response = _conditional_json(request, data, etag, msgpack=msgpack)
+            patch_vary_headers(response, ['Accept'])
+            return response
+        return JsonResponse(await sync_to_async(machine.get_all_groups_status)())
+    except Exception as e:
+        logger.error(f"Error getting machine status: {e}")
+        return JsonResponse(dict(_offline_status(), error=str(e)))
+
+
+async def machine_metrics(request):
+    """Get status poller metrics (current poll rate and the reason for it)"""
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    return JsonResponse({
+        'poller': get_status_poller().metrics(),
+        'orders': get_order_dispatcher().metrics(),
+        'writes': get_write_buffer().metrics(),
+        'telemetry': get_telemetry_store().metrics(),
+        'journal': get_command_journal().metrics(),
+    })
+
+
+async def status_stream(request):
+    """Push the current status once, then only the groups that change.
+
+    One coroutine per client instead of one thread. Django 4.2 does not
+    tell a streaming response that its client went away, so each stream
+    ends after ``STATUS_STREAM_MAX_AGE`` seconds; EventSource reconnects
+    with Last-Event-ID and resumes without a full snapshot.
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    poller = get_status_poller()
+    poller.touch()
+    loop = asyncio.get_running_loop()
+    updates = asyncio.Queue(maxsize=64)
+    keepalive = getattr(settings, 'STATUS_STREAM_KEEPALIVE', 15)
+    max_age = getattr(settings, 'STATUS_STREAM_MAX_AGE', 300)
+    last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+
+    def offer(snapshot):
+        try:
+            updates.put_nowait(snapshot)
+        except asyncio.QueueFull:
+            pass  # The stream coalesces to the newest snapshot anyway
+
+    def subscriber(snapshot):
+        # Called from the poller thread
+        try:
+            loop.call_soon_threadsafe(offer, snapshot)
+        except RuntimeError:
+            pass  # Event loop already closed
+
+    async def events():
+        state = _StreamState(poller, last_event_id)
+        ends_at = time.monotonic() + max_age
+        poller.subscribe(subscriber)
+        try:
+            yield state.retry()
+            opening = state.opening(await _current_snapshot(poller))
+            if opening:
+                yield opening
+
+            while time.monotonic() < ends_at:
+                try:
+                    snapshot = await asyncio.wait_for(updates.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield state.idle()
+                    continue
+
+                # Coalesce a backlog into the newest snapshot
+                while not updates.empty():
+                    snapshot = updates.get_nowait()
+
+                event = state.update(snapshot)
+                if event:
+                    yield event
+        finally:
+            poller.unsubscribe(subscriber)
+            logger.debug("Status stream closed")
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Disable proxy buffering (ingress/nginx)
+    return response
+
+
+async def export_history(request, kind):
+    """Stream an export without buffering it: each chunk is read in the shared thread"""
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    try:
+        options = export_options(request.GET)
+        chunks = export_chunks(kind, **options)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except RuntimeError as e:
+        return JsonResponse({'error': str(e)}, status=501)
+
+    async def content():
+        next_chunk = sync_to_async(next)
+        while True:
+            chunk = await next_chunk(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    response = StreamingHttpResponse(content(), content_type=CONTENT_TYPES[options['fmt']])
+    response['Content-Disposition'] = f'attachment; filename="{export_filename(kind, options["fmt"])}"'
+    return response
+
+
+# Commands and orders write to the bus and the database, so they run in the shared thread
+deliver_coffee = _in_bus_thread(views_raw.deliver_coffee_raw)
+stop_delivery = _in_bus_thread(views_raw.stop_delivery_raw)
+start_purge = _in_bus_thread(views_raw.start_purge_raw)
+batch = _in_bus_thread(views_raw.batch_raw)
+orders = _in_bus_thread(views_raw.orders_raw)
+order_detail = _in_bus_thread(views_raw.order_detail_raw)
@@ -1,11 +1,14 @@
 """Raw views that bypass Django's request parsing"""
 import json
 import logging
+from django.conf import settings
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.utils import timezone
-from .models import CoffeeDelivery, MaintenanceLog
-from .coffee_machine import get_coffee_machine
+from . import services
+from .dispatcher import QueueFull, get_order_dispatcher
+from .idempotency import IdempotencyError, get_idempotency_store, request_key
+from .models import CoffeeOrder
+from .poller import get_status_poller
 
 logger = logging.getLogger('machine')
 
@@ -47,52 +50,25 @@ def deliver_coffee_raw(request):
                 'coffee_type': request.GET.get('type', 'single_short')
             }
         
-        # Get parameters
-        group_number = data.get('group_number')
-        coffee_type = data.get('coffee_type')
-        
-        # Convert group_number to int
-        try:
-            group_number = int(group_number)
-        except (ValueError, TypeError):
-            return JsonResponse({
-                'success': False,
-                'message': f'Invalid group_number: {group_number}'
-            }, status=400)
-        
         # Validate
-        if not (1 <= group_number <= 3):
-            return JsonResponse({
-                'success': False,
-                'message': f'group_number must be between 1 and 3'
-            }, status=400)
-        
-        valid_types = ['single_short', 'single_medium', 'single_long', 
-                      'double_short', 'double_medium', 'double_long']
-        if coffee_type not in valid_types:
+        try:
+            group_number = services.parse_group_number(data.get('group_number'))
+            coffee_type = services.validate_coffee_type(data.get('coffee_type'))
+            idempotency_key = request_key(request, data)
+        except ValueError as e:
             return JsonResponse({
                 'success': False,
-                'message': f'Invalid coffee_type: {coffee_type}'
+                'message': str(e)
             }, status=400)
         
-        # Try to deliver coffee
+        # Try to deliver coffee (the delivery is logged to the database)
         try:
-            machine = get_coffee_machine()
-            result = machine.deliver_coffee(group_number, coffee_type)
-            
-            # Log to database
-            CoffeeDelivery.objects.create(
-                coffee_type=coffee_type,
-                group_number=group_number,
-                status='in_progress' if result['success'] else 'failed'
-            )
-            
+            return JsonResponse(services.deliver_coffee(group_number, coffee_type, idempotency_key))
+        except IdempotencyError as e:
             return JsonResponse({
-                'success': result['success'],
-                'message': result.get('message', 'Coffee delivered'),
-                'group': group_number,
-                'type': coffee_type
-            })
+                'success': False,
+                'message': str(e)
+            }, status=e.status_code)
         except Exception as e:
             logger.error(f"Machine error: {e}")
             return JsonResponse({
@@ -138,41 +114,20 @@ def stop_delivery_raw(request):
         if not data:
             data = {'group_number': 1}
         
-        group_number = data.get('group_number')
-        
-        # Convert to int
         try:
-            group_number = int(group_number)
-        except (ValueError, TypeError):
+            group_number = services.parse_group_number(data.get('group_number'))
+        except ValueError as e:
             return JsonResponse({
                 'success': False,
-                'message': f'Invalid group_number: {group_number}'
+                'message': str(e)
             }, status=400)
         
-        # Stop delivery
+        # Stop delivery (closes in-progress deliveries and logs the stop)
         try:
-            machine = get_coffee_machine()
-            success = machine.stop_delivery(group_number)
-            
-            if success:
-                # Update database
-                CoffeeDelivery.objects.filter(
-                    group_number=group_number,
-                    status='in_progress'
-                ).update(
-                    status='stopped',
-                    completed_at=timezone.now()
-                )
-                
-                MaintenanceLog.objects.create(
-                    log_type='manual_stop',
-                    group_number=group_number,
-                    message=f'Manual stop command sent to group {group_number}'
-                )
-            
+            result = services.stop_delivery(group_number)
             return JsonResponse({
-                'success': success,
-                'message': f'Stop command {"sent" if success else "failed"} for group {group_number}'
+                'success': result['success'],
+                'message': result['message']
             })
         except Exception as e:
             logger.error(f"Machine error: {e}")
@@ -219,32 +174,20 @@ def start_purge_raw(request):
         if not data:
             data = {'group_number': 1}
         
-        group_number = data.get('group_number')
-        
-        # Convert to int
         try:
-            group_number = int(group_number)
-        except (ValueError, TypeError):
+            group_number = services.parse_group_number(data.get('group_number'))
+        except ValueError as e:
             return JsonResponse({
                 'success': False,
-                'message': f'Invalid group_number: {group_number}'
+                'message': str(e)
             }, status=400)
         
-        # Start purge
+        # Start purge (logged as maintenance)
         try:
-            machine = get_coffee_machine()
-            success = machine.start_purge(group_number)
-            
-            if success:
-                MaintenanceLog.objects.create(
-                    log_type='purge',
-                    group_number=group_number,
-                    message=f'Purge cycle started for group {group_number}'
-                )
-            
+            result = services.start_purge(group_number)
             return JsonResponse({
-                'success': success,
-                'message': f'Purge cycle {"started" if success else "failed"} for group {group_number}'
+                'success': result['success'],
+                'message': result['message']
             })
         except Exception as e:
             logger.error(f"Machine error: {e}")
@@ -258,4 +201,159 @@ def start_purge_raw(request):
         return JsonResponse({
             'success': False,
             'error': str(e)
-        }, status=500)
\ No newline at end of file
+        }, status=500)
+
+@csrf_exempt
+def batch_raw(request):
+    """Run several deliver/stop/purge/water/MAT actions in one request"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    
+    try:
+        logger.info("=== BATCH RAW ===")
+        
+        try:
+            data = json.loads(request.read() or b'null')
+        except ValueError as e:
+            return JsonResponse({
+                'success': False,
+                'message': f'Invalid JSON: {e}'
+            }, status=400)
+        
+        # Accept a bare list or {"actions": [...]}
+        actions = data.get('actions') if isinstance(data, dict) else data
+        if not isinstance(actions, list) or not actions:
+            return JsonResponse({
+                'success': False,
+                'message': 'Expected a non-empty list of actions'
+            }, status=400)
+        
+        try:
+            idempotency_key = request_key(request, data)
+        except ValueError as e:
+            return JsonResponse({
+                'success': False,
+                'message': str(e)
+            }, status=400)
+        
+        max_actions = getattr(settings, 'MACHINE_BATCH_MAX_ACTIONS', 8)
+        if len(actions) > max_actions:
+            return JsonResponse({
+                'success': False,
+                'message': f'At most {max_actions} actions per batch'
+            }, status=400)
+        
+        try:
+            return JsonResponse(services.execute_batch(actions, idempotency_key))
+        except IdempotencyError as e:
+            return JsonResponse({
+                'success': False,
+                'message': str(e)
+            }, status=e.status_code)
+        except Exception as e:
+            logger.error(f"Machine error: {e}")
+            return JsonResponse({
+                'success': False,
+                'message': f'Machine error: {str(e)}'
+            }, status=500)
+            
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}")
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+
+@csrf_exempt
+def orders_raw(request):
+    """Order queue: GET lists queued orders with ETAs, POST queues a drink on any group"""
+    dispatcher = get_order_dispatcher()
+    
+    if request.method == 'GET':
+        return JsonResponse({'orders': dispatcher.schedule(), 'queue': dispatcher.metrics()})
+    
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    
+    try:
+        logger.info("=== ORDER RAW ===")
+        
+        try:
+            data = json.loads(request.read() or b'{}')
+        except ValueError as e:
+            return JsonResponse({
+                'success': False,
+                'message': f'Invalid JSON: {e}'
+            }, status=400)
+        if not isinstance(data, dict):
+            data = {}
+        
+        try:
+            coffee_type = services.validate_coffee_type(data.get('coffee_type'))
+            idempotency_key = request_key(request, data)
+        except ValueError as e:
+            return JsonResponse({
+                'success': False,
+                'message': str(e)
+            }, status=400)
+        
+        if not get_status_poller().is_running:
+            return JsonResponse({
+                'success': False,
+                'message': 'Order queue is unavailable: the status poller is not running'
+            }, status=503)
+        
+        def place():
+            return {'order_id': dispatcher.enqueue(coffee_type, idempotency_key or '')['order_id']}
+        
+        try:
+            if idempotency_key:
+                placed, replayed = get_idempotency_store().execute(idempotency_key, ('order', coffee_type), place)
+            else:
+                placed, replayed = place(), False
+        except IdempotencyError as e:
+            return JsonResponse({
+                'success': False,
+                'message': str(e)
+            }, status=e.status_code)
+        except QueueFull as e:
+            return JsonResponse({
+                'success': False,
+                'message': str(e)
+            }, status=503)
+        
+        # Position and ETA are always current, also for a replayed order
+        order = dispatcher.describe(CoffeeOrder.objects.get(id=placed['order_id']))
+        return JsonResponse(dict(order, success=True, replayed=replayed), status=200 if replayed else 201)
+            
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}")
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+
+@csrf_exempt
+def order_detail_raw(request, order_id):
+    """GET an order's status, queue position and ETA; DELETE cancels it while queued"""
+    dispatcher = get_order_dispatcher()
+    try:
+        order = CoffeeOrder.objects.get(id=order_id)
+    except CoffeeOrder.DoesNotExist:
+        return JsonResponse({'error': f'Order {order_id} not found'}, status=404)
+    
+    if request.method == 'GET':
+        return JsonResponse(dispatcher.describe(order))
+    
+    if request.method == 'DELETE':
+        if not dispatcher.cancel(order.id):
+            return JsonResponse({
+                'success': False,
+                'message': f'Order {order.id} is {order.status} and can no longer be cancelled'
+            }, status=409)
+        order.refresh_from_db()
+        return JsonResponse(dict(dispatcher.describe(order), success=True))
+    
+    return JsonResponse({'error': 'Method not allowed'}, status=405)
@@ -0,0 +1,162 @@
+"""Server-Sent Events views that push machine status to the dashboard"""
+import json
+import time
+import queue
+import logging
+import threading
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.views.decorators.http import require_GET
+from .poller import get_status_poller
+
+logger = logging.getLogger('machine')
+
+
+def _sse_event(event: str, data: dict, event_id=None) -> str:
+    """Format one SSE message"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return '\n'.join(lines) + '\n\n'
+
+
+class _StreamState:
+    """What one status stream has sent so far, and the events that follow from it.
+
+    Shared by the threaded stream below and the async one in ``views_async``;
+    only the way snapshots are waited for differs between the two.
+    """
+
+    def __init__(self, poller, last_event_id):
+        self.poller = poller
+        # Resume from the client's last version when it is still in the history
+        self.sent = None
+        if last_event_id:
+            try:
+                self.sent = poller.snapshot_at(int(last_event_id))
+            except ValueError:
+                self.sent = None
+
+    @staticmethod
+    def retry() -> str:
+        return f'retry: {getattr(settings, "STATUS_STREAM_RETRY_MS", 3000)}\n\n'
+
+    def opening(self, current):
+        """One full snapshot, or the delta since the resumed version"""
+        if current is None:
+            self.sent = None
+            return _sse_event('disconnected', {'connection_status': False})
+        return self.update(current)
+
+    def update(self, snapshot):
+        """Event for a new snapshot, or None if its version was already sent"""
+        if self.sent is None:
+            event = _sse_event('snapshot', dict(snapshot.to_status(), connection_status=True), snapshot.version)
+        elif snapshot.version != self.sent.version:
+            changed = snapshot.changed_groups(self.sent)
+            event = _sse_event('groups', dict(snapshot.to_status(changed), connection_status=True), snapshot.version)
+        else:
+            return None
+        self.sent = snapshot
+        return event
+
+    def idle(self) -> str:
+        """Event for a quiet keepalive period"""
+        if self.sent is not None and self.poller.snapshot is None:
+            self.sent = None
+            return _sse_event('disconnected', {'connection_status': False})
+        # Comment line keeps the ingress proxy from closing an idle stream
+        return ': keepalive\n\n'
+
+
+def _status_events(poller, last_event_id, updates, keepalive, max_age):
+    """Yield the status stream: one full snapshot (or a resume delta), then changes for ``max_age`` seconds"""
+    state = _StreamState(poller, last_event_id)
+    ends_at = time.monotonic() + max_age
+    yield state.retry()
+
+    opening = state.opening(poller.refresh())
+    if opening:
+        yield opening
+
+    while time.monotonic() < ends_at:
+        try:
+            snapshot = updates.get(timeout=min(keepalive, max(ends_at - time.monotonic(), 0.01)))
+        except queue.Empty:
+            if time.monotonic() < ends_at:
+                yield state.idle()
+            continue
+
+        # Coalesce a backlog into the newest snapshot
+        while True:
+            try:
+                snapshot = updates.get_nowait()
+            except queue.Empty:
+                break
+
+        event = state.update(snapshot)
+        if event:
+            yield event
+
+
+_stream_threads = None
+_stream_threads_lock = threading.Lock()
+
+def _stream_slots() -> threading.BoundedSemaphore:
+    """Worker threads of this process that status streams may hold at once"""
+    global _stream_threads
+
+    if _stream_threads is None:
+        with _stream_threads_lock:
+            if _stream_threads is None:
+                _stream_threads = threading.BoundedSemaphore(getattr(settings, 'STATUS_STREAM_MAX_THREADS', 4))
+
+    return _stream_threads
+
+
+@require_GET
+def status_stream(request):
+    """Push the current status once, then only the groups that change.
+
+    Each open stream holds a worker thread, so it ends after
+    ``STATUS_STREAM_MAX_AGE`` seconds (EventSource reconnects with
+    Last-Event-ID and resumes without a full snapshot), and at most
+    ``STATUS_STREAM_MAX_THREADS`` streams per process stay open: beyond
+    that a client gets the opening event only and reconnects after the
+    retry delay, which leaves the other threads to the API.
+    """
+    poller = get_status_poller()
+    poller.touch()
+    updates = queue.Queue(maxsize=64)
+
+    def subscriber(snapshot):
+        try:
+            updates.put_nowait(snapshot)
+        except queue.Full:
+            pass  # The stream coalesces to the newest snapshot anyway
+
+    def events():
+        slots = _stream_slots()
+        held = slots.acquire(blocking=False)
+        max_age = getattr(settings, 'STATUS_STREAM_MAX_AGE', 300) if held else 0
+        poller.subscribe(subscriber)
+        try:
+            yield from _status_events(
+                poller,
+                request.headers.get('Last-Event-ID') or request.GET.get('last_event_id'),
+                updates,
+                getattr(settings, 'STATUS_STREAM_KEEPALIVE', 15),
+                max_age,
+            )
+        finally:
+            poller.unsubscribe(subscriber)
+            if held:
+                slots.release()
+            logger.debug("Status stream closed")
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Disable proxy buffering (ingress/nginx)
+    return response
@@ -0,0 +1,294 @@
+"""Write-behind buffer that takes database writes off the request path"""
+import os
+import json
+import time
+import uuid
+import fcntl
+import logging
+import threading
+from itertools import groupby
+from typing import Dict, List, Optional
+from django.apps import apps
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+logger = logging.getLogger('machine')
+
+JOURNAL_PREFIX = 'writebehind-'
+
+
+class WriteBehindBuffer:
+    """Queues inserts and updates and writes them in batches from a background thread.
+
+    Callers only append to a list (and to the journal, when one is
+    configured) and return; the flush thread writes everything queued every
+    ``flush_interval`` seconds, or as soon as ``batch_size`` writes wait,
+    in queue order and in one transaction: consecutive inserts into a
+    model become one bulk INSERT. Queued writes are flushed on shutdown.
+
+    With ``journal_dir`` each write is first appended to a journal file of
+    this process. The journal of a process that died before flushing is
+    replayed by the next process that starts (at least once).
+    """
+
+    def __init__(self, flush_interval: Optional[float] = None, batch_size: Optional[int] = None,
+                 journal_dir: Optional[str] = None, journal_fsync: Optional[bool] = None,
+                 enabled: Optional[bool] = None):
+        self.flush_interval = flush_interval or getattr(settings, 'WRITE_BEHIND_FLUSH_INTERVAL', 0.25)
+        self.batch_size = batch_size or getattr(settings, 'WRITE_BEHIND_BATCH_SIZE', 50)
+        self.journal_dir = journal_dir or getattr(settings, 'WRITE_BEHIND_JOURNAL_DIR', None)
+        self.journal_fsync = journal_fsync if journal_fsync is not None else getattr(
+            settings, 'WRITE_BEHIND_JOURNAL_FSYNC', False)
+        self.enabled = enabled if enabled is not None else getattr(settings, 'WRITE_BEHIND_ENABLED', True)
+
+        self._ops: List[Dict] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._recovered = False
+        self._flushed = 0
+        self._last_flush_ms: Optional[float] = None
+
+        self._journal = None
+        self._journal_path: Optional[str] = None
+        self._lock_file = None
+        self._segment = 0
+        self._segments: List[str] = []  # Rotated journal files not yet written to the database
+
+    # Queueing (request threads)
+
+    def insert(self, obj):
+        """Queue an INSERT of an unsaved model instance"""
+        fields = {field.attname: getattr(obj, field.attname)
+                  for field in obj._meta.concrete_fields if not field.primary_key}
+        self._queue({'op': 'insert', 'model': obj._meta.label_lower, 'fields': fields})
+
+    def update(self, model, filters: Dict, **values):
+        """Queue ``model.objects.filter(**filters).update(**values)``"""
+        self._queue({'op': 'update', 'model': model._meta.label_lower, 'filters': filters, 'values': values})
+
+    def _queue(self, op: Dict):
+        if not self.enabled or self._thread is None:
+            self._apply([op])
+            return
+        with self._lock:
+            if self._journal is not None:
+                self._journal.write(json.dumps(op, cls=DjangoJSONEncoder) + '\n')
+                self._journal.flush()
+                if self.journal_fsync:
+                    os.fsync(self._journal.fileno())
+            self._ops.append(op)
+            due = len(self._ops) >= self.batch_size
+        if due:
+            self._wake.set()
+
+    # Flushing (background thread)
+
+    def start(self):
+        """Open this process's journal and start the flush thread"""
+        if not self.enabled or self._thread is not None:
+            return
+        if self.journal_dir:
+            self._open_journal()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+        logger.info(f"Write-behind buffer started ({self.flush_interval}s, {self.batch_size} writes"
+                    f"{', journal in ' + self.journal_dir if self.journal_dir else ''})")
+
+    def stop(self):
+        """Stop the flush thread and write out everything still queued"""
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._stopped.set()
+        self._wake.set()
+        thread.join(timeout=10)
+        if self.flush() is not None and not self._segments:
+            self._close_journal()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if not self._recovered:
+                self._recover()
+            self.flush()
+
+    def flush(self) -> Optional[int]:
+        """Write queued operations to the database; returns how many (None on failure)"""
+        with self._flush_lock:
+            with self._lock:
+                ops, self._ops = self._ops, []
+                self._rotate_journal()
+                segments = list(self._segments)
+            if not ops:
+                return 0
+
+            started = time.monotonic()
+            try:
+                self._apply(ops)
+            except Exception as e:
+                logger.error(f"Failed to write {len(ops)} buffered writes: {e}")
+                with self._lock:
+                    self._ops = ops + self._ops
+                return None
+
+            self._flushed += len(ops)
+            self._last_flush_ms = round((time.monotonic() - started) * 1000, 1)
+            for path in segments:
+                os.remove(path)
+                self._segments.remove(path)
+            return len(ops)
+
+    def _apply(self, ops: List[Dict]):
+        """Write operations in order, in one transaction"""
+        with transaction.atomic():
+            for (kind, label), group in groupby(ops, key=lambda op: (op['op'], op['model'])):
+                model = apps.get_model(label)
+                if kind == 'insert':
+                    model.objects.bulk_create([model(**op['fields']) for op in group])
+                else:
+                    for op in group:
+                        model.objects.filter(**op['filters']).update(**op['values'])
+
+    # Journal
+
+    def _open_journal(self):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        name = f'{JOURNAL_PREFIX}{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        # Held for the life of the process: a lock that can be taken means its owner is gone
+        self._lock_file = open(os.path.join(self.journal_dir, f'{name}.lock'), 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._journal_path = os.path.join(self.journal_dir, f'{name}.jsonl')
+        self._journal = open(self._journal_path, 'a')
+
+    def _rotate_journal(self):
+        """Move the journal aside so it can be deleted once its writes are committed"""
+        if self._journal is None or self._journal.tell() == 0:
+            return
+        self._journal.close()
+        self._segment += 1
+        segment = f'{self._journal_path}.{self._segment}'
+        os.rename(self._journal_path, segment)
+        self._segments.append(segment)
+        self._journal = open(self._journal_path, 'a')
+
+    def _close_journal(self):
+        if self._journal is None:
+            return
+        self._journal.close()
+        self._journal = None
+        os.remove(self._journal_path)
+        os.remove(self._lock_file.name)
+        self._lock_file.close()
+        self._lock_file = None
+
+    def _recover(self):
+        """Replay the journals of processes that exited without flushing"""
+        if not self.journal_dir:
+            self._recovered = True
+            return
+        try:
+            names = sorted(os.listdir(self.journal_dir))
+        except OSError as e:
+            logger.error(f"Failed to list write-behind journals: {e}")
+            return
+
+        own = os.path.basename(self._lock_file.name) if self._lock_file else None
+        for lock_name in names:
+            if not (lock_name.startswith(JOURNAL_PREFIX) and lock_name.endswith('.lock')) or lock_name == own:
+                continue
+            try:
+                lock_file = open(os.path.join(self.journal_dir, lock_name))
+            except FileNotFoundError:
+                continue  # Recovered by another process meanwhile
+            with lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # Owner still running
+                try:
+                    self._replay(lock_name[:-len('.lock')], names)
+                except Exception as e:
+                    logger.error(f"Failed to replay write-behind journal {lock_name}: {e}")
+                    return  # Database not ready yet; try again on the next flush
+                try:
+                    os.remove(lock_file.name)
+                except FileNotFoundError:
+                    pass
+        self._recovered = True
+
+    def _replay(self, name: str, names: List[str]):
+        base = f'{name}.jsonl'
+        paths = sorted((n for n in names if n.startswith(f'{base}.')), key=lambda n: int(n.rsplit('.', 1)[1]))
+        paths = [os.path.join(self.journal_dir, n) for n in paths + [base]]
+
+        ops = []
+        for path in paths:
+            try:
+                with open(path) as journal:
+                    for line in journal:
+                        try:
+                            ops.append(_decode(json.loads(line)))
+                        except ValueError:
+                            break  # Torn last line of a crash
+            except FileNotFoundError:
+                continue
+        if ops:
+            self._apply(ops)
+            logger.info(f"Replayed {len(ops)} writes from write-behind journal {name}")
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            queued = len(self._ops)
+        return {
+            'enabled': self.enabled and self._thread is not None,
+            'queued': queued,
+            'flushed': self._flushed,
+            'last_flush_ms': self._last_flush_ms,
+            'journal': self._journal_path,
+        }
+
+
+def _decode(op: Dict) -> Dict:
+    """Journal entry back to Python values (dates arrive as ISO strings)"""
+    model = apps.get_model(op['model'])
+
+    def convert(values):
+        converted = {}
+        for key, value in values.items():
+            field = model._meta.get_field(key.split('__')[0])
+            if isinstance(value, list):
+                converted[key] = [field.to_python(item) for item in value]
+            else:
+                converted[key] = field.to_python(value) if value is not None else None
+        return converted
+
+    if op['op'] == 'insert':
+        return dict(op, fields=convert(op['fields']))
+    return dict(op, filters=convert(op['filters']), values=convert(op['values']))
+
+
+# Singleton instance for Django integration
+_buffer_instance = None
+_buffer_lock = threading.Lock()
+
+def get_write_buffer() -> WriteBehindBuffer:
+    """Get singleton write-behind buffer instance"""
+    global _buffer_instance
+
+    if _buffer_instance is None:
+        with _buffer_lock:
+            if _buffer_instance is None:
+                _buffer_instance = WriteBehindBuffer()
+
+    return _buffer_instance
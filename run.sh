@@ -11,6 +11,8 @@ declare baudrate
 declare secret_key
 declare debug
 declare log_level
+declare channel_layer
+declare server
 
 bashio::log.info "Starting Coffee Machine Controller..."
 
@@ -20,12 +22,16 @@ baudrate=$(bashio::config 'baudrate')
 secret_key=$(bashio::config 'django_secret_key')
 debug=$(bashio::config 'debug')
 log_level=$(bashio::config 'log_level')
+channel_layer=$(bashio::config 'channel_layer' 'memory')
+server=$(bashio::config 'server' 'uvicorn')
 
 bashio::log.info "Configuring Coffee Machine Controller..."
 bashio::log.info "Serial Port: ${port}"
 bashio::log.info "Baudrate: ${baudrate}"
 bashio::log.info "Debug Mode: ${debug}"
 bashio::log.info "Log Level: ${log_level}"
+bashio::log.info "Channel Layer: ${channel_layer}"
+bashio::log.info "Server: ${server}"
 
 # Set environment variables
 export DJANGO_SECRET_KEY="${secret_key}"
@@ -33,6 +39,7 @@ export DJANGO_DEBUG="${debug}"
 export COFFEE_MACHINE_PORT="${port}"
 export COFFEE_MACHINE_BAUDRATE="${baudrate}"
 export DJANGO_LOG_LEVEL="${log_level}"
+export CHANNEL_LAYER_BACKEND="${channel_layer}"
 
 # Create database if it doesn't exist
 if [ ! -f /data/db.sqlite3 ]; then
@@ -63,8 +70,29 @@ chmod -R 755 /data
 bashio::log.info "Starting Coffee Machine Controller web server..."
 cd /app
 
-# Use gunicorn for production
+# The server process runs the poller, delivery tracking and order dispatch
+export COFFEE_MACHINE_BACKGROUND="True"
+
+if [ "${server}" = "uvicorn" ]; then
+    # Single process: one event loop serves every HTTP/WebSocket client and the
+    # same process owns the serial bus, so there is exactly one poller
+    export COFFEE_MACHINE_ASYNC_VIEWS="True"
+    exec uvicorn coffee_machine_controller.asgi:application \
+        --host 0.0.0.0 \
+        --port 8000 \
+        --workers 1 \
+        --lifespan off \
+        --proxy-headers \
+        --timeout-keep-alive 5 \
+        --log-level "${log_level,,}"
+fi
+
+# gunicorn serves the WSGI application only: no WebSocket (/ws/machine/), and
+# each worker process runs its own status poller
+bashio::log.warning "Server gunicorn: the WebSocket API (/ws/machine/) is not served; use server: uvicorn for it"
 exec gunicorn coffee_machine_controller.wsgi:application \
+    --worker-class gthread \
+    --threads 8 \
     --bind 0.0.0.0:8000 \
     --workers 2 \
     --timeout 120 \
@@ -67,6 +67,9 @@ echo "Using Gunicorn for better proxy support..."
 echo "=========================================="
 echo ""
 
+# The server process runs the poller, delivery tracking and order dispatch
+export COFFEE_MACHINE_BACKGROUND="True"
+
 # Use gunicorn instead of runserver for better proxy support
 gunicorn coffee_machine_controller.wsgi:application \
     --bind 0.0.0.0:8000 \